@@ -3,6 +3,7 @@ from gevent.monkey import patch_all; patch_all()
 import logging
 from redis import StrictRedis
 from shepherd.shepherd import Shepherd
+from shepherd.redis_stats import RedisStats
 import os
 
 from shepherd.wsgi import create_app
@@ -27,6 +28,10 @@ def main():
 
     redis = StrictRedis.from_url(REDIS_URL, decode_responses=True)
 
+    # count redis calls per api endpoint
+    if os.environ.get('REDIS_STATS'):
+        redis = RedisStats().wrap(redis)
+
     shepherd = Shepherd(redis, NETWORK_NAME)
     shepherd.load_flocks(FLOCKS)
 
@@ -0,0 +1,308 @@
+from gevent.monkey import patch_all; patch_all()
+
+import argparse
+import json
+import time
+from contextlib import contextmanager
+
+import gevent
+import gevent.pool
+
+from shepherd.pool import create_pool
+
+from benchmarks.utils import make_shepherd, summarize, get_meta, save_results, load_results
+
+
+# ============================================================================
+class PoolBenchmark(object):
+    """ Request, start, poll, expire and remove flocks in a single pool,
+    recording latency, redis commands and docker calls for each operation
+    """
+    FLOCK = 'bench'
+
+    def __init__(self, pool_type, size, depth=0, latency=None, errors=None, seed=None,
+                 concurrency=1, poll_rounds=3, teardown_rate=None):
+        self.pool_type = pool_type
+        self.size = size
+        self.depth = depth if pool_type != 'all' else 0
+        self.latency = latency
+        self.errors = errors
+        self.seed = seed
+        self.concurrency = concurrency
+        self.poll_rounds = poll_rounds
+        self.teardown_rate = teardown_rate
+
+        self.latencies = {}
+        self.phases = {}
+
+    def run(self):
+        self.shepherd = make_shepherd(latency=self.latency, errors=self.errors, seed=self.seed,
+                                      teardown_rate=self.teardown_rate,
+                                      teardown_concurrency=self.concurrency * 2)
+
+        self.docker = self.shepherd.docker
+        self.redis = self.shepherd.redis
+        self.stats = self.shepherd.redis_stats
+
+        self.pool = create_pool(self.shepherd, self.redis, {'name': 'bench-' + self.pool_type,
+                                                            'type': self.pool_type,
+                                                            'max_size': self.size,
+                                                            'duration': 3600,
+                                                            'expire_check': 3600,
+                                                            'expire_concurrency': self.concurrency,
+                                                            'wait_ping_ttl': 3600})
+
+        try:
+            self.stats.reset()
+
+            reqids = self.run_phase('request', self.request, [None] * (self.size + self.depth))
+
+            running = reqids[:self.size]
+            queued = reqids[self.size:]
+
+            self.run_phase('start', self.start, running)
+
+            for x in range(0, self.poll_rounds):
+                self.run_phase('queue_poll', self.start, queued)
+
+            # expire half of the running flocks, the rest are removed while running
+            running = sorted(self.redis.smembers(self.pool.flocks_key))
+            self.run_expire(running[:(len(running) + 1) // 2])
+            self.wait_teardown(reqids)
+
+            # freed slots are taken by queued flocks on their next poll
+            if self.pool_type == 'fixed':
+                self.run_phase('queue_admit', self.start, queued)
+
+            self.run_phase('remove', self.remove, reqids)
+            self.wait_teardown(reqids)
+
+        finally:
+            self.pool.shutdown()
+            self.shepherd.shutdown()
+
+        return self.get_results()
+
+    def run_phase(self, op, func, items):
+        with self.phase(op):
+            pool = gevent.pool.Pool(self.concurrency)
+            return pool.map(lambda item: self.timed(op, func, item), items)
+
+    def run_expire(self, reqids):
+        self.make_due(reqids)
+
+        # time each flock expired by the pool, up to expire_concurrency at a time,
+        # but not deadlines set again by die events of removed containers
+        due = set(reqids)
+        expire = self.pool._expire
+
+        def timed_expire(reqid):
+            if reqid not in due:
+                return expire(reqid)
+
+            due.discard(reqid)
+            return self.timed('expire', expire, reqid)
+
+        self.pool._expire = timed_expire
+
+        try:
+            with self.phase('expire'):
+                while self.pool.expire_due() >= self.pool.EXPIRE_BATCH:
+                    pass
+
+                self.pool.expire_pool.join()
+
+        finally:
+            del self.pool._expire
+
+    @contextmanager
+    def phase(self, op):
+        calls = dict(self.docker.calls)
+        start = time.time()
+
+        yield
+
+        phase = self.phases.setdefault(op, {'elapsed': 0.0, 'docker_calls': {}})
+        phase['elapsed'] += time.time() - start
+
+        for name, count in self.docker.calls.items():
+            count -= calls.get(name, 0)
+            if count:
+                phase['docker_calls'][name] = phase['docker_calls'].get(name, 0) + count
+
+    def timed(self, op, func, item):
+        self.stats.set_context(op)
+        start = time.time()
+        try:
+            return func(item)
+        finally:
+            self.latencies.setdefault(op, []).append(time.time() - start)
+            self.stats.set_context(None)
+
+    def wait_teardown(self, reqids):
+        for reqid in reqids:
+            self.shepherd.teardown.wait(reqid)
+
+    def request(self, item):
+        res = self.pool.request(self.FLOCK, {})
+        return res['reqid']
+
+    def start(self, reqid):
+        return self.pool.start(reqid)
+
+    def make_due(self, reqids):
+        # duration has passed
+        pi = self.redis.pipeline()
+        for reqid in reqids:
+            pi.delete(self.pool.req_key + reqid)
+            pi.zadd(self.pool.deadlines_key, 0, reqid)
+
+        pi.execute()
+
+    def remove(self, reqid):
+        return self.pool.remove(reqid)
+
+    def get_results(self):
+        stats = self.stats.get_stats()
+
+        ops = {}
+        for op, latencies in self.latencies.items():
+            phase = self.phases[op]
+            res = summarize(latencies, phase['elapsed'])
+
+            entry = stats.get(op, {})
+            requests = entry.get('requests') or 1
+            res['redis_calls_per_op'] = entry.get('calls', 0) / requests
+            res['redis_commands_per_op'] = {name: value['calls'] / requests
+                                            for name, value in entry.get('commands', {}).items()}
+
+            res['docker_calls_per_op'] = {name: count / float(len(latencies))
+                                          for name, count in phase['docker_calls'].items()}
+
+            ops[op] = res
+
+        background = stats.get(self.stats.BACKGROUND, {})
+
+        return {'pool': self.pool_type,
+                'size': self.size,
+                'depth': self.depth,
+                'concurrency': self.concurrency,
+                'ops': ops,
+                'background_redis_calls': background.get('calls', 0)}
+
+
+# ============================================================================
+def case_key(case):
+    return (case['pool'], case['size'], case['depth'], case['concurrency'])
+
+
+def print_case(case, base=None):
+    print('\n{pool} pool, size {size}, queue depth {depth}, concurrency {concurrency}'.format(**case))
+    print('  {0:<12} {1:>8} {2:>10} {3:>10} {4:>10} {5:>8}'.format('op', 'count', 'ops/s', 'p50 ms', 'p99 ms', 'redis'))
+
+    for op, res in case['ops'].items():
+        line = '  {0:<12} {1:>8} {2:>10.1f} {3:>10.2f} {4:>10.2f} {5:>8.1f}'.format(op, res['count'],
+                                                                                  res['ops_per_sec'],
+                                                                                  res['p50_ms'],
+                                                                                  res['p99_ms'],
+                                                                                  res['redis_calls_per_op'])
+
+        base_res = base['ops'].get(op) if base else None
+        if base_res and base_res['ops_per_sec']:
+            line += '  ({0:+.0f}% ops/s, {1:+.1f} redis)'.format((res['ops_per_sec'] / base_res['ops_per_sec'] - 1) * 100,
+                                                                 res['redis_calls_per_op'] - base_res['redis_calls_per_op'])
+
+        print(line)
+
+
+def load_latency(value):
+    if not value:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    if value.startswith('{'):
+        return json.loads(value)
+
+    with open(value, 'rt') as fh:
+        return json.load(fh)
+
+
+def split_ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+# ============================================================================
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark pool throughput against fakeredis and a fake docker client')
+
+    parser.add_argument('--pools', default='all,fixed,persist',
+                        help='pool types to benchmark')
+
+    parser.add_argument('--sizes', default='10,100', type=split_ints,
+                        help='pool max_size values, also the number of running flocks')
+
+    parser.add_argument('--depths', default='0,100', type=split_ints,
+                        help='number of queued flocks beyond max_size (fixed and persist pools)')
+
+    parser.add_argument('--latency', default='0.001',
+                        help='docker call latency: seconds, a json dict of call name to latency, or a json file')
+
+    parser.add_argument('--errors', default=None,
+                        help='json dict of docker call name to error rate')
+
+    parser.add_argument('--concurrency', default=1, type=int,
+                        help='concurrent operations in each phase')
+
+    parser.add_argument('--poll-rounds', default=3, type=int,
+                        help='number of times each queued flock polls start')
+
+    parser.add_argument('--teardown-rate', default=10000, type=float,
+                        help='teardown rate limit, high by default to measure shepherd rather than the limit')
+
+    parser.add_argument('--seed', default=1, type=int)
+
+    parser.add_argument('-o', '--output', default=None,
+                        help='save results as json')
+
+    parser.add_argument('--compare', default=None,
+                        help='json results of a previous run to compare with')
+
+    args = parser.parse_args(args)
+
+    latency = load_latency(args.latency)
+    errors = json.loads(args.errors) if args.errors else None
+
+    base = {}
+    if args.compare:
+        base = {case_key(case): case for case in load_results(args.compare)['results']}
+
+    results = []
+
+    for pool_type in args.pools.split(','):
+        for size in args.sizes:
+            for depth in (args.depths if pool_type != 'all' else [0]):
+                bench = PoolBenchmark(pool_type, size, depth,
+                                      latency=latency,
+                                      errors=errors,
+                                      seed=args.seed,
+                                      concurrency=args.concurrency,
+                                      poll_rounds=args.poll_rounds,
+                                      teardown_rate=args.teardown_rate)
+
+                case = bench.run()
+                results.append(case)
+                print_case(case, base.get(case_key(case)))
+
+    if args.output:
+        save_results(args.output, {'meta': get_meta(args), 'results': results})
+        print('\nResults saved to ' + args.output)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
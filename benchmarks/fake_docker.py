@@ -0,0 +1,608 @@
+import binascii
+import collections
+import itertools
+import os
+import random
+import time
+
+import gevent
+import gevent.queue
+
+from docker.api.client import APIClient
+from docker.errors import NotFound, APIError, ImageNotFound
+
+
+# ============================================================================
+def new_id():
+    return binascii.hexlify(os.urandom(32)).decode('utf-8')
+
+
+def match_labels(labels, label_filter):
+    if isinstance(label_filter, str):
+        label_filter = [label_filter]
+
+    for value in label_filter:
+        name, _, value = value.partition('=')
+        if name not in labels or (value and labels[name] != value):
+            return False
+
+    return True
+
+
+# ============================================================================
+class Latency(object):
+    """ Latency and error injection for each fake docker call
+
+    latency is either a number of seconds for all calls, or a dict of call name to
+    a number, a [min, max] uniform range, or {'mean': .., 'sd': ..} for a normal distribution,
+    with 'default' used for any other call
+
+    errors is a dict of call name to the fraction of calls which raise an APIError
+    """
+    def __init__(self, latency=None, errors=None, seed=None):
+        if not isinstance(latency, dict):
+            latency = {'default': latency or 0}
+
+        self.latency = latency
+        self.errors = errors or {}
+        self.random = random.Random(seed)
+
+    def get_delay(self, name):
+        value = self.latency.get(name, self.latency.get('default', 0))
+
+        if isinstance(value, (list, tuple)):
+            return self.random.uniform(value[0], value[1])
+
+        if isinstance(value, dict):
+            return max(self.random.gauss(value['mean'], value.get('sd', 0)), 0)
+
+        return value or 0
+
+    def call(self, name):
+        delay = self.get_delay(name)
+        if delay:
+            gevent.sleep(delay)
+
+        rate = self.errors.get(name)
+        if rate and self.random.random() < rate:
+            raise APIError('Injected error: ' + name)
+
+
+# ============================================================================
+class FakeModel(object):
+    def __init__(self, client, attrs):
+        self.client = client
+        self.attrs = attrs
+
+    @property
+    def id(self):
+        return self.attrs['Id']
+
+    @property
+    def short_id(self):
+        return self.id[:12]
+
+    def __eq__(self, other):
+        return self.id == getattr(other, 'id', None)
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+# ============================================================================
+class FakeContainer(FakeModel):
+    @property
+    def name(self):
+        return self.attrs['Name']
+
+    @property
+    def labels(self):
+        return self.attrs['Config']['Labels']
+
+    @property
+    def status(self):
+        return self.attrs['State']['Status']
+
+    def start(self):
+        self.client.api.start(self.id)
+
+    def reload(self):
+        self.client.latency.call('inspect_container')
+        self.attrs = self.client.get_container(self.id).attrs
+
+    def kill(self):
+        self.client.api.kill(self.id)
+
+    def stop(self, timeout=None):
+        self.client.api.stop(self.id, timeout=timeout)
+
+    def remove(self, force=False, v=False):
+        self.client.api.remove_container(self.id, force=force, v=v)
+
+    def rename(self, name):
+        self.client.api.rename(self.id, name)
+
+
+# ============================================================================
+class FakeNetwork(FakeModel):
+    @property
+    def name(self):
+        return self.attrs['Name']
+
+    @property
+    def containers(self):
+        return [self.client.get_container(cid) for cid in self.attrs['Containers']]
+
+    def reload(self):
+        self.client.latency.call('inspect_network')
+
+    def connect(self, container, aliases=None):
+        self.client.api.connect_container_to_network(getattr(container, 'id', container), self.id)
+
+    def disconnect(self, container, force=False):
+        self.client.api.disconnect_container_from_network(getattr(container, 'id', container), self.id)
+
+    def remove(self):
+        self.client.api.remove_network(self.id)
+
+
+# ============================================================================
+class FakeImage(FakeModel):
+    @property
+    def labels(self):
+        return self.attrs['Config']['Labels']
+
+    @property
+    def tags(self):
+        return self.attrs['RepoTags']
+
+
+# ============================================================================
+class FakeAPI(object):
+    """ The low-level APIClient calls used by shepherd
+    """
+    API_VERSION = '1.41'
+
+    EVENT_HISTORY = 10000
+
+    def __init__(self, client):
+        self.client = client
+
+        # used only to build config dicts
+        self.config_client = APIClient(version=self.API_VERSION)
+
+        self.event_subs = []
+        self.event_history = collections.deque(maxlen=self.EVENT_HISTORY)
+
+    def _call(self, name):
+        self.client.count(name)
+        self.client.latency.call(name)
+
+    def create_host_config(self, *args, **kwargs):
+        return self.config_client.create_host_config(*args, **kwargs)
+
+    def create_networking_config(self, *args, **kwargs):
+        return self.config_client.create_networking_config(*args, **kwargs)
+
+    def create_endpoint_config(self, *args, **kwargs):
+        return self.config_client.create_endpoint_config(*args, **kwargs)
+
+    def emit(self, type_, action, id_, attrs):
+        now = time.time()
+        event = {'Type': type_,
+                 'Action': action,
+                 'status': action,
+                 'id': id_,
+                 'Actor': {'ID': id_, 'Attributes': attrs},
+                 'time': int(now),
+                 'timeNano': int(now * 1e9)}
+
+        self.event_history.append(event)
+        for queue in self.event_subs:
+            queue.put(event)
+
+    def _match_event(self, event, filters):
+        types = filters.get('type')
+        if types and event['Type'] not in ([types] if isinstance(types, str) else types):
+            return False
+
+        actions = filters.get('event')
+        if actions and event['Action'] not in ([actions] if isinstance(actions, str) else actions):
+            return False
+
+        label = filters.get('label')
+        if label and not match_labels(event['Actor']['Attributes'], label):
+            return False
+
+        return True
+
+    def events(self, decode=True, filters=None, since=None):
+        self.client.count('events')
+        queue = gevent.queue.Queue()
+        self.event_subs.append(queue)
+
+        if since:
+            secs, _, nanos = str(since).partition('.')
+            since = int(secs) * 10 ** 9 + int((nanos or '0').ljust(9, '0')[:9])
+            for event in self.event_history:
+                if event['timeNano'] >= since:
+                    queue.put(event)
+
+        try:
+            for event in queue:
+                if event is StopIteration:
+                    return
+
+                if self._match_event(event, filters or {}):
+                    yield event
+        finally:
+            if queue in self.event_subs:
+                self.event_subs.remove(queue)
+
+    def close_events(self):
+        for queue in self.event_subs:
+            queue.put(StopIteration)
+
+    def create_container(self, image, name=None, labels=None, environment=None,
+                         networking_config=None, host_config=None, **kwargs):
+        self._call('create_container')
+        image_obj = self.client.images.find(image)
+
+        if name and self.client.find_container(name):
+            raise APIError('Conflict: container name already in use: ' + name)
+
+        if isinstance(environment, dict):
+            environment = ['{0}={1}'.format(n, v) for n, v in environment.items()]
+
+        endpoints = (networking_config or {}).get('EndpointsConfig') or {'bridge': {}}
+
+        attrs = {'Id': new_id(),
+                 'Name': name or new_id()[:16],
+                 'Image': image_obj.id,
+                 'Config': {'Labels': dict(labels or {}),
+                            'Env': list(environment or []),
+                            'Image': image},
+                 'State': {'Status': 'created', 'ExitCode': 0},
+                 'HostConfig': host_config or {},
+                 'NetworkSettings': {'Networks': {}, 'Ports': {}}}
+
+        container = FakeContainer(self.client, attrs)
+        self.client._containers[container.id] = container
+
+        for network_name in endpoints:
+            network = self.client.get_network(network_name)
+            network.attrs['Containers'][container.id] = {}
+            attrs['NetworkSettings']['Networks'][network.name] = {'IPAddress': ''}
+
+        self.emit('container', 'create', container.id,
+                  dict(container.labels, image=image, name=container.name))
+
+        return {'Id': container.id}
+
+    def inspect_container(self, container_id):
+        self._call('inspect_container')
+        return self.client.get_container(container_id).attrs
+
+    def start(self, container_id):
+        self._call('start')
+        container = self.client.get_container(container_id)
+        container.attrs['State']['Status'] = 'running'
+
+        for settings in container.attrs['NetworkSettings']['Networks'].values():
+            settings['IPAddress'] = self.client.next_ip()
+
+        ports = {}
+        for port in (container.attrs['HostConfig'].get('PortBindings') or {}):
+            ports[port] = [{'HostIp': '0.0.0.0', 'HostPort': str(self.client.next_port())}]
+
+        container.attrs['NetworkSettings']['Ports'] = ports
+
+        self.emit('container', 'start', container.id,
+                  dict(container.labels, name=container.name))
+
+    def _die(self, container, exit_code):
+        if container.status != 'running':
+            return
+
+        container.attrs['State']['Status'] = 'exited'
+        container.attrs['State']['ExitCode'] = int(exit_code)
+        self.emit('container', 'die', container.id,
+                  dict(container.labels, exitCode=exit_code, name=container.name))
+
+    def kill(self, container_id):
+        self._call('kill')
+        self._die(self.client.get_container(container_id), '137')
+
+    def stop(self, container_id, timeout=None):
+        self._call('stop')
+        self._die(self.client.get_container(container_id), '0')
+
+    def remove_container(self, container_id, force=False, v=False):
+        self._call('remove_container')
+        container = self.client.get_container(container_id)
+        if container.status == 'running' and not force:
+            raise APIError('Conflict: container is running: ' + container_id)
+
+        self._die(container, '137')
+
+        del self.client._containers[container.id]
+        for network in self.client._networks.values():
+            network.attrs['Containers'].pop(container.id, None)
+
+        self.emit('container', 'destroy', container.id,
+                  dict(container.labels, name=container.name))
+
+    def rename(self, container_id, name):
+        self._call('rename')
+        self.client.get_container(container_id).attrs['Name'] = name
+
+    def connect_container_to_network(self, container_id, network_id, aliases=None):
+        self._call('connect_container_to_network')
+        container = self.client.get_container(container_id)
+        network = self.client.get_network(network_id)
+
+        network.attrs['Containers'][container.id] = {}
+        container.attrs['NetworkSettings']['Networks'][network.name] = {'IPAddress': self.client.next_ip()}
+
+    def disconnect_container_from_network(self, container_id, network_id, force=False):
+        self._call('disconnect_container_from_network')
+        container = self.client.get_container(container_id)
+        network = self.client.get_network(network_id)
+
+        network.attrs['Containers'].pop(container.id, None)
+        container.attrs['NetworkSettings']['Networks'].pop(network.name, None)
+
+    def remove_network(self, network_id):
+        self._call('remove_network')
+        network = self.client.get_network(network_id)
+        if network.attrs['Containers']:
+            raise APIError('Conflict: network has active endpoints: ' + network.name)
+
+        del self.client._networks[network.id]
+        self.emit('network', 'destroy', network.id,
+                  dict(network.attrs['Labels'], name=network.name, type='bridge'))
+
+    def history(self, image_id):
+        self._call('history')
+        image = self.client.images.find(image_id)
+        size = image.attrs['Size'] // max(len(image.attrs['RootFS']['Layers']), 1)
+        return [{'Id': layer, 'Size': size} for layer in reversed(image.attrs['RootFS']['Layers'])]
+
+
+# ============================================================================
+class FakeContainers(object):
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, container_id):
+        self.client.count('containers.get')
+        self.client.latency.call('inspect_container')
+        return self.client.get_container(container_id)
+
+    def list(self, all=False, filters=None, ignore_removed=False, **kwargs):
+        self.client.count('containers.list')
+        self.client.latency.call('containers.list')
+
+        res = []
+        for container in list(self.client._containers.values()):
+            if not all and container.status != 'running':
+                continue
+
+            if filters and 'label' in filters and not match_labels(container.labels, filters['label']):
+                continue
+
+            if filters and 'network' in filters and filters['network'] not in container.attrs['NetworkSettings']['Networks']:
+                continue
+
+            res.append(container)
+
+        return res
+
+    def prepare_model(self, attrs):
+        return FakeContainer(self.client, attrs)
+
+
+# ============================================================================
+class FakeNetworks(object):
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, name, labels=None, **kwargs):
+        self.client.count('networks.create')
+        self.client.latency.call('networks.create')
+        return self.client.add_network(name, labels)
+
+    def get(self, network_id):
+        self.client.count('networks.get')
+        self.client.latency.call('inspect_network')
+        return self.client.get_network(network_id)
+
+    def list(self, names=None, filters=None, **kwargs):
+        self.client.count('networks.list')
+        self.client.latency.call('networks.list')
+
+        res = []
+        for network in self.client._networks.values():
+            if names and network.name not in names:
+                continue
+
+            if filters and 'label' in filters and not match_labels(network.attrs['Labels'], filters['label']):
+                continue
+
+            res.append(network)
+
+        return res
+
+    def prepare_model(self, attrs):
+        return FakeNetwork(self.client, attrs)
+
+
+# ============================================================================
+class FakeVolumes(object):
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, name, labels=None, **kwargs):
+        self.client.count('volumes.create')
+        self.client.latency.call('volumes.create')
+        self.client._volumes[name] = dict(labels or {})
+
+    def list(self, filters=None):
+        self.client.count('volumes.list')
+        return [name for name, labels in self.client._volumes.items()
+                if not filters or match_labels(labels, filters.get('label', []))]
+
+    def prune(self, filters=None):
+        self.client.count('volumes.prune')
+        self.client.latency.call('volumes.prune')
+
+        removed = self.list(filters)
+        for name in removed:
+            del self.client._volumes[name]
+
+        return {'VolumesDeleted': removed, 'SpaceReclaimed': 0}
+
+
+# ============================================================================
+class FakeImages(object):
+    def __init__(self, client):
+        self.client = client
+
+    def find(self, name):
+        if ':' not in name and not name.startswith('sha256:'):
+            name += ':latest'
+
+        for image in self.client._images.values():
+            if image.id == name or name in image.tags:
+                return image
+
+        raise ImageNotFound('No such image: ' + name)
+
+    def get(self, name):
+        self.client.count('images.get')
+        self.client.latency.call('images.get')
+        return self.find(name)
+
+    def list(self, name=None, filters=None, all=False):
+        self.client.count('images.list')
+        self.client.latency.call('images.list')
+
+        res = []
+        for image in self.client._images.values():
+            if filters and 'label' in filters and not match_labels(image.labels, filters['label']):
+                continue
+
+            res.append(image)
+
+        return res
+
+    def pull(self, repository, tag=None, **kwargs):
+        self.client.count('images.pull')
+        self.client.latency.call('images.pull')
+        return self.client.add_image(repository + ':' + (tag or 'latest'))
+
+    def remove(self, image, force=False, **kwargs):
+        self.client.count('images.remove')
+        self.client.latency.call('images.remove')
+        del self.client._images[self.find(image).id]
+
+
+# ============================================================================
+class FakeDockerClient(object):
+    """ In-memory stand-in for docker.DockerClient, implementing the subset used
+    by shepherd, with configurable latency and errors for each call, see Latency
+    """
+    def __init__(self, latency=None, errors=None, seed=None):
+        self.latency = Latency(latency, errors, seed)
+
+        self.calls = {}
+
+        self._containers = {}
+        self._networks = {}
+        self._volumes = {}
+        self._images = {}
+
+        self._ips = itertools.count(2)
+        self._ports = itertools.count(30000)
+
+        self.api = FakeAPI(self)
+        self.containers = FakeContainers(self)
+        self.networks = FakeNetworks(self)
+        self.volumes = FakeVolumes(self)
+        self.images = FakeImages(self)
+
+        self.add_network('bridge')
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def next_ip(self):
+        value = next(self._ips)
+        return '10.{0}.{1}.{2}'.format(value // 62500 % 250, value // 250 % 250, value % 250 + 2)
+
+    def next_port(self):
+        return next(self._ports)
+
+    def find_container(self, container_id):
+        container = self._containers.get(container_id)
+        if container:
+            return container
+
+        for container in self._containers.values():
+            if container.name == container_id or container.id.startswith(container_id):
+                return container
+
+        return None
+
+    def get_container(self, container_id):
+        container = self.find_container(container_id)
+        if not container:
+            raise NotFound('No such container: ' + container_id)
+
+        return container
+
+    def get_network(self, network_id):
+        network = self._networks.get(network_id)
+        if network:
+            return network
+
+        for network in self._networks.values():
+            if network.name == network_id or network.id.startswith(network_id or '-'):
+                return network
+
+        raise NotFound('No such network: ' + str(network_id))
+
+    def add_network(self, name, labels=None):
+        network = FakeNetwork(self, {'Id': new_id(),
+                                     'Name': name,
+                                     'Labels': dict(labels or {}),
+                                     'Containers': {}})
+
+        self._networks[network.id] = network
+        self.api.emit('network', 'create', network.id,
+                      dict(network.attrs['Labels'], name=name, type='bridge'))
+        return network
+
+    def add_image(self, tag, labels=None, layers=None, size=1000000):
+        if ':' not in tag:
+            tag += ':latest'
+
+        image = FakeImage(self, {'Id': 'sha256:' + new_id(),
+                                 'RepoTags': [tag],
+                                 'Config': {'Labels': dict(labels or {})},
+                                 'RootFS': {'Layers': list(layers or ['sha256:' + new_id()])},
+                                 'Size': size})
+
+        self._images[image.id] = image
+        return image
+
+    def df(self):
+        self.count('df')
+        return {'LayersSize': sum(image.attrs['Size'] for image in self._images.values()),
+                'Images': [{'Id': image.id,
+                            'Size': image.attrs['Size'],
+                            'RepoTags': image.tags,
+                            'Containers': 0} for image in self._images.values()]}
+
+    def reset_calls(self):
+        self.calls = {}
@@ -0,0 +1,339 @@
+from gevent.monkey import patch_all; patch_all()
+
+import argparse
+import json
+import os
+import re
+import socket
+
+from gevent.pywsgi import WSGIServer
+from werkzeug.wrappers import Request, Response
+
+from docker.errors import NotFound, APIError
+
+from benchmarks.fake_docker import FakeDockerClient
+from benchmarks.utils import BENCH_IMAGES
+
+
+# ============================================================================
+class FakeEngineServer(object):
+    """ WSGI app implementing the subset of the Docker Engine API used by shepherd,
+    backed by an in-memory FakeDockerClient.
+
+    Latency and errors are configured per call, with the same names as FakeDockerClient:
+    create_container, start, kill, stop, remove_container, rename, inspect_container,
+    containers.list, networks.create, inspect_network, networks.list,
+    connect_container_to_network, disconnect_container_from_network, remove_network,
+    volumes.create, volumes.prune, images.get, images.list, images.pull, images.remove,
+    history and events
+    """
+    API_VERSION = '1.41'
+
+    PREFIX = re.compile(r'^/v[\d.]+')
+
+    def __init__(self, latency=None, errors=None, seed=None, images=None):
+        self.docker = FakeDockerClient(latency=latency, errors=errors, seed=seed)
+
+        for image, labels in (images or {}).items():
+            self.docker.add_image(image, labels=labels)
+
+        self.routes = []
+
+        self.route('GET', r'/_ping', self.ping)
+        self.route('GET', r'/version', self.version)
+        self.route('GET', r'/info', self.info)
+        self.route('GET', r'/system/df', self.system_df)
+        self.route('GET', r'/events', self.events)
+        self.route('GET', r'/_fake/calls', self.get_calls)
+
+        self.route('POST', r'/containers/create', self.create_container)
+        self.route('GET', r'/containers/json', self.list_containers)
+        self.route('GET', r'/containers/(?P<id>[^/]+)/json', self.inspect_container)
+        self.route('POST', r'/containers/(?P<id>[^/]+)/start', self.start_container)
+        self.route('POST', r'/containers/(?P<id>[^/]+)/kill', self.kill_container)
+        self.route('POST', r'/containers/(?P<id>[^/]+)/stop', self.stop_container)
+        self.route('POST', r'/containers/(?P<id>[^/]+)/rename', self.rename_container)
+        self.route('DELETE', r'/containers/(?P<id>[^/]+)', self.remove_container)
+
+        self.route('POST', r'/networks/create', self.create_network)
+        self.route('GET', r'/networks', self.list_networks)
+        self.route('GET', r'/networks/(?P<id>[^/]+)', self.inspect_network)
+        self.route('POST', r'/networks/(?P<id>[^/]+)/connect', self.connect_network)
+        self.route('POST', r'/networks/(?P<id>[^/]+)/disconnect', self.disconnect_network)
+        self.route('DELETE', r'/networks/(?P<id>[^/]+)', self.remove_network)
+
+        self.route('POST', r'/volumes/create', self.create_volume)
+        self.route('GET', r'/volumes', self.list_volumes)
+        self.route('POST', r'/volumes/prune', self.prune_volumes)
+
+        self.route('GET', r'/images/json', self.list_images)
+        self.route('POST', r'/images/create', self.pull_image)
+        self.route('GET', r'/images/(?P<id>.+)/json', self.inspect_image)
+        self.route('GET', r'/images/(?P<id>.+)/history', self.image_history)
+        self.route('DELETE', r'/images/(?P<id>.+)', self.remove_image)
+
+    def route(self, method, path, func):
+        self.routes.append((method, re.compile('^' + path + '$'), func))
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        path = self.PREFIX.sub('', request.path)
+
+        for method, regex, func in self.routes:
+            if method != request.method:
+                continue
+
+            m = regex.match(path)
+            if not m:
+                continue
+
+            try:
+                response = func(request, **m.groupdict())
+            except NotFound as nf:
+                response = self.error(404, str(nf))
+            except APIError as ae:
+                response = self.error(409 if str(ae).startswith('Conflict') else 500, str(ae))
+
+            return response(environ, start_response)
+
+        return self.error(404, 'page not found')(environ, start_response)
+
+    def json(self, data, status=200):
+        return Response(json.dumps(data), status=status, mimetype='application/json')
+
+    def error(self, status, message):
+        return self.json({'message': message}, status)
+
+    def get_filters(self, request):
+        filters = request.args.get('filters')
+        return json.loads(filters) if filters else {}
+
+    def flag(self, request, name):
+        return request.args.get(name, '').lower() in ('1', 'true')
+
+    # System
+    def ping(self, request):
+        return Response('OK', mimetype='text/plain')
+
+    def version(self, request):
+        return self.json({'ApiVersion': self.API_VERSION,
+                          'MinAPIVersion': '1.12',
+                          'Version': 'fake',
+                          'Os': 'linux',
+                          'Arch': 'amd64'})
+
+    def info(self, request):
+        return self.json({'Containers': len(self.docker._containers),
+                          'Images': len(self.docker._images),
+                          'Name': 'fake-engine'})
+
+    def system_df(self, request):
+        return self.json(self.docker.df())
+
+    def get_calls(self, request):
+        return self.json(self.docker.calls)
+
+    def events(self, request):
+        filters = self.get_filters(request)
+        since = request.args.get('since')
+
+        # check for injected latency or errors before streaming
+        self.docker.latency.call('events')
+
+        def stream():
+            for event in self.docker.api.events(filters=filters, since=since):
+                yield (json.dumps(event) + '\n').encode('utf-8')
+
+        return Response(stream(), mimetype='application/json')
+
+    # Containers
+    def container_json(self, container):
+        attrs = dict(container.attrs)
+        attrs['Name'] = '/' + container.name
+        attrs['State'] = dict(attrs['State'], Running=container.status == 'running')
+        return attrs
+
+    def create_container(self, request):
+        data = request.get_json(force=True)
+        res = self.docker.api.create_container(data['Image'],
+                                               name=request.args.get('name'),
+                                               labels=data.get('Labels'),
+                                               environment=data.get('Env'),
+                                               networking_config=data.get('NetworkingConfig'),
+                                               host_config=data.get('HostConfig'))
+
+        return self.json(dict(res, Warnings=[]), 201)
+
+    def list_containers(self, request):
+        filters = dict(label=self.get_filters(request).get('label', []))
+        containers = self.docker.containers.list(all=self.flag(request, 'all'),
+                                                 filters=filters if filters['label'] else None)
+
+        return self.json([{'Id': container.id,
+                           'Names': ['/' + container.name],
+                           'Image': container.attrs['Config']['Image'],
+                           'Labels': container.labels,
+                           'State': container.status,
+                           'Status': container.status} for container in containers])
+
+    def inspect_container(self, request, id):
+        self.docker.api.inspect_container(id)
+        return self.json(self.container_json(self.docker.get_container(id)))
+
+    def start_container(self, request, id):
+        self.docker.api.start(id)
+        return Response(status=204)
+
+    def kill_container(self, request, id):
+        self.docker.api.kill(id)
+        return Response(status=204)
+
+    def stop_container(self, request, id):
+        self.docker.api.stop(id, timeout=request.args.get('t'))
+        return Response(status=204)
+
+    def rename_container(self, request, id):
+        self.docker.api.rename(id, request.args['name'])
+        return Response(status=204)
+
+    def remove_container(self, request, id):
+        self.docker.api.remove_container(id, force=self.flag(request, 'force'), v=self.flag(request, 'v'))
+        return Response(status=204)
+
+    # Networks
+    def create_network(self, request):
+        data = request.get_json(force=True)
+        network = self.docker.networks.create(data['Name'], labels=data.get('Labels'))
+        return self.json({'Id': network.id, 'Warning': ''}, 201)
+
+    def list_networks(self, request):
+        filters = self.get_filters(request)
+        networks = self.docker.networks.list(names=filters.get('name'),
+                                             filters={'label': filters['label']} if filters.get('label') else None)
+
+        return self.json([network.attrs for network in networks])
+
+    def inspect_network(self, request, id):
+        return self.json(self.docker.networks.get(id).attrs)
+
+    def connect_network(self, request, id):
+        data = request.get_json(force=True)
+        self.docker.api.connect_container_to_network(data['Container'], id)
+        return Response(status=200)
+
+    def disconnect_network(self, request, id):
+        data = request.get_json(force=True)
+        self.docker.api.disconnect_container_from_network(data['Container'], id,
+                                                          force=data.get('Force', False))
+        return Response(status=200)
+
+    def remove_network(self, request, id):
+        self.docker.api.remove_network(id)
+        return Response(status=204)
+
+    # Volumes
+    def volume_json(self, name):
+        return {'Name': name,
+                'Driver': 'local',
+                'Labels': self.docker._volumes.get(name, {}),
+                'Mountpoint': '/var/lib/docker/volumes/{0}/_data'.format(name)}
+
+    def create_volume(self, request):
+        data = request.get_json(force=True)
+        self.docker.volumes.create(data['Name'], labels=data.get('Labels'))
+        return self.json(self.volume_json(data['Name']), 201)
+
+    def list_volumes(self, request):
+        filters = self.get_filters(request)
+        names = self.docker.volumes.list(filters=filters)
+        return self.json({'Volumes': [self.volume_json(name) for name in names], 'Warnings': []})
+
+    def prune_volumes(self, request):
+        return self.json(self.docker.volumes.prune(filters=self.get_filters(request)))
+
+    # Images
+    def list_images(self, request):
+        filters = self.get_filters(request)
+        images = self.docker.images.list(filters={'label': filters['label']} if filters.get('label') else None)
+
+        return self.json([{'Id': image.id,
+                           'RepoTags': image.tags,
+                           'Labels': image.labels,
+                           'Size': image.attrs['Size']} for image in images])
+
+    def inspect_image(self, request, id):
+        return self.json(self.docker.images.get(id).attrs)
+
+    def image_history(self, request, id):
+        return self.json(self.docker.api.history(id))
+
+    def pull_image(self, request):
+        image = self.docker.images.pull(request.args['fromImage'], tag=request.args.get('tag'))
+        status = {'status': 'Downloaded newer image for ' + image.tags[0]}
+        return Response(json.dumps(status) + '\n', mimetype='application/json')
+
+    def remove_image(self, request, id):
+        image = self.docker.images.find(id)
+        self.docker.images.remove(id, force=self.flag(request, 'force'))
+        return self.json([{'Untagged': tag} for tag in image.tags] + [{'Deleted': image.id}])
+
+
+# ============================================================================
+def make_server(app, socket_path=None, listen=None):
+    if listen:
+        host, _, port = listen.rpartition(':')
+        return WSGIServer((host or '127.0.0.1', int(port)), app, log=None)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1024)
+
+    return WSGIServer(listener, app, log=None)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Fake Docker Engine API server with latency and error injection')
+
+    parser.add_argument('--socket', default='/tmp/fake-docker.sock',
+                        help='unix socket path, use with DOCKER_HOST=unix://<path>')
+
+    parser.add_argument('--listen', default=None,
+                        help='listen on host:port instead of a unix socket')
+
+    parser.add_argument('--latency', default='0',
+                        help='call latency: seconds, a json dict of call name to latency, or a json file')
+
+    parser.add_argument('--errors', default=None,
+                        help='json dict of call name to error rate')
+
+    parser.add_argument('--image', action='append', default=[],
+                        help='image to add, as name or name=label:value,label:value, may be repeated. '
+                             'The benchmark images are always added')
+
+    parser.add_argument('--seed', default=None, type=int)
+
+    args = parser.parse_args(args)
+
+    from benchmarks.bench_pools import load_latency
+
+    images = dict(BENCH_IMAGES)
+    for value in args.image:
+        name, _, labels = value.partition('=')
+        images[name] = dict(label.split(':', 1) for label in labels.split(',') if label)
+
+    app = FakeEngineServer(latency=load_latency(args.latency),
+                           errors=json.loads(args.errors) if args.errors else None,
+                           seed=args.seed,
+                           images=images)
+
+    server = make_server(app, args.socket, args.listen)
+
+    print('Fake Docker Engine listening on ' + (args.listen or 'unix://' + args.socket))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
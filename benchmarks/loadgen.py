@@ -0,0 +1,458 @@
+from gevent.monkey import patch_all; patch_all()
+
+import argparse
+import itertools
+import os
+import random
+import resource
+import time
+
+import gevent
+import gevent.pool
+
+from benchmarks.utils import make_shepherd, summarize, get_meta, save_results
+from benchmarks.utils import BENCH_POOLS, BENCH_IMAGE_CONFIG
+
+
+# ============================================================================
+class AppClient(object):
+    """ Calls an in-process app via the flask test client
+    """
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, data=None):
+        res = self.client.post(path, json=data or {})
+        return res.status_code, res.get_json(silent=True) or {}
+
+
+# ============================================================================
+class HTTPClient(object):
+    """ Calls a running shepherd over http
+    """
+    def __init__(self, url, timeout=60):
+        import requests
+
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def post(self, path, data=None):
+        try:
+            res = self.session.post(self.url + path, json=data or {}, timeout=self.timeout)
+        except Exception:
+            return 0, {}
+
+        try:
+            return res.status_code, res.json()
+        except ValueError:
+            return res.status_code, {}
+
+
+# ============================================================================
+class Distribution(object):
+    """ Random values given as 'name:params', eg. 'fixed:30', 'exp:60' (mean),
+    'uniform:10,120' or 'lognormal:3.5,0.8' (mu, sigma)
+    """
+    def __init__(self, spec, rng):
+        self.spec = spec
+        self.rng = rng
+
+        name, _, params = spec.partition(':')
+        self.name = name
+        self.params = [float(value) for value in params.split(',') if value]
+
+        if self.name not in ('fixed', 'exp', 'uniform', 'lognormal'):
+            raise ValueError('Unknown distribution: ' + spec)
+
+    def sample(self):
+        if self.name == 'fixed':
+            return self.params[0]
+
+        if self.name == 'exp':
+            return self.rng.expovariate(1.0 / self.params[0])
+
+        if self.name == 'uniform':
+            return self.rng.uniform(self.params[0], self.params[1])
+
+        return self.rng.lognormvariate(self.params[0], self.params[1])
+
+
+# ============================================================================
+def arrival_times(process, rate, count, rng, burst_size=None):
+    """ Offsets in seconds from the start of the run at which each client arrives
+
+    poisson: exponential gaps with mean 1 / rate
+    constant: even gaps of 1 / rate
+    burst: burst_size clients at once, bursts arriving at rate / burst_size per second
+    """
+    offset = 0.0
+    for x in range(0, count):
+        if process == 'poisson':
+            offset += rng.expovariate(rate)
+
+        elif process == 'constant':
+            offset = x / rate
+
+        elif process == 'burst':
+            offset = (x // burst_size) * burst_size / rate
+
+        else:
+            raise ValueError('Unknown arrival process: ' + process)
+
+        yield offset
+
+
+# ============================================================================
+class SimClient(object):
+    """ A browser session: request a flock for an image, poll start until running
+    (within wait_ping_ttl), keep the session, then stop it or walk away
+    """
+    def __init__(self, num, client, image, poll_interval, patience, session_length, walk_away):
+        self.num = num
+        self.client = client
+        self.image = image
+        self.poll_interval = poll_interval
+        self.patience = patience
+        self.session_length = session_length
+        self.walk_away = walk_away
+
+        self.reqid = None
+        self.outcome = None
+        self.arrived = None
+        self.admitted = None
+        self.polls = 0
+        self.max_queue = 0
+        self.responses = []
+
+    def post(self, endpoint, path, data=None):
+        start = time.time()
+        status, res = self.client.post(path, data)
+        self.responses.append((endpoint, status, time.time() - start))
+        return status, res
+
+    def run(self):
+        self.arrived = time.time()
+
+        status, res = self.post('request', '/api/request/' + self.image, {'url': 'http://example.com/'})
+        self.reqid = res.get('reqid')
+        if not self.reqid:
+            self.outcome = 'request_error'
+            return
+
+        while True:
+            status, res = self.post('start', '/api/flock/start/' + self.reqid)
+            self.polls += 1
+
+            if 'queue' in res:
+                self.max_queue = max(self.max_queue, res['queue'] + 1)
+                if self.patience and time.time() - self.arrived >= self.patience:
+                    # stops pinging, left to expire from the queue
+                    self.outcome = 'gave_up'
+                    return
+
+                gevent.sleep(self.poll_interval)
+                continue
+
+            if 'containers' in res:
+                self.admitted = time.time()
+                break
+
+            self.outcome = 'start_error'
+            return
+
+        gevent.sleep(self.session_length)
+
+        if self.walk_away:
+            # left running until the pool duration expires
+            self.outcome = 'walked_away'
+            return
+
+        self.post('stop', '/api/flock/stop/' + self.reqid)
+        self.outcome = 'stopped'
+
+
+# ============================================================================
+class ProcessSampler(object):
+    """ Samples cpu and resident memory of processes from /proc,
+    or of the current process with getrusage if /proc is not available
+    """
+    def __init__(self, pids, interval=1.0):
+        self.pids = pids or [os.getpid()]
+        self.interval = interval
+        self.samples = {pid: [] for pid in self.pids}
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.greenlet = None
+
+    def read(self, pid):
+        try:
+            with open('/proc/{0}/stat'.format(pid), 'rt') as fh:
+                fields = fh.read().rsplit(')', 1)[1].split()
+
+            cpu = (int(fields[11]) + int(fields[12])) / float(self.clock_ticks)
+            rss = int(fields[21]) * resource.getpagesize()
+
+        except (IOError, OSError, IndexError):
+            if pid != os.getpid():
+                return None
+
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu = usage.ru_utime + usage.ru_stime
+            rss = usage.ru_maxrss * 1024
+
+        return time.time(), cpu, rss
+
+    def sample(self):
+        for pid in self.pids:
+            value = self.read(pid)
+            if value:
+                self.samples[pid].append(value)
+
+    def loop(self):
+        while True:
+            self.sample()
+            gevent.sleep(self.interval)
+
+    def start(self):
+        self.sample()
+        self.greenlet = gevent.spawn_later(self.interval, self.loop)
+
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill()
+
+        self.sample()
+
+    def get_results(self):
+        res = {}
+        for pid, samples in self.samples.items():
+            if len(samples) < 2:
+                continue
+
+            cpu_percent = [(b[1] - a[1]) / (b[0] - a[0]) * 100
+                           for a, b in zip(samples, samples[1:]) if b[0] > a[0]]
+
+            res[str(pid)] = {'cpu_seconds': samples[-1][1] - samples[0][1],
+                             'cpu_percent_mean': (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0]) * 100,
+                             'cpu_percent_max': max(cpu_percent) if cpu_percent else 0,
+                             'rss_mb_max': max(sample[2] for sample in samples) / 1048576.0}
+
+        return res
+
+
+# ============================================================================
+def count_inversions(values):
+    """ Number of pairs out of order, by merge sort
+    """
+    if len(values) < 2:
+        return values, 0
+
+    mid = len(values) // 2
+    left, left_count = count_inversions(values[:mid])
+    right, right_count = count_inversions(values[mid:])
+
+    merged = []
+    count = left_count + right_count
+    i = j = 0
+    while i < len(left) and j < len(right):
+        if left[i] <= right[j]:
+            merged.append(left[i])
+            i += 1
+        else:
+            merged.append(right[j])
+            count += len(left) - i
+            j += 1
+
+    merged.extend(left[i:])
+    merged.extend(right[j:])
+    return merged, count
+
+
+def get_fairness(clients):
+    """ Fraction of pairs of queued clients admitted in a different order than they arrived,
+    0 for strict first come, first served
+    """
+    queued = [client for client in clients if client.admitted and client.polls > 1]
+    queued.sort(key=lambda client: client.admitted)
+
+    pairs = len(queued) * (len(queued) - 1) // 2
+    inversions = count_inversions([client.arrived for client in queued])[1]
+
+    return {'queued_admitted': len(queued),
+            'inversions': inversions,
+            'inversion_ratio': inversions / float(pairs) if pairs else 0}
+
+
+# ============================================================================
+def get_results(clients, elapsed):
+    outcomes = {}
+    for client in clients:
+        outcomes[client.outcome or 'unfinished'] = outcomes.get(client.outcome or 'unfinished', 0) + 1
+
+    endpoints = {}
+    for client in clients:
+        for endpoint, status, latency in client.responses:
+            entry = endpoints.setdefault(endpoint, {'latencies': [], 'status': {}})
+            entry['latencies'].append(latency)
+            entry['status'][str(status)] = entry['status'].get(str(status), 0) + 1
+
+    for name, entry in endpoints.items():
+        total = len(entry['latencies'])
+        errors_4xx = sum(count for status, count in entry['status'].items() if status.startswith('4'))
+
+        res = summarize(entry.pop('latencies'), elapsed)
+        res['status'] = entry['status']
+        res['rate_4xx'] = errors_4xx / float(total) if total else 0
+        endpoints[name] = res
+
+    admission = [client.admitted - client.arrived for client in clients if client.admitted]
+
+    return {'clients': len(clients),
+            'elapsed': elapsed,
+            'outcomes': outcomes,
+            'admission_latency': summarize(admission),
+            'max_queue_position': max([client.max_queue for client in clients] or [0]),
+            'polls_per_client': sum(client.polls for client in clients) / float(len(clients) or 1),
+            'fairness': get_fairness(clients),
+            'endpoints': endpoints}
+
+
+def print_results(res):
+    print('\n{clients} clients in {elapsed:.1f}s'.format(**res))
+    print('  outcomes: ' + ', '.join('{0}={1}'.format(name, count) for name, count in sorted(res['outcomes'].items())))
+
+    adm = res['admission_latency']
+    print('  admission: p50 {0:.0f} ms, p90 {1:.0f} ms, p99 {2:.0f} ms, max {3:.0f} ms'.format(adm['p50_ms'], adm['p90_ms'],
+                                                                                          adm['p99_ms'], adm['max_ms']))
+
+    print('  queue: max position {0}, {1:.1f} polls per client, {2:.3f} admitted out of order'.format(res['max_queue_position'],
+                                                                                                   res['polls_per_client'],
+                                                                                                   res['fairness']['inversion_ratio']))
+
+    for name, entry in sorted(res['endpoints'].items()):
+        print('  {0:<8} {1:>7} calls  p50 {2:>8.2f} ms  p99 {3:>8.2f} ms  4xx {4:.1%}'.format(name, entry['count'],
+                                                                                           entry['p50_ms'], entry['p99_ms'],
+                                                                                           entry['rate_4xx']))
+
+    for pid, proc in sorted(res.get('process', {}).items()):
+        print('  pid {0}: cpu {1:.0f}% mean, {2:.0f}% max, rss {3:.0f} MB max'.format(pid, proc['cpu_percent_mean'],
+                                                                                   proc['cpu_percent_max'],
+                                                                                   proc['rss_mb_max']))
+
+
+# ============================================================================
+def make_clients(args):
+    if args.url:
+        return [HTTPClient(url) for url in args.url]
+
+    from shepherd.wsgi import create_app
+    from benchmarks.bench_pools import load_latency
+
+    shepherd = make_shepherd(latency=load_latency(args.latency), seed=args.seed)
+    app = create_app(shepherd, args.pools, BENCH_IMAGE_CONFIG, redis_stats=False)
+
+    pool = app.get_pool()
+    if args.poll_interval >= getattr(pool, 'wait_ping_ttl', float('inf')):
+        print('Warning: poll interval is not less than wait_ping_ttl {0}, queued clients will expire'.format(pool.wait_ping_ttl))
+
+    return [AppClient(app)]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Simulate browser clients requesting, starting and stopping flocks')
+
+    parser.add_argument('--url', action='append',
+                        help='shepherd url, may be repeated to spread clients over workers. '
+                             'If not set, an in-process app is used, with fakeredis and a fake docker client')
+
+    parser.add_argument('--pools', default=BENCH_POOLS,
+                        help='pool config for the in-process app')
+
+    parser.add_argument('--latency', default='0.005',
+                        help='fake docker call latency for the in-process app, see bench_pools')
+
+    parser.add_argument('--clients', default=1000, type=int)
+
+    parser.add_argument('--arrival', default='poisson', choices=['poisson', 'constant', 'burst'])
+
+    parser.add_argument('--rate', default=50.0, type=float,
+                        help='mean client arrivals per second')
+
+    parser.add_argument('--burst-size', default=100, type=int)
+
+    parser.add_argument('--session', default='exp:10',
+                        help='session length distribution, eg. fixed:30, exp:60, uniform:10,120, lognormal:3.5,0.8')
+
+    parser.add_argument('--walk-away', default=0.3, type=float,
+                        help='fraction of clients leaving without stopping their flock')
+
+    parser.add_argument('--patience', default=0, type=float,
+                        help='seconds a queued client waits before giving up, 0 to wait forever')
+
+    parser.add_argument('--poll-interval', default=1.0, type=float,
+                        help='seconds between start polls while queued, must be less than wait_ping_ttl')
+
+    parser.add_argument('--images', default='browser,chrome,firefox',
+                        help='images requested, chosen at random for each client')
+
+    parser.add_argument('--pid', action='append', type=int,
+                        help='pid of a shepherd worker to sample cpu and memory of, may be repeated. '
+                             'Defaults to this process')
+
+    parser.add_argument('--max-concurrency', default=10000, type=int,
+                        help='maximum clients active at once')
+
+    parser.add_argument('--seed', default=1, type=int)
+
+    parser.add_argument('-o', '--output', default=None,
+                        help='save results as json')
+
+    args = parser.parse_args(args)
+
+    rng = random.Random(args.seed)
+    session = Distribution(args.session, rng)
+    images = args.images.split(',')
+
+    http_clients = itertools.cycle(make_clients(args))
+
+    sampler = ProcessSampler(args.pid)
+    sampler.start()
+
+    pool = gevent.pool.Pool(args.max_concurrency)
+    clients = []
+
+    start = time.time()
+    for num, offset in enumerate(arrival_times(args.arrival, args.rate, args.clients, rng, args.burst_size)):
+        delay = start + offset - time.time()
+        if delay > 0:
+            gevent.sleep(delay)
+
+        client = SimClient(num, next(http_clients),
+                           image=rng.choice(images),
+                           poll_interval=args.poll_interval,
+                           patience=args.patience,
+                           session_length=session.sample(),
+                           walk_away=rng.random() < args.walk_away)
+
+        clients.append(client)
+        pool.spawn(client.run)
+
+    pool.join()
+    elapsed = time.time() - start
+
+    sampler.stop()
+
+    res = get_results(clients, elapsed)
+    res['process'] = sampler.get_results()
+
+    print_results(res)
+
+    if args.output:
+        save_results(args.output, {'meta': get_meta(args), 'results': res})
+        print('\nResults saved to ' + args.output)
+
+    return res
+
+
+if __name__ == '__main__':
+    main()
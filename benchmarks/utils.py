@@ -0,0 +1,104 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import fakeredis
+
+from shepherd.shepherd import Shepherd
+from shepherd.redis_stats import RedisStats
+
+from benchmarks.fake_docker import FakeDockerClient
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_FLOCKS = os.path.join(BENCH_DIR, 'flocks.yaml')
+
+BENCH_POOLS = os.path.join(BENCH_DIR, 'pools.yaml')
+
+BENCH_IMAGE_CONFIG = os.path.join(BENCH_DIR, 'images.yaml')
+
+# image -> labels
+BENCH_IMAGES = {'bench/browser': {'bench.name': 'browser', 'bench.browser': '1'},
+                'bench/chrome': {'bench.name': 'chrome', 'bench.browser': '1'},
+                'bench/firefox': {'bench.name': 'firefox', 'bench.browser': '1'},
+                'bench/xserver': {}}
+
+
+# ============================================================================
+def make_shepherd(latency=None, errors=None, seed=None, redis=None, docker_client=None, **kwargs):
+    """ Create a Shepherd using fakeredis (unless redis is given) and a FakeDockerClient
+    (unless docker_client is given), with all redis calls counted in shepherd.redis_stats
+    """
+    if redis is None:
+        redis = fakeredis.FakeStrictRedis(decode_responses=True)
+        redis.flushall()
+
+    if docker_client is None:
+        docker_client = FakeDockerClient(latency=latency, errors=errors, seed=seed)
+        for image, labels in BENCH_IMAGES.items():
+            docker_client.add_image(image, labels=labels)
+
+    redis_stats = RedisStats()
+
+    kwargs.setdefault('untracked_check_time', 0)
+
+    shepherd = Shepherd(redis_stats.wrap(redis), docker_client=docker_client, **kwargs)
+    shepherd.redis_stats = redis_stats
+    shepherd.load_flocks(BENCH_FLOCKS)
+    return shepherd
+
+
+# ============================================================================
+def percentile(values, pct):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(latencies, elapsed=None):
+    """ Summary of a list of latencies in seconds, with ops/s over elapsed
+    """
+    count = len(latencies)
+    res = {'count': count,
+           'p50_ms': percentile(latencies, 50) * 1000,
+           'p90_ms': percentile(latencies, 90) * 1000,
+           'p99_ms': percentile(latencies, 99) * 1000,
+           'max_ms': max(latencies) * 1000 if latencies else 0,
+           'mean_ms': sum(latencies) / count * 1000 if count else 0}
+
+    if elapsed is not None:
+        res['ops_per_sec'] = count / elapsed if elapsed > 0 else 0
+
+    return res
+
+
+# ============================================================================
+def get_meta(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        commit = None
+
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'commit': commit,
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'args': vars(args)}
+
+
+def save_results(filename, results):
+    with open(filename, 'wt') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+
+
+def load_results(filename):
+    with open(filename, 'rt') as fh:
+        return json.load(fh)
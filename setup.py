@@ -36,7 +36,7 @@ setup(
     author='Ilya Kreymer',
     author_email='ikreymer@gmail.com',
     license='Apache 2.0',
-    packages=find_packages(exclude=['test']),
+    packages=find_packages(exclude=['test', 'benchmarks']),
     package_data = {'shepherd': ['static_base/*.*',
                                  'templates/*',
                                  '*.yaml']},
@@ -57,6 +57,7 @@ setup(
         'pytest-cov',
         'pytest-flask',
         'fakeredis<1.0',
+        'lupa',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -2,9 +2,8 @@ from shepherd.schema import FlockIdSchema, FlockRequestOptsSchema, GenericRespon
 from shepherd.schema import LaunchResponseSchema, LaunchContainerSchema, FlockRequestDataSchema
 from shepherd.shepherd import FlockRequest
 
-from flask import Response, request, jsonify
+from flask import Response, request, jsonify, send_file
 import json
-import base64
 
 
 # ============================================================================
@@ -208,41 +207,78 @@ def init_routes(app):
         """
 
         flock_req = FlockRequest(reqid)
-        if not flock_req.load(app.shepherd.redis):
+        cache = app.shepherd.response_cache
+        redis = app.shepherd.redis
+        if not (cache.load(flock_req, redis) if cache else flock_req.load(redis)):
             return {'error': 'invalid_reqid'}
 
         return flock_req.data
 
 
+    @app.route('/api/flock/<reqid>/trace', methods=['GET'])
+    def get_flock_trace(reqid):
+        return jsonify(traces=app.shepherd.traces.get_traces(reqid, app.shepherd.redis))
+
+    @app.route('/api/traces', methods=['GET'])
+    def get_recent_traces():
+        count = int(request.args.get('count', 100))
+        return jsonify(traces=app.shepherd.traces.get_recent(app.shepherd.redis, count))
+
+    @app.route('/api/traces/images', methods=['GET'])
+    def get_image_phases():
+        return jsonify(app.shepherd.traces.get_image_phases(app.shepherd.redis))
+
     @app.route('/api/images/<image_group>', methods=['GET'])
     def get_images(image_group):
         return jsonify(app.imageinfos[image_group].list_images(request.args))
 
+    @app.route('/api/images/<image_group>/layers', methods=['GET'])
+    def get_image_layers(image_group):
+        image_info = app.imageinfos[image_group]
+        image_info.ensure_built()
+        return jsonify(app.shepherd.get_layer_report(image_info.get_image_names()))
+
     @app.route('/api/images/<image_group>/<iid>/<field>', methods=['GET'])
     def get_image_field(image_group, iid, field):
-        images = app.imageinfos[image_group].list_images({'id': iid, 'include_all': True})
-        if not images:
+        image_id, value = app.imageinfos[image_group].get_field(iid, field)
+        if not image_id:
             return jsonify(error='image_not_found')
 
-        value = images.get(iid, {}).get(field)
         if value is None:
             return jsonify(error='field_not_found')
 
-        if not value.startswith('data:'):
-            return Response(value, mimetype='text/plain')
-
-        value = value[5:]
-        parts = value.split(',', 1)
-        if len(parts) == 1:
-            return Response(value, mimetype='text/plain')
-
-        value = parts[1]
-        parts = parts[0].split(';')
-        mimetype = parts[0]
-        if len(parts) == 2 and parts[1] == 'base64':
-            value = base64.b64decode(value)
-
-        return Response(value, mimetype=mimetype)
+        blob = app.blob_cache.get(image_id, field, value)
+
+        # only immutable if requested by content digest, otherwise revalidate via etag
+        if request.args.get('v') == blob.digest:
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'no-cache'
+
+        if blob.digest in request.if_none_match:
+            response = Response(status=304)
+        elif blob.path:
+            response = send_file(blob.path, mimetype=blob.mimetype, conditional=False, etag=False)
+        else:
+            response = Response(blob.data, mimetype=blob.mimetype)
+
+        response.set_etag(blob.digest)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(app.render_metrics(),
+                        mimetype='text/plain; version=0.0.4')
+
+    if app.redis_stats:
+        @app.route('/api/debug/redis-stats', methods=['GET', 'DELETE'])
+        def redis_stats():
+            stats = app.redis_stats.get_stats()
+            if request.method == 'DELETE':
+                app.redis_stats.reset()
+
+            return jsonify(stats)
 
     @app.route('/api', methods=['GET'])
     def print_api():
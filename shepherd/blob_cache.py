@@ -0,0 +1,143 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+
+from collections import namedtuple, OrderedDict
+
+
+Blob = namedtuple('Blob', ['digest', 'mimetype', 'data', 'path', 'size'])
+
+
+# ============================================================================
+class BlobCache(object):
+    """ Cache of decoded image label values (eg. data: url icons),
+    keyed by image id and field. Each blob is addressed by the sha256 of its content,
+    which is also used as the ETag. Blobs larger than spill_size are kept on disk instead
+    of in memory, in a subdirectory of spill_dir for each process, removed on close()
+    """
+    MAX_ENTRIES = 1024
+
+    SPILL_SIZE = 64 * 1024
+
+    def __init__(self, max_entries=None, spill_size=None, spill_dir=None, image_cache=None):
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.spill_size = spill_size or self.SPILL_SIZE
+        self.spill_dir = spill_dir
+
+        # (image id, field) -> Blob
+        self.blobs = OrderedDict()
+
+        if image_cache:
+            image_cache.add_listener(self.handle_image_event)
+
+    @classmethod
+    def decode(cls, value):
+        if not value.startswith('data:'):
+            return value.encode('utf-8'), 'text/plain'
+
+        value = value[5:]
+        parts = value.split(',', 1)
+        if len(parts) == 1:
+            return value.encode('utf-8'), 'text/plain'
+
+        value = parts[1]
+        parts = parts[0].split(';')
+        mimetype = parts[0]
+        if len(parts) == 2 and parts[1] == 'base64':
+            return base64.b64decode(value), mimetype
+
+        return value.encode('utf-8'), mimetype
+
+    def get(self, image_id, field, value):
+        key = (image_id, field)
+
+        blob = self.blobs.get(key)
+        if blob:
+            self.blobs.move_to_end(key)
+            return blob
+
+        data, mimetype = self.decode(value)
+        digest = hashlib.sha256(data).hexdigest()
+
+        path = None
+        if len(data) > self.spill_size:
+            path = self._spill(digest, data)
+            data = None
+
+        blob = Blob(digest=digest,
+                    mimetype=mimetype,
+                    data=data,
+                    path=path,
+                    size=os.path.getsize(path) if path else len(data))
+
+        self.blobs[key] = blob
+
+        while len(self.blobs) > self.max_entries:
+            _, old_blob = self.blobs.popitem(last=False)
+            self._remove_spilled(old_blob)
+
+        return blob
+
+    def get_process_dir(self):
+        if not self.spill_dir:
+            self.spill_dir = tempfile.mkdtemp(prefix='shepherd-blobs-')
+
+        # other workers sharing spill_dir evict their own blobs
+        return os.path.join(self.spill_dir, str(os.getpid()))
+
+    def _spill(self, digest, data):
+        process_dir = self.get_process_dir()
+        os.makedirs(process_dir, exist_ok=True)
+
+        path = os.path.join(process_dir, digest)
+        if os.path.isfile(path):
+            return path
+
+        # write under a temp name, rename is atomic
+        fd, temp_path = tempfile.mkstemp(dir=process_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+
+        os.rename(temp_path, path)
+        return path
+
+    def _remove_spilled(self, blob):
+        if not blob.path:
+            return
+
+        # same content may be shared by other images
+        for other in self.blobs.values():
+            if other.path == blob.path:
+                return
+
+        try:
+            os.remove(blob.path)
+        except OSError:
+            pass
+
+    def invalidate(self, image_id):
+        for key in list(self.blobs.keys()):
+            if key[0] == image_id:
+                self._remove_spilled(self.blobs.pop(key))
+
+    def clear(self):
+        blobs = list(self.blobs.values())
+        self.blobs = OrderedDict()
+        for blob in blobs:
+            self._remove_spilled(blob)
+
+    def close(self):
+        self.blobs = OrderedDict()
+        if self.spill_dir:
+            shutil.rmtree(self.get_process_dir(), ignore_errors=True)
+
+    def handle_image_event(self, event):
+        if event is None:
+            self.clear()
+            return
+
+        image_id = event.get('id') or event['Actor'].get('ID')
+        if image_id and image_id.startswith('sha256:') and event.get('Action') in ('untag', 'delete'):
+            self.invalidate(image_id)
@@ -0,0 +1,208 @@
+import base64
+import hashlib
+import json
+import os
+import time
+import traceback
+
+from collections import OrderedDict, deque, namedtuple
+
+import gevent
+import gevent.event
+
+import logging
+
+logger = logging.getLogger('shepherd.cache')
+
+
+CacheEntry = namedtuple('CacheEntry', ['id', 'slot_id', 'image_id', 'created'])
+
+
+# ============================================================================
+class ContainerCache(object):
+    PRECREATED_LABEL = 'owt.shepherd.precreated'
+
+    CACHE_NAME = 'shepherd-cached-{0}'
+
+    OWNER_KEY = 'cc:{0}'
+
+    DEFAULT_SIZE = 2
+
+    MAX_KEYS = 16
+
+    MAX_AGE = 3600
+
+    FILL_CHECK = 10
+
+    OWNER_TTL = 60
+
+    def __init__(self, shepherd, size=None, max_keys=None, max_age=None, fill_check=None):
+        self.shepherd = shepherd
+        self.docker = shepherd.docker
+        self.redis = shepherd.redis
+
+        self.size = int(size or self.DEFAULT_SIZE)
+        self.max_keys = int(max_keys or self.MAX_KEYS)
+        self.max_age = int(max_age or self.MAX_AGE)
+        self.fill_check = fill_check or self.FILL_CHECK
+
+        # key -> (image, create_kwargs), in least-recently-used order
+        self.templates = OrderedDict()
+
+        # key -> deque of CacheEntry
+        self.entries = {}
+
+        self.owner = base64.b32encode(os.urandom(10)).decode('utf-8')
+        self.owner_key = self.OWNER_KEY.format(self.owner)
+
+        self.changed = gevent.event.Event()
+
+        self.running = True
+
+        gevent.spawn(self.fill_loop)
+
+    def get_key(self, image, spec, labels, host_config):
+        labels = {n: v for n, v in labels.items() if n != self.shepherd.reqid_label}
+        data = json.dumps([image, spec.key, labels, host_config], sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def adopt(self, key, image, create_kwargs, name, network, aliases):
+        # mark key as recently used, and register it to be precreated
+        # if it is not cached yet
+        if key in self.templates:
+            self.templates.move_to_end(key)
+        else:
+            self.templates[key] = (image, create_kwargs)
+            self._evict_keys()
+
+        self.changed.set()
+
+        entries = self.entries.get(key)
+
+        while entries:
+            entry = entries.popleft()
+            if time.time() - entry.created > self.max_age:
+                self._remove_entry(entry)
+                continue
+
+            try:
+                container = self.docker.containers.prepare_model({'Id': entry.id})
+                container.rename(name)
+
+                network.connect(container, aliases=aliases)
+                self.docker.api.disconnect_container_from_network(container.id, 'bridge')
+
+                logger.debug('Adopted Precreated Container: ' + name)
+                return container, entry.slot_id
+
+            except Exception as e:
+                logger.warning('Invalid Precreated Container: ' + str(e))
+                self._remove_entry(entry)
+
+        return None, None
+
+    def _evict_keys(self):
+        while len(self.templates) > self.max_keys:
+            key, _ = self.templates.popitem(last=False)
+            for entry in self.entries.pop(key, []):
+                self._remove_entry(entry)
+
+    def _remove_entry(self, entry):
+        try:
+            self.docker.api.remove_container(entry.id, force=True)
+        except Exception as e:
+            logger.debug('Error removing precreated container: ' + str(e))
+
+    def precreate(self, key):
+        image, create_kwargs = self.templates[key]
+
+        image_id = self.shepherd.image_cache.get_id(image)
+        if not image_id:
+            raise Exception('Image not found: ' + image)
+
+        slot_id = base64.b32encode(os.urandom(15)).decode('utf-8')
+
+        kwargs = dict(create_kwargs)
+        labels = dict(kwargs.pop('labels', None) or {})
+        labels[self.shepherd.reqid_label] = slot_id
+        labels[self.PRECREATED_LABEL] = self.owner
+
+        cdata = self.docker.api.create_container(image,
+                                                 name=self.CACHE_NAME.format(slot_id.lower()),
+                                                 labels=labels,
+                                                 **kwargs)
+
+        entry = CacheEntry(cdata['Id'], slot_id, image_id, time.time())
+        self.entries.setdefault(key, deque()).append(entry)
+
+    def fill(self, key):
+        try:
+            while self.running and key in self.templates and len(self.entries.get(key, ())) < self.size:
+                self.precreate(key)
+
+        except Exception as e:
+            logger.warning('Error precreating container: ' + str(e))
+
+    def remove_stale(self):
+        now = time.time()
+
+        for key, (image, _) in list(self.templates.items()):
+            entries = self.entries.get(key)
+            if not entries:
+                continue
+
+            image_id = self.shepherd.image_cache.get_id(image)
+
+            for entry in list(entries):
+                # remove if image retagged or removed, or entry too old
+                if entry.image_id != image_id or now - entry.created > self.max_age:
+                    entries.remove(entry)
+                    self._remove_entry(entry)
+
+    def remove_orphaned(self):
+        # remove precreated containers left by processes no longer running
+        filters = {'label': self.PRECREATED_LABEL, 'status': 'created'}
+        for container in self.docker.containers.list(all=True, filters=filters,
+                                                     ignore_removed=True):
+            owner = container.labels.get(self.PRECREATED_LABEL)
+            if owner == self.owner or self.redis.exists(self.OWNER_KEY.format(owner)):
+                continue
+
+            try:
+                container.remove(force=True)
+            except Exception as e:
+                logger.debug('Error removing orphaned container: ' + str(e))
+
+    def fill_loop(self):
+        logger.info('Container Cache Loop Started')
+
+        last_orphan_check = 0
+
+        while self.running:
+            try:
+                self.redis.set(self.owner_key, '1', ex=max(self.OWNER_TTL, int(self.fill_check * 3)))
+
+                if time.time() - last_orphan_check > self.max_age:
+                    self.remove_orphaned()
+                    last_orphan_check = time.time()
+
+                self.remove_stale()
+
+                for key in reversed(list(self.templates.keys())):
+                    self.fill(key)
+
+            except Exception:
+                traceback.print_exc()
+
+            self.changed.wait(self.fill_check)
+            self.changed.clear()
+
+    def shutdown(self):
+        self.running = False
+
+        for entries in self.entries.values():
+            for entry in entries:
+                self._remove_entry(entry)
+
+        self.entries = {}
+        self.redis.delete(self.owner_key)
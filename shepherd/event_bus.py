@@ -0,0 +1,277 @@
+import os
+import socket
+import time
+import traceback
+
+import gevent
+import gevent.queue
+
+import logging
+
+logger = logging.getLogger('shepherd.events')
+
+
+# ============================================================================
+class Subscriber(object):
+    def __init__(self, callback, pool=None, type_=None, actions=None, queue_size=None):
+        self.callback = callback
+        self.pool = pool
+        self.type = type_
+        self.actions = actions
+
+        self.queue = gevent.queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+        # events dropped since the last resync
+        self.needs_resync = False
+
+        self.running = True
+        self.greenlet = gevent.spawn(self.run)
+
+    def put(self, event):
+        if self.actions and event and event.get('Action') not in self.actions:
+            return
+
+        # drop oldest event instead of blocking the bus on a slow handler,
+        # the handler is then sent None to resync before the next event
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except gevent.queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    self.needs_resync = True
+                    logger.warning('Event Queue Full, Dropped Event for: {0}'.format(self.pool or self.type))
+                except gevent.queue.Empty:
+                    pass
+
+    def run(self):
+        while self.running:
+            event = self.queue.get()
+            if not self.running:
+                break
+
+            if self.needs_resync or event is None:
+                self.needs_resync = False
+                self.handle(None)
+
+            if event is not None:
+                self.handle(event)
+
+    def handle(self, event):
+        try:
+            self.callback(event)
+        except Exception:
+            traceback.print_exc()
+
+    def stop(self):
+        self.running = False
+        self.greenlet.kill(block=False)
+
+
+# ============================================================================
+class EventBus(object):
+    """ Single Docker events connection for the process, dispatching
+    container events to pools by pool label, and other events by type.
+    The time of the last event is stored in redis, and the stream is resumed
+    from it after a reconnect, or a restart after an unclean exit.
+    Each process has its own cursor, keyed by cursor_id (default hostname:pid)
+    """
+    POOL_NAME_LABEL = 'owt.shepherd.pool'
+
+    CURSOR_KEY = 'shep:ev:since:{0}'
+
+    CONTAINER_EVENTS = ['create', 'start', 'die', 'destroy', 'rename']
+
+    NETWORK_EVENTS = ['create', 'destroy']
+
+    IMAGE_EVENTS = ['pull', 'tag', 'untag', 'delete', 'import', 'load']
+
+    QUEUE_SIZE = 1000
+
+    RECONNECT_WAIT = 1.0
+
+    CURSOR_SAVE_INTERVAL = 1.0
+
+    MAX_REPLAY = 3600
+
+    def __init__(self, docker_client, redis, cursor_key=None, cursor_id=None,
+                 queue_size=None, max_replay=None):
+        self.docker = docker_client
+        self.redis = redis
+
+        if not cursor_key:
+            cursor_id = cursor_id or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+            cursor_key = self.CURSOR_KEY.format(cursor_id)
+
+        self.cursor_key = cursor_key
+        self.queue_size = queue_size or self.QUEUE_SIZE
+        self.max_replay = max_replay or self.MAX_REPLAY
+
+        # pool name -> list of Subscriber
+        self.pool_subs = {}
+
+        # event type -> list of Subscriber
+        self.type_subs = {}
+
+        # last event timeNano, and keys of events seen at that time
+        self.cursor = None
+        self.cursor_events = set()
+        self.last_save = 0
+
+        self.connected = False
+
+        self.running = False
+        self.greenlet = None
+
+    def subscribe(self, callback, pool=None, type_=None, actions=None):
+        sub = Subscriber(callback, pool=pool, type_=type_, actions=actions,
+                         queue_size=self.queue_size)
+
+        if pool:
+            self.pool_subs.setdefault(pool, []).append(sub)
+        else:
+            self.type_subs.setdefault(type_, []).append(sub)
+
+        self.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = self.pool_subs.get(sub.pool) if sub.pool else self.type_subs.get(sub.type)
+        if subs and sub in subs:
+            subs.remove(sub)
+
+        sub.stop()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.greenlet = gevent.spawn(self.event_loop)
+
+    def get_filters(self):
+        events = set(self.CONTAINER_EVENTS + self.NETWORK_EVENTS + self.IMAGE_EVENTS)
+        return {'type': ['container', 'network', 'image'],
+                'event': sorted(events)}
+
+    def load_cursor(self):
+        if self.cursor:
+            return self.cursor
+
+        cursor = self.redis.get(self.cursor_key)
+        if not cursor:
+            return None
+
+        # too old to replay, start from now
+        if time.time() - int(cursor) / 1e9 > self.max_replay:
+            return None
+
+        self.cursor = int(cursor)
+        return self.cursor
+
+    def get_since(self):
+        cursor = self.load_cursor()
+        if not cursor:
+            return None
+
+        return '{0}.{1:09d}'.format(cursor // 1000000000, cursor % 1000000000)
+
+    def save_cursor(self, force=False):
+        if not self.cursor:
+            return
+
+        if force or time.time() - self.last_save >= self.CURSOR_SAVE_INTERVAL:
+            # not resumed past max_replay, so no need to keep it longer
+            self.redis.set(self.cursor_key, self.cursor, ex=self.max_replay)
+            self.last_save = time.time()
+
+    def is_seen(self, event):
+        time_nano = event.get('timeNano')
+        if not time_nano:
+            return False
+
+        key = (event.get('id'), event.get('Action'))
+
+        if self.cursor:
+            if time_nano < self.cursor:
+                return True
+
+            if time_nano == self.cursor and key in self.cursor_events:
+                return True
+
+        if time_nano != self.cursor:
+            self.cursor = time_nano
+            self.cursor_events = set()
+
+        self.cursor_events.add(key)
+        return False
+
+    def dispatch(self, event):
+        if self.is_seen(event):
+            return
+
+        type_ = event.get('Type')
+
+        subs = list(self.type_subs.get(type_, []))
+
+        if type_ == 'container':
+            pool = event['Actor'].get('Attributes', {}).get(self.POOL_NAME_LABEL)
+            if pool:
+                subs.extend(self.pool_subs.get(pool, []))
+
+        for sub in subs:
+            sub.put(event)
+
+        self.save_cursor()
+
+    def notify_resync(self):
+        # all subscribers are sent None to reload all data
+        for subs in list(self.pool_subs.values()) + list(self.type_subs.values()):
+            for sub in subs:
+                sub.put(None)
+
+    def event_loop(self):
+        logger.info('Event Bus Started')
+
+        while self.running:
+            try:
+                since = self.get_since()
+
+                # can't resume, events may have been missed
+                if not since and self.connected:
+                    self.notify_resync()
+
+                self.connected = True
+
+                for event in self.docker.api.events(decode=True,
+                                                    filters=self.get_filters(),
+                                                    since=since):
+                    if not self.running:
+                        break
+
+                    self.dispatch(event)
+
+            except Exception as e:
+                logger.warning('Event Stream Error: ' + str(e))
+
+            self.save_cursor(force=True)
+
+            if self.running:
+                gevent.sleep(self.RECONNECT_WAIT)
+
+    def shutdown(self):
+        self.running = False
+
+        if self.greenlet:
+            self.greenlet.kill(block=False)
+
+        # clean shutdown, nothing to resume
+        self.redis.delete(self.cursor_key)
+
+        for subs in list(self.pool_subs.values()) + list(self.type_subs.values()):
+            for sub in subs:
+                sub.stop()
+
+        self.pool_subs = {}
+        self.type_subs = {}
@@ -1,18 +1,58 @@
 import os
 import base64
 import json
+import zlib
+
+import msgpack
+
+from redis.exceptions import ResponseError
 
 
 # ===========================================================================
 class FlockRequest(object):
+    """ Flock request stored as a redis hash under req:<id>.
+
+    Small, frequently changed fields are stored as their own hash fields
+    and updated in place. All other fields are packed (msgpack, compressed if large)
+    into the 'blob' field, and the launch response into the 'resp' field,
+    which are only unpacked when first accessed through 'data'
+    """
     REQ_KEY = 'req:{0}'
 
+    # reqids of changed or removed requests, for process response caches
+    INVALIDATE_CHANNEL = 'shep:req:inv'
+
+    HOT_FIELDS = ('id', 'flock', 'state', 'net', 'alias')
+
+    JSON_FIELDS = ('container_ids',)
+
+    BLOB = 'blob'
+
+    RESP = 'resp'
+
+    COMPRESS_MIN_SIZE = 512
+
     def __init__(self, reqid=None):
         if not reqid:
             reqid = self._make_reqid()
         self.reqid = reqid
         self.key = self.REQ_KEY.format(self.reqid)
-        self.data = None
+        self._data = None
+
+        # packed fields loaded but not yet unpacked
+        self._packed = None
+
+    @property
+    def data(self):
+        if self._packed:
+            self._unpack_fields()
+
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._packed = None
+        self._data = data
 
     def _make_reqid(self):
         return base64.b32encode(os.urandom(15)).decode('utf-8')
@@ -44,36 +84,188 @@ class FlockRequest(object):
         self.data['environ'].update(environ)
 
         if save:
-            self.save(redis, expire=expire)
+            # response environ is stored relative to the request environ
+            self.save_fields(redis, [self.BLOB, self.RESP], expire=expire)
 
     def get_overrides(self):
         return self.data.get('overrides') or {}
 
     def get_state(self):
-        return self.data and self.data.get('state', 'new')
+        # hot fields are read without unpacking
+        return self._data and self._data.get('state', 'new')
 
     def set_state(self, state, redis):
-        self.data['state'] = state
-        self.save(redis)
+        self._data['state'] = state
+
+        # like a full save, clears any queue or request ttl,
+        # so that a long launch does not lose the request
+        pi, execute = self._get_pipeline(redis)
+        self.save_fields(pi, ['state'])
+        pi.persist(self.key)
+        if execute:
+            pi.execute()
 
     def set_network(self, network_name):
-        self.data['net'] = network_name
+        self._data['net'] = network_name
 
     def get_network(self):
-        return self.data.get('net')
+        return self._data.get('net')
+
+    def get_alias(self):
+        return self._data.get('alias')
+
+    def get_launch_id(self):
+        # id that containers and volumes were launched with,
+        # differs from reqid if flock was assigned from a warm spare
+        return self.data.get('launch_id', self.reqid)
+
+    def get_label_ids(self):
+        return [self.reqid] + self.data.get('aliases', [])
+
+    def add_container(self, name, container_id):
+        self._data.setdefault('container_ids', {})[name] = container_id
+
+    def get_container_ids(self):
+        return self._data.get('container_ids') or {}
+
+    def add_alias(self, alias_id, redis):
+        aliases = self.data.setdefault('aliases', [])
+        if alias_id not in aliases:
+            aliases.append(alias_id)
+
+        alias_req = FlockRequest(alias_id)
+        alias_req.data = {'id': alias_id, 'alias': self.reqid}
+
+        pi, execute = self._get_pipeline(redis)
+        alias_req.save(pi)
+        alias_req.invalidate(pi)
+        if execute:
+            pi.execute()
+
+    def clear_aliases(self, redis):
+        aliases = self.data.pop('aliases', [])
+        self.data.pop('launch_id', None)
+        if aliases:
+            redis.delete(*[self.REQ_KEY.format(alias_id) for alias_id in aliases])
 
     def load(self, redis):
+        try:
+            fields = redis.hgetall(self.key)
+        except ResponseError:
+            # stored as json by an earlier version
+            return self._migrate(redis)
+
+        self._data = {}
+        self._packed = {}
+
+        for name, value in fields.items():
+            if name in self.JSON_FIELDS:
+                self._data[name] = json.loads(value)
+            elif name in (self.BLOB, self.RESP):
+                self._packed[name] = value
+            else:
+                self._data[name] = value
+
+        return fields != {}
+
+    def _migrate(self, redis):
         data = redis.get(self.key)
         self.data = json.loads(data) if data else {}
-        return self.data != {}
+        if not self.data:
+            return False
+
+        ttl = redis.ttl(self.key)
+        self.save(redis, expire=ttl if ttl and ttl > 0 else None)
+        return True
+
+    def _unpack_fields(self):
+        packed = self._packed
+        self._packed = None
+
+        if self.BLOB in packed:
+            self._data.update(self.unpack(packed[self.BLOB]))
+
+        if self.RESP in packed:
+            resp = self.unpack(packed[self.RESP])
+            self._data[self.RESP] = self._expand_resp(resp, self._data.get('environ'))
+
+    def _get_pipeline(self, redis):
+        # already part of a caller's pipeline
+        if hasattr(redis, 'execute'):
+            return redis, False
+
+        return redis.pipeline(), True
+
+    def _pack_field(self, name):
+        if name == self.BLOB:
+            cold = {n: v for n, v in self.data.items()
+                    if n not in self.HOT_FIELDS and n not in self.JSON_FIELDS and n != self.RESP}
+
+            return self.pack(cold) if cold else None
+
+        if name == self.RESP:
+            value = self.data.get(name)
+            return self.pack(self._compact_resp(value, self.data.get('environ'))) if value else None
+
+        value = self._data.get(name)
+        if value is None:
+            return None
+
+        if name in self.JSON_FIELDS:
+            return json.dumps(value)
+
+        return value
 
     def save(self, redis, expire=None):
-        redis.set(self.key, json.dumps(self.data), ex=expire)
-        if expire is None:
-            redis.persist(self.key)
+        # rewrite all fields, also clears any existing ttl if no expire
+        fields = {}
+        for name in self.HOT_FIELDS + self.JSON_FIELDS + (self.RESP, self.BLOB):
+            value = self._pack_field(name)
+            if value is not None:
+                fields[name] = value
+
+        pi, execute = self._get_pipeline(redis)
+        pi.delete(self.key)
+        if fields:
+            pi.hmset(self.key, fields)
+
+        if expire:
+            pi.expire(self.key, expire)
+
+        if execute:
+            pi.execute()
+
+    def save_fields(self, redis, names, expire=None):
+        # update only the given fields in place
+        update = {}
+        remove = []
+        for name in names:
+            value = self._pack_field(name)
+            if value is not None:
+                update[name] = value
+            else:
+                remove.append(name)
+
+        pi, execute = self._get_pipeline(redis)
+        if remove:
+            pi.hdel(self.key, *remove)
+
+        if update:
+            pi.hmset(self.key, update)
 
-    def load_cached_response(self, redis, required=False):
-        if not self.load(redis):
+        if expire:
+            pi.expire(self.key, expire)
+
+        if execute:
+            pi.execute()
+
+    def invalidate(self, redis, reqids=None):
+        for reqid in reqids or [self.reqid]:
+            redis.publish(self.INVALIDATE_CHANNEL, reqid)
+
+    def load_cached_response(self, redis, required=False, cache=None):
+        loaded = cache.load(self, redis) if cache else self.load(redis)
+        if not loaded:
             return {'error': 'invalid_reqid'}
 
         response = self.get_cached_response()
@@ -86,20 +278,92 @@ class FlockRequest(object):
         return None
 
     def get_cached_response(self):
-        return self.data.get('resp')
+        # no response stored, don't unpack other fields
+        if self._packed is not None and self.RESP not in self._packed:
+            return self._data.get(self.RESP)
+
+        return self.data.get(self.RESP)
 
     def cache_response(self, resp, redis):
         self.data['state'] = 'running'
         self.data['resp'] = resp
-        self.save(redis)
+
+        pi, execute = self._get_pipeline(redis)
+        self.save(pi)
+        self.invalidate(pi)
+        if execute:
+            pi.execute()
 
     def stop(self, redis):
         self.data.pop('resp', '')
         self.data['state'] = 'stopped'
-        self.save(redis)
+
+        pi, execute = self._get_pipeline(redis)
+        self.save_fields(pi, ['state', self.RESP, 'container_ids', self.BLOB])
+        pi.persist(self.key)
+        self.invalidate(pi)
+        if execute:
+            pi.execute()
 
     def delete(self, redis):
-        redis.delete(self.key)
+        reqids = [self.reqid]
+        if self.data:
+            reqids.extend(self.data.get('aliases', []))
+
+        pi, execute = self._get_pipeline(redis)
+        pi.delete(*[self.REQ_KEY.format(reqid) for reqid in reqids])
+        self.invalidate(pi, reqids)
+        if execute:
+            pi.execute()
+
+    def _compact_resp(self, resp, environ):
+        # store each container environ as its difference from the request environ
+        if not environ or not resp.get('containers'):
+            return resp
+
+        containers = {}
+        for name, info in resp['containers'].items():
+            if info.get('environ') is not None:
+                info = dict(info)
+                container_env = info.pop('environ')
+                info['environ_diff'] = {n: v for n, v in container_env.items()
+                                        if n not in environ or environ[n] != v}
+                info['environ_del'] = [n for n in environ if n not in container_env]
+
+            containers[name] = info
+
+        resp = dict(resp)
+        resp['containers'] = containers
+        return resp
+
+    def _expand_resp(self, resp, environ):
+        for info in (resp.get('containers') or {}).values():
+            if 'environ_diff' in info:
+                removed = info.pop('environ_del', [])
+                container_env = {n: v for n, v in (environ or {}).items() if n not in removed}
+                container_env.update(info.pop('environ_diff'))
+                info['environ'] = container_env
+
+        return resp
+
+    @classmethod
+    def pack(cls, value):
+        data = msgpack.packb(value, use_bin_type=True)
+        if len(data) >= cls.COMPRESS_MIN_SIZE:
+            data = b'z' + zlib.compress(data)
+        else:
+            data = b'm' + data
 
+        # stored as text, as the shared redis client decodes responses
+        # and the whole hash is read with a single hgetall
+        return base64.b64encode(data).decode('utf-8')
 
+    @classmethod
+    def unpack(cls, value):
+        data = base64.b64decode(value)
+        if data[:1] == b'z':
+            data = zlib.decompress(data[1:])
+        else:
+            data = data[1:]
 
+        return msgpack.unpackb(data, raw=False)
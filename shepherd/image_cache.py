@@ -0,0 +1,167 @@
+import time
+
+from collections import namedtuple
+from types import MappingProxyType
+
+import docker
+import gevent
+
+import logging
+
+logger = logging.getLogger('shepherd.images')
+
+
+ImageMeta = namedtuple('ImageMeta', ['id', 'tags', 'labels', 'layers', 'size'])
+
+
+# ============================================================================
+class ImageCache(object):
+    """ In-process cache of image metadata (id, tags, labels, RootFS layers),
+    kept current from Docker image events, with a TTL as fallback
+    """
+    DEFAULT_TTL = 300
+
+    NOT_FOUND_TTL = 10
+
+    RECONNECT_WAIT = 1.0
+
+    def __init__(self, docker_client, ttl=None, not_found_ttl=None, watch_events=True,
+                 event_bus=None):
+        self.docker = docker_client
+
+        self.ttl = ttl or self.DEFAULT_TTL
+        self.not_found_ttl = not_found_ttl or self.NOT_FOUND_TTL
+
+        # name -> (ImageMeta or None, time loaded)
+        self.images = {}
+
+        # image id -> set of names
+        self.names_by_id = {}
+
+        self.listeners = []
+
+        self.running = True
+
+        if event_bus:
+            event_bus.subscribe(self.handle_event, type_='image')
+        elif watch_events:
+            gevent.spawn(self.event_loop)
+
+    @classmethod
+    def full_tag(cls, tag):
+        if tag.startswith('sha256:'):
+            return tag
+
+        return tag + ':latest' if ':' not in tag.rsplit('/', 1)[-1] else tag
+
+    def get(self, name):
+        name = self.full_tag(name)
+
+        entry = self.images.get(name)
+        if entry:
+            meta, loaded = entry
+            ttl = self.ttl if meta else self.not_found_ttl
+            if time.time() - loaded < ttl:
+                return meta
+
+        try:
+            image = self.docker.images.get(name)
+            meta = ImageMeta(id=image.id,
+                             tags=tuple(image.tags),
+                             labels=MappingProxyType(dict(image.labels or {})),
+                             layers=tuple(image.attrs['RootFS'].get('Layers') or ()),
+                             size=image.attrs.get('Size', 0))
+
+        except docker.errors.ImageNotFound:
+            meta = None
+
+        self.images[name] = (meta, time.time())
+
+        if meta:
+            self.names_by_id.setdefault(meta.id, set()).add(name)
+
+        return meta
+
+    def get_id(self, name):
+        meta = self.get(name)
+        return meta.id if meta else None
+
+    def has_label(self, name, label):
+        meta = self.get(name)
+        if not meta:
+            return False
+
+        if '=' in label:
+            name, value = label.split('=', 1)
+            return meta.labels.get(name) == value
+        else:
+            return meta.labels.get(label, '') != ''
+
+    def invalidate(self, name=None, image_id=None):
+        if name:
+            name = self.full_tag(name)
+            entry = self.images.pop(name, None)
+            if entry and entry[0]:
+                self.names_by_id.get(entry[0].id, set()).discard(name)
+
+        if image_id:
+            for name in self.names_by_id.pop(image_id, ()):
+                self.images.pop(name, None)
+
+    def clear(self):
+        self.images = {}
+        self.names_by_id = {}
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def handle_event(self, event):
+        if event is None:
+            self.clear()
+            self._notify(None)
+            return
+
+        image_id = event.get('id') or event['Actor'].get('ID')
+        name = event['Actor'].get('Attributes', {}).get('name')
+
+        if image_id and image_id.startswith('sha256:'):
+            self.invalidate(image_id=image_id)
+        elif image_id:
+            # pull events are reported by name
+            self.invalidate(name=image_id)
+
+        if name and not name.startswith('sha256:'):
+            self.invalidate(name=name)
+
+        self._notify(event)
+
+    def _notify(self, event):
+        # event is None if events may have been missed and
+        # all cached data should be reloaded
+        for callback in self.listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.warning('Image Event Listener Error: ' + str(e))
+
+    def event_loop(self):
+        logger.info('Image Event Loop Started')
+
+        while self.running:
+            try:
+                for event in self.docker.api.events(decode=True,
+                                                    filters={'type': 'image'}):
+                    if not self.running:
+                        break
+
+                    self.handle_event(event)
+
+            except Exception as e:
+                logger.warning('Image Event Stream Error: ' + str(e))
+
+            # events may have been missed while disconnected
+            self.handle_event(None)
+            gevent.sleep(self.RECONNECT_WAIT)
+
+    def shutdown(self):
+        self.running = False
@@ -0,0 +1,254 @@
+import time
+import traceback
+
+import docker
+import gevent
+import gevent.event
+import gevent.pool
+
+import logging
+
+logger = logging.getLogger('shepherd.images')
+
+
+# ============================================================================
+class ImageManager(object):
+    """ Pulls images on demand (one pull per tag at a time), pre-pulls images
+    referenced by loaded flocks and registered sources, and removes the least
+    recently launched images when over the disk budget
+    """
+    LAUNCH_KEY = 'img:l'
+
+    EVICTED_KEY = 'img:ev'
+
+    EVICTED_TTL = 86400
+
+    PREFETCH_INTERVAL = 300
+
+    PULL_CONCURRENCY = 2
+
+    MIN_AGE = 3600
+
+    def __init__(self, shepherd, prefetch_interval=0, disk_budget=0,
+                 pull_concurrency=None, min_age=None, evicted_ttl=None):
+        self.shepherd = shepherd
+        self.docker = shepherd.docker
+        self.redis = shepherd.redis
+        self.image_cache = shepherd.image_cache
+
+        self.prefetch_interval = prefetch_interval
+        self.disk_budget = int(disk_budget or 0)
+        self.pull_concurrency = pull_concurrency or self.PULL_CONCURRENCY
+        self.min_age = self.MIN_AGE if min_age is None else min_age
+        self.evicted_ttl = int(evicted_ttl or self.EVICTED_TTL)
+
+        # tag -> AsyncResult for pull in progress
+        self.pulls = {}
+
+        # callables returning image names to prefetch
+        self.sources = []
+
+        self.running = True
+
+        if prefetch_interval or self.disk_budget:
+            gevent.spawn(self.prefetch_loop)
+
+    @classmethod
+    def split_tag(cls, name):
+        # repo@sha256:<digest>, pulled by digest
+        if '@' in name:
+            repo, digest = name.split('@', 1)
+            if ':' in repo.rsplit('/', 1)[-1]:
+                repo = repo.rsplit(':', 1)[0]
+
+            return repo, digest
+
+        name = cls.full_tag(name)
+        repo, tag = name.rsplit(':', 1)
+        return repo, tag
+
+    @classmethod
+    def full_tag(cls, name):
+        return name + ':latest' if ':' not in name.rsplit('/', 1)[-1] else name
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def pull(self, name):
+        name = self.full_tag(name)
+
+        result = self.pulls.get(name)
+        if result:
+            # already being pulled, wait for same result
+            return result.get()
+
+        result = gevent.event.AsyncResult()
+        self.pulls[name] = result
+
+        try:
+            logger.info('Pulling Image: ' + name)
+            repo, tag = self.split_tag(name)
+            image = self.docker.images.pull(repo, tag=tag)
+
+            self.image_cache.invalidate(name=name)
+            self.record_launch(name, image_time=True)
+
+            result.set(image)
+            return image
+
+        except Exception as e:
+            result.set_exception(e)
+            raise
+
+        finally:
+            self.pulls.pop(name, None)
+
+    def ensure_image(self, name):
+        if self.image_cache.get(name):
+            return False
+
+        self.pull(name)
+        return True
+
+    def record_launch(self, name, image_time=False):
+        name = self.full_tag(name)
+
+        # a pulled image counts as launched, if not already launched
+        if image_time and self.redis.zscore(self.LAUNCH_KEY, name) is not None:
+            return
+
+        pi = self.redis.pipeline(transaction=False)
+        pi.zadd(self.LAUNCH_KEY, time.time(), name)
+        pi.zrem(self.EVICTED_KEY, name)
+        pi.execute()
+
+    def get_evicted(self):
+        # images removed by gc in any process, not prefetched again
+        # until launched, or evicted_ttl has passed
+        return set(self.redis.zrangebyscore(self.EVICTED_KEY, time.time() - self.evicted_ttl, '+inf'))
+
+    def get_prefetch_images(self):
+        names = set()
+        for template in self.shepherd.templates.values():
+            for container in template.containers:
+                names.add(self.full_tag(container.image))
+
+        for source in self.sources:
+            try:
+                names.update(self.full_tag(name) for name in source())
+            except Exception:
+                traceback.print_exc()
+
+        return names - self.get_evicted()
+
+    def prefetch(self):
+        def prefetch_one(name):
+            try:
+                if self.ensure_image(name):
+                    logger.info('Prefetched Image: ' + name)
+            except Exception as e:
+                logger.warning('Image Prefetch Failed: {0}: {1}'.format(name, e))
+
+        pool = gevent.pool.Pool(self.pull_concurrency)
+        for name in self.get_prefetch_images():
+            pool.spawn(prefetch_one, name)
+
+        pool.join()
+
+    def get_protected_images(self):
+        # images of running or stopped containers, and flock defaults
+        protected = set()
+        for container in self.docker.containers.list(all=True, ignore_removed=True):
+            protected.add(container.attrs.get('Image'))
+
+        for template in self.shepherd.templates.values():
+            for container in template.containers:
+                image_id = self.image_cache.get_id(container.image)
+                if image_id:
+                    protected.add(image_id)
+
+        return protected
+
+    def collect(self):
+        if not self.disk_budget:
+            return []
+
+        df = self.docker.df()
+
+        total = df.get('LayersSize') or 0
+        if total <= self.disk_budget:
+            return []
+
+        protected = self.get_protected_images()
+
+        now = time.time()
+
+        candidates = []
+        for image in df.get('Images') or []:
+            if image['Id'] in protected or image.get('Containers', 0) > 0:
+                continue
+
+            tags = image.get('RepoTags') or []
+
+            # only remove images launched or pulled by shepherd
+            scores = [self.redis.zscore(self.LAUNCH_KEY, tag) for tag in tags]
+            scores = [score for score in scores if score is not None]
+            if not scores:
+                continue
+
+            last_launch = max(scores)
+            if now - last_launch < self.min_age:
+                continue
+
+            # layers shared with other images are not freed
+            size = image.get('Size', 0) - max(image.get('SharedSize', 0), 0)
+            candidates.append((last_launch, size, image['Id'], tags))
+
+        removed = []
+
+        for last_launch, size, image_id, tags in sorted(candidates):
+            if total <= self.disk_budget:
+                break
+
+            try:
+                for tag in tags:
+                    self.docker.images.remove(tag)
+                    self.image_cache.invalidate(name=tag)
+                    self.add_evicted(tag)
+
+                total -= size
+                removed.append(image_id)
+                logger.info('Removed Image: {0} ({1})'.format(', '.join(tags), size))
+
+            except docker.errors.APIError as e:
+                logger.warning('Image Removal Failed: {0}: {1}'.format(image_id, e))
+
+        return removed
+
+    def add_evicted(self, tag):
+        now = time.time()
+
+        pi = self.redis.pipeline(transaction=False)
+        pi.zrem(self.LAUNCH_KEY, tag)
+        pi.zadd(self.EVICTED_KEY, now, tag)
+        pi.zremrangebyscore(self.EVICTED_KEY, '-inf', now - self.evicted_ttl)
+        pi.expire(self.EVICTED_KEY, self.evicted_ttl)
+        pi.execute()
+
+    def prefetch_loop(self):
+        logger.info('Image Prefetch Loop Started')
+
+        while self.running:
+            try:
+                self.collect()
+
+                if self.prefetch_interval:
+                    self.prefetch()
+
+            except Exception:
+                traceback.print_exc()
+
+            gevent.sleep(self.prefetch_interval or self.PREFETCH_INTERVAL)
+
+    def shutdown(self):
+        self.running = False
@@ -1,16 +1,35 @@
+import time
 import traceback
 
+import docker
+
 
 class ImageInfo(object):
     CAPS ='caps'
 
-    def __init__(self, docker, label_match, label_prefix, image_prefix='', exclude_labels=None):
+    REBUILD_INTERVAL = 600
+
+    def __init__(self, docker, label_match, label_prefix, image_prefix='', exclude_labels=None,
+                 image_cache=None, rebuild_interval=None):
         self.docker = docker
         self.image_prefix = image_prefix
         self.label_match = label_match
         self.label_prefix = label_prefix
         self.exclude_labels = exclude_labels or []
 
+        self.rebuild_interval = rebuild_interval or self.REBUILD_INTERVAL
+
+        # primary id -> {'image_id', 'labels', 'props', 'all_props'}
+        self.catalog = {}
+
+        # label name -> label value -> set of primary ids
+        self.index = {}
+
+        self.last_build = 0
+
+        if image_cache:
+            image_cache.add_listener(self.handle_image_event)
+
     def _load_info(self, labels, include_all=False):
         props = {}
         caps = []
@@ -58,13 +77,145 @@ class ImageInfo(object):
         else:
             return None
 
-    def list_images(self, params=None):
-        filters = {"dangling": False}
+    def _make_entry(self, image):
+        id_ = self._get_primary_id(image.tags)
+        if not id_:
+            return None, None
+
+        props = self._load_info(image.labels)
+        props['id'] = id_
+
+        all_props = self._load_info(image.labels, include_all=True)
+        all_props['id'] = id_
+
+        labels = {}
+        for n, v in image.labels.items():
+            label_prop = n.split(self.label_prefix)
+            if len(label_prop) == 2:
+                labels[label_prop[1]] = v
+
+        return id_, {'image_id': image.id,
+                     'labels': labels,
+                     'props': props,
+                     'all_props': all_props}
+
+    def _add_entry(self, id_, entry):
+        self._remove_entry(id_)
+
+        self.catalog[id_] = entry
+
+        for name, value in entry['labels'].items():
+            self.index.setdefault(name, {}).setdefault(value, set()).add(id_)
+
+    def _remove_entry(self, id_):
+        entry = self.catalog.pop(id_, None)
+        if not entry:
+            return
+
+        for name, value in entry['labels'].items():
+            ids = self.index.get(name, {}).get(value)
+            if ids is None:
+                continue
+
+            ids.discard(id_)
+            if not ids:
+                del self.index[name][value]
+                if not self.index[name]:
+                    del self.index[name]
+
+    def _match_label(self, labels):
+        if '=' in self.label_match:
+            name, value = self.label_match.split('=', 1)
+            return labels.get(name) == value
+        else:
+            return self.label_match in labels
+
+    def rebuild(self):
+        filters = {'dangling': False, 'label': [self.label_match]}
+
+        images = self.docker.images.list(filters=filters)
+
+        self.catalog = {}
+        self.index = {}
+
+        for image in images:
+            id_, entry = self._make_entry(image)
+            if id_:
+                self._add_entry(id_, entry)
+
+        self.last_build = time.time()
+
+    def ensure_built(self):
+        if time.time() - self.last_build > self.rebuild_interval:
+            try:
+                self.rebuild()
+            except Exception:
+                traceback.print_exc()
+
+    def update_image(self, image_ref):
+        # remove any existing entries for this image
+        if image_ref.startswith('sha256:'):
+            for id_, entry in list(self.catalog.items()):
+                if entry['image_id'] == image_ref:
+                    self._remove_entry(id_)
+
+        try:
+            image = self.docker.images.get(image_ref)
+        except docker.errors.ImageNotFound:
+            return
+
+        for id_, entry in list(self.catalog.items()):
+            if entry['image_id'] == image.id:
+                self._remove_entry(id_)
+
+        if not self._match_label(image.labels or {}):
+            return
+
+        id_, entry = self._make_entry(image)
+        if id_:
+            self._add_entry(id_, entry)
+
+    def handle_image_event(self, event):
+        # events missed, rebuild on next query
+        if event is None:
+            self.last_build = 0
+            return
 
-        label_filters = [self.label_match]
+        # not yet built, nothing to update
+        if not self.last_build:
+            return
+
+        image_ref = event['Actor'].get('Attributes', {}).get('name')
+        if not image_ref or event.get('Action') in ('untag', 'delete'):
+            image_ref = event.get('id') or event['Actor'].get('ID')
+
+        if image_ref:
+            self.update_image(image_ref)
+
+    def get_facets(self, ids, names=None, include_all=False):
+        facets = {}
+
+        for name in (names or self.index.keys()):
+            if not include_all and name in self.exclude_labels:
+                continue
+
+            counts = {}
+            for value, value_ids in self.index.get(name, {}).items():
+                count = len(value_ids & ids)
+                if count:
+                    counts[value] = count
+
+            facets[name] = counts
+
+        return facets
+
+    def list_images(self, params=None):
+        self.ensure_built()
 
         id_ = None
         include_all = False
+        facets = None
+        label_filters = []
 
         if params:
             for k, v in params.items():
@@ -77,23 +228,69 @@ class ImageInfo(object):
                     include_all = bool(v)
                     continue
 
-                label_filters.append(self.label_prefix + k + '=' + v)
+                if k == 'facets':
+                    facets = [name for name in v.split(',') if name] if v not in ('1', 'true') else []
+                    continue
 
-        filters["label"] = label_filters
+                label_filters.append((k, v))
 
-        image_results = {}
+        props_key = 'all_props' if include_all else 'props'
+
+        if id_:
+            entry = self.catalog.get(id_)
+            if entry:
+                return {id_: dict(entry[props_key])}
+
+            # not in catalog, check image directly
+            return self._load_image_by_id(id_, include_all)
+
+        ids = set(self.catalog.keys())
+        for name, value in label_filters:
+            ids &= self.index.get(name, {}).get(value, set())
+
+        image_results = {id_: dict(self.catalog[id_][props_key]) for id_ in ids}
+
+        if facets is not None:
+            return {'images': image_results,
+                    'facets': self.get_facets(ids, facets, include_all)}
+
+        return image_results
+
+    def get_image_names(self):
+        return [self.image_prefix + id_ for id_ in self.catalog.keys()]
+
+    def get_field(self, id_, field):
+        """ Return (image id, label value) for image field,
+        image id is None if the image is not found
+        """
+        self.ensure_built()
+
+        entry = self.catalog.get(id_)
+        if entry:
+            return entry['image_id'], entry['all_props'].get(field)
 
         try:
-            if id_:
-                images = [self.docker.images.get(self.image_prefix + id_)]
-            else:
-                images = self.docker.images.list(filters=filters)
+            image = self.docker.images.get(self.image_prefix + id_)
+        except docker.errors.ImageNotFound:
+            return None, None
+        except Exception:
+            traceback.print_exc()
+            return None, None
 
-            for image in images:
-                id_ = self._get_primary_id(image.tags)
-                if not id_:
-                    continue
+        if self._get_primary_id(image.tags) != id_:
+            return image.id, None
 
+        props = self._load_info(image.labels, include_all=True)
+        return image.id, props.get(field)
+
+    def _load_image_by_id(self, id_, include_all):
+        image_results = {}
+
+        try:
+            image = self.docker.images.get(self.image_prefix + id_)
+
+            id_ = self._get_primary_id(image.tags)
+            if id_:
                 props = self._load_info(image.labels, include_all=include_all)
                 props['id'] = id_
 
@@ -103,5 +300,3 @@ class ImageInfo(object):
             traceback.print_exc()
 
         return image_results
-
-
@@ -0,0 +1,174 @@
+# ============================================================================
+class LayerNode(object):
+    __slots__ = ('layer', 'parent', 'depth', 'children', 'images')
+
+    def __init__(self, layer=None, parent=None):
+        self.layer = layer
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+
+        # layer digest -> LayerNode
+        self.children = {}
+
+        # ids of images whose top layer is this layer
+        self.images = set()
+
+
+# ============================================================================
+class LayerIndex(object):
+    """ Prefix tree of image RootFS layer chains. An image is an ancestor
+    of another if its top layer node is on the other's path to the root
+    """
+    def __init__(self, docker_client, image_cache=None):
+        self.docker = docker_client
+
+        self.root = LayerNode()
+
+        # image id -> LayerNode of top layer
+        self.image_nodes = {}
+
+        # layer digest -> size in bytes, loaded for reports only
+        self.layer_sizes = {}
+
+        if image_cache:
+            image_cache.add_listener(self.handle_image_event)
+
+    def add(self, meta):
+        node = self.image_nodes.get(meta.id)
+        if node:
+            return node
+
+        node = self.root
+        for layer in meta.layers:
+            child = node.children.get(layer)
+            if not child:
+                child = LayerNode(layer, node)
+                node.children[layer] = child
+
+            node = child
+
+        node.images.add(meta.id)
+        self.image_nodes[meta.id] = node
+        return node
+
+    def remove(self, image_id):
+        node = self.image_nodes.pop(image_id, None)
+        if not node:
+            return
+
+        node.images.discard(image_id)
+
+        # prune branches no longer leading to any image
+        while node.parent and not node.images and not node.children:
+            del node.parent.children[node.layer]
+            self.layer_sizes.pop(node.layer, None)
+            node = node.parent
+
+    def clear(self):
+        self.root = LayerNode()
+        self.image_nodes = {}
+
+    def is_ancestor(self, base_meta, meta):
+        base_node = self.add(base_meta)
+        node = self.add(meta)
+
+        if base_node.depth > node.depth:
+            return False
+
+        while node.depth > base_node.depth:
+            node = node.parent
+
+        return node is base_node
+
+    def get_descendants(self, meta):
+        """ ids of all images built on top of this image, including itself
+        """
+        image_ids = set()
+        nodes = [self.add(meta)]
+        while nodes:
+            node = nodes.pop()
+            image_ids.update(node.images)
+            nodes.extend(node.children.values())
+
+        return image_ids
+
+    def load_layer_sizes(self, meta):
+        if all(layer in self.layer_sizes for layer in meta.layers):
+            return
+
+        # history is newest first and also includes steps with no layer
+        history = list(reversed(self.docker.api.history(meta.id)))
+        layers = list(meta.layers)
+
+        sizes = []
+        for i, entry in enumerate(history):
+            if len(sizes) == len(layers):
+                break
+
+            size = entry.get('Size', 0)
+
+            # zero size steps are only layers if all remaining steps must be layers
+            if size > 0 or len(history) - i <= len(layers) - len(sizes):
+                sizes.append(size)
+
+        sizes.extend([0] * (len(layers) - len(sizes)))
+
+        for layer, size in zip(layers, sizes):
+            self.layer_sizes.setdefault(layer, size)
+
+    def get_report(self, images):
+        """ Report shared and unique layer bytes for a dict of name -> ImageMeta
+        """
+        refs = {}
+        unique_images = {meta.id: meta for meta in images.values()}
+        for meta in unique_images.values():
+            self.add(meta)
+            self.load_layer_sizes(meta)
+            for layer in meta.layers:
+                refs[layer] = refs.get(layer, 0) + 1
+
+        names_by_node = {}
+        for name, meta in images.items():
+            names_by_node.setdefault(self.image_nodes[meta.id], []).append(name)
+
+        report = {}
+        for name, meta in images.items():
+            shared = 0
+            unique = 0
+            for layer in meta.layers:
+                size = self.layer_sizes.get(layer, 0)
+                if refs[layer] > 1:
+                    shared += size
+                else:
+                    unique += size
+
+            # closest ancestor in this set of images
+            base = None
+            node = self.image_nodes[meta.id].parent
+            while node and not base:
+                base = names_by_node.get(node, [None])[0]
+                node = node.parent
+
+            report[name] = {'layers': len(meta.layers),
+                            'size': shared + unique,
+                            'shared': shared,
+                            'unique': unique,
+                            'base': base}
+
+        total = sum(self.layer_sizes.get(layer, 0) * count for layer, count in refs.items())
+        stored = sum(self.layer_sizes.get(layer, 0) for layer in refs)
+
+        return {'images': report,
+                'total_size': total,
+                'stored_size': stored,
+                'shared_size': sum(self.layer_sizes.get(layer, 0)
+                                   for layer, count in refs.items() if count > 1)}
+
+    def handle_image_event(self, event):
+        if event is None:
+            self.clear()
+            return
+
+        image_id = event.get('id') or event['Actor'].get('ID')
+        if event.get('Action') == 'delete' and image_id:
+            self.remove(image_id)
@@ -0,0 +1,122 @@
+import time
+
+
+# ============================================================================
+class Histogram(object):
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+# ============================================================================
+class Metrics(object):
+    """ In-process counters and histograms, updated as events happen,
+    and rendered in the Prometheus text format along with any values
+    read at scrape time
+    """
+    DESCRIPTIONS = {
+        'shepherd_pool_admissions_total': ('counter', 'Flocks admitted to run by a pool'),
+        'shepherd_pool_expirations_total': ('counter', 'Flocks stopped by a pool when their duration expired'),
+        'shepherd_pool_running': ('gauge', 'Flocks currently running in a pool'),
+        'shepherd_pool_max_size': ('gauge', 'Maximum running flocks for a pool'),
+        'shepherd_pool_queue_depth': ('gauge', 'Flocks waiting to run in a pool'),
+        'shepherd_start_flock_seconds': ('histogram', 'Time to launch a flock'),
+        'shepherd_start_flock_errors_total': ('counter', 'Flock launches that failed'),
+        'shepherd_queue_wait_seconds': ('histogram', 'Time a flock waited in a pool queue before running'),
+        'shepherd_teardown_seconds': ('histogram', 'Time to remove a flock'),
+        'shepherd_network_pool_hits_total': ('counter', 'Networks reused from a network pool'),
+        'shepherd_network_pool_misses_total': ('counter', 'Networks created when none were available in a network pool'),
+        'shepherd_network_pool_quota_misses_total': ('counter', 'Shared networks not taken as the pool was at its quota'),
+    }
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+
+        # (name, labels) -> Histogram
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if not histogram:
+            histogram = Histogram()
+            self.histograms[key] = histogram
+
+        histogram.observe(value)
+
+    def observe_since(self, name, start, labels=None):
+        self.observe(name, time.time() - start, labels)
+
+    def render(self, collected=None):
+        """ Render all metrics, along with values read at scrape time
+        given as a list of (name, labels, value)
+        """
+        samples = {}
+
+        for (name, labels), value in self.counters.items():
+            samples.setdefault(name, []).append((name, labels, value))
+
+        for name, labels, value in collected or []:
+            samples.setdefault(name, []).append((name, self._key(name, labels)[1], value))
+
+        for (name, labels), histogram in self.histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, total in histogram.cumulative():
+                lines.append((name + '_bucket', labels + (('le', self._format(bound)),), total))
+
+            lines.append((name + '_bucket', labels + (('le', '+Inf'),), histogram.count))
+            lines.append((name + '_sum', labels, histogram.sum))
+            lines.append((name + '_count', labels, histogram.count))
+
+        output = []
+        for name in sorted(samples):
+            type_, desc = self.DESCRIPTIONS.get(name, ('untyped', name))
+            output.append('# HELP {0} {1}'.format(name, desc))
+            output.append('# TYPE {0} {1}'.format(name, type_))
+
+            for sample_name, labels, value in samples[name]:
+                output.append(sample_name + self._format_labels(labels) + ' ' + self._format(value))
+
+        return '\n'.join(output) + '\n'
+
+    def _format_labels(self, labels):
+        if not labels:
+            return ''
+
+        values = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                  for name, value in labels]
+
+        return '{' + ','.join(values) + '}'
+
+    def _format(self, value):
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+
+        return str(value)
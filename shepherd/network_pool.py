@@ -1,7 +1,15 @@
 import base64
+import json
 import os
+import time
 import traceback
 
+import gevent
+import gevent.event
+import gevent.pool
+
+from docker.errors import NotFound
+
 
 # ============================================================================
 class NetworkPool(object):
@@ -58,6 +66,9 @@ class CachedNetworkPool(NetworkPool):
         self.redis = redis
         self.networks_key = self.NETWORKS_LIST_KEY.format(self.pool_name)
 
+        self.hits = 0
+        self.misses = 0
+
     def shutdown(self):
         while True:
             network_name = self.redis.spop(self.networks_key)
@@ -75,8 +86,10 @@ class CachedNetworkPool(NetworkPool):
             name = self.redis.spop(self.networks_key)
             network = self.docker.networks.get(name)
             assert len(network.containers) == 0
+            self.hits += 1
             return network
         except:
+            self.misses += 1
             return super(CachedNetworkPool, self).create_network()
 
     def remove_network(self, network):
@@ -98,3 +111,283 @@ class CachedNetworkPool(NetworkPool):
             return False
 
 
+
+
+# ============================================================================
+class SharedNetworkPool(NetworkPool):
+    """ Node-wide pool of idle networks, created and verified in the background,
+    so that pools can start flocks without waiting on network creation.
+    The idle set and the attrs of each idle network are kept in redis, so a network
+    is handed out without any docker calls. Pools take networks through a
+    QuotaNetworkPool, limiting how many each pool can hold at once.
+    Leases of networks removed, or left with no containers, without a release
+    are reconciled along with the idle networks.
+    """
+    IDLE_KEY = 'nw:idle'
+
+    INFO_KEY = 'nw:i:'
+
+    LEASED_KEY = 'nw:l:{0}'
+
+    FILL_LOCK_KEY = 'nw:fill'
+
+    FILL_CONCURRENCY = 2
+
+    CHECK_INTERVAL = 5
+
+    VERIFY_INTERVAL = 60
+
+    VERIFY_BATCH = 10
+
+    FILL_LOCK_TTL = 60
+
+    LEASE_TIMEOUT = 300
+
+    # atomically check quota of the pool and take an idle network
+    # KEYS: idle set, pool leased set
+    # ARGV: quota
+    TAKE_LUA = """
+local quota = tonumber(ARGV[1])
+if quota > 0 and redis.call('scard', KEYS[2]) >= quota then
+    return {'quota'}
+end
+
+local name = redis.call('spop', KEYS[1])
+if not name then
+    return {'empty'}
+end
+
+redis.call('sadd', KEYS[2], name)
+return {'ok', name}
+"""
+
+    def __init__(self, docker, redis, target=0, name='owt.netpool.shared',
+                 fill_concurrency=None, check_interval=None, verify_interval=None,
+                 lease_timeout=None, **kwargs):
+        super(SharedNetworkPool, self).__init__(docker, name=name, **kwargs)
+        self.redis = redis
+        self.target = int(target)
+
+        self.fill_concurrency = int(fill_concurrency or self.FILL_CONCURRENCY)
+        self.check_interval = float(check_interval or self.CHECK_INTERVAL)
+        self.verify_interval = float(verify_interval or self.VERIFY_INTERVAL)
+        self.lease_timeout = float(lease_timeout or self.LEASE_TIMEOUT)
+
+        # names of pools taking networks in this process, with leases to reconcile
+        self.lease_pools = set()
+
+        self.fill_lock_id = self.new_name()
+
+        self.hits = 0
+        self.misses = 0
+        self.quota_misses = 0
+
+        self.fill_needed = gevent.event.Event()
+
+        self.running = True
+        self.greenlet = gevent.spawn(self.fill_loop)
+
+    def is_shared(self, network):
+        return (network.attrs.get('Labels') or {}).get(self.network_label) == self.pool_name
+
+    def take(self, pool_name, quota=0):
+        res = self.redis.eval(self.TAKE_LUA, 2,
+                              self.IDLE_KEY,
+                              self.LEASED_KEY.format(pool_name),
+                              int(quota or 0))
+
+        if res[0] == 'quota':
+            self.quota_misses += 1
+            return None
+
+        attrs = None
+        if res[0] == 'ok':
+            # no longer idle, so only updated by this lease
+            info_key = self.INFO_KEY + res[1]
+            pi = self.redis.pipeline()
+            pi.hmset(info_key, {'pool': pool_name, 'taken': time.time()})
+            pi.hget(info_key, 'attrs')
+            attrs = pi.execute()[1]
+
+            if not attrs:
+                self.redis.srem(self.LEASED_KEY.format(pool_name), res[1])
+                self.redis.delete(info_key)
+
+        if not attrs:
+            self.misses += 1
+            self.fill_needed.set()
+            return None
+
+        self.hits += 1
+        self.fill_needed.set()
+        return self.docker.networks.prepare_model(json.loads(attrs))
+
+    def release(self, network, pool_name):
+        self.redis.srem(self.LEASED_KEY.format(pool_name), network.name)
+
+        try:
+            self.disconnect_all(network)
+            network.reload()
+
+            if not network.containers and self.redis.scard(self.IDLE_KEY) < self.target:
+                self.add_idle(network)
+                return True
+
+        except Exception:
+            traceback.print_exc()
+
+        return self.remove_shared(network)
+
+    def add_idle(self, network):
+        pi = self.redis.pipeline()
+        pi.delete(self.INFO_KEY + network.name)
+        pi.hmset(self.INFO_KEY + network.name, {'attrs': json.dumps(network.attrs),
+                                                'verified': time.time()})
+        pi.sadd(self.IDLE_KEY, network.name)
+        pi.execute()
+
+    def remove_shared(self, network):
+        self.redis.delete(self.INFO_KEY + network.name)
+        return super(SharedNetworkPool, self).remove_network(network)
+
+    def fill_loop(self):
+        while self.running:
+            try:
+                if self.redis.set(self.FILL_LOCK_KEY, self.fill_lock_id,
+                                  nx=True, ex=self.FILL_LOCK_TTL):
+                    try:
+                        self.verify_idle()
+                        self.verify_leases()
+                        self.fill()
+                    finally:
+                        if self.redis.get(self.FILL_LOCK_KEY) == self.fill_lock_id:
+                            self.redis.delete(self.FILL_LOCK_KEY)
+
+            except Exception:
+                traceback.print_exc()
+
+            self.fill_needed.wait(timeout=self.check_interval)
+            self.fill_needed.clear()
+
+    def fill(self):
+        needed = self.target - self.redis.scard(self.IDLE_KEY)
+        if needed <= 0:
+            return
+
+        fill_pool = gevent.pool.Pool(self.fill_concurrency)
+        for x in range(0, needed):
+            fill_pool.spawn(self._create_idle)
+
+        fill_pool.join()
+
+    def _create_idle(self):
+        try:
+            network = self.create_network()
+            self.add_idle(network)
+        except Exception:
+            traceback.print_exc()
+
+    def verify_idle(self):
+        # recheck idle networks not verified recently, claiming each from
+        # the idle set while checking
+        names = self.redis.srandmember(self.IDLE_KEY, self.VERIFY_BATCH) or []
+        now = time.time()
+
+        for name in names:
+            verified = self.redis.hget(self.INFO_KEY + name, 'verified')
+            if verified and now - float(verified) < self.verify_interval:
+                continue
+
+            if not self.redis.srem(self.IDLE_KEY, name):
+                continue
+
+            try:
+                network = self.docker.networks.get(name)
+            except Exception:
+                self.redis.delete(self.INFO_KEY + name)
+                continue
+
+            if network.containers:
+                self.remove_shared(network)
+            else:
+                self.add_idle(network)
+
+    def verify_leases(self):
+        # recheck leases not taken or seen in use recently, a network
+        # with no containers, even stopped ones, is no longer used by its flock
+        now = time.time()
+
+        for pool_name in list(self.lease_pools):
+            leased_key = self.LEASED_KEY.format(pool_name)
+
+            for name in self.redis.smembers(leased_key):
+                taken, in_use = self.redis.hmget(self.INFO_KEY + name, 'taken', 'in_use')
+                if now - max(float(taken or 0), float(in_use or 0)) < self.lease_timeout:
+                    continue
+
+                try:
+                    network = self.docker.networks.get(name)
+                    in_use = self.docker.containers.list(all=True, filters={'network': name})
+
+                except NotFound:
+                    self.redis.srem(leased_key, name)
+                    self.redis.delete(self.INFO_KEY + name)
+                    continue
+
+                except Exception:
+                    traceback.print_exc()
+                    continue
+
+                if in_use:
+                    self.redis.hset(self.INFO_KEY + name, 'in_use', now)
+                else:
+                    self.release(network, pool_name)
+
+    def clear_leases(self, pool_name):
+        self.lease_pools.discard(pool_name)
+        self.redis.delete(self.LEASED_KEY.format(pool_name))
+
+    def shutdown(self):
+        self.running = False
+        self.fill_needed.set()
+        self.greenlet.kill(block=False)
+
+        while True:
+            name = self.redis.spop(self.IDLE_KEY)
+            if not name:
+                break
+
+            try:
+                self.remove_shared(self.docker.networks.get(name))
+            except Exception:
+                self.redis.delete(self.INFO_KEY + name)
+
+
+# ============================================================================
+class QuotaNetworkPool(NetworkPool):
+    """ Network pool for a single scheduling pool, taking prewarmed networks
+    from the shared pool while under quota, otherwise using its own network pool
+    """
+    def __init__(self, shared, pool_name, quota=0, fallback=None):
+        self.shared = shared
+        self.pool_name = pool_name
+        self.quota = int(quota or 0)
+        self.fallback = fallback
+
+        self.network_label = fallback.network_label
+        self.docker = fallback.docker
+
+        self.shared.lease_pools.add(pool_name)
+
+    def create_network(self):
+        return self.shared.take(self.pool_name, self.quota) or self.fallback.create_network()
+
+    def remove_network(self, network):
+        if self.shared.is_shared(network):
+            return self.shared.release(network, self.pool_name)
+
+        return self.fallback.remove_network(network)
+
+    def shutdown(self):
+        self.shared.clear_leases(self.pool_name)
+        self.fallback.shutdown()
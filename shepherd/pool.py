@@ -1,8 +1,13 @@
+import base64
 import gevent
+import gevent.event
+import gevent.pool
+import os
+import time
 import traceback
 
 from shepherd.flock import FlockRequest
-from shepherd.network_pool import CachedNetworkPool
+from shepherd.network_pool import CachedNetworkPool, QuotaNetworkPool
 
 import logging
 
@@ -20,6 +25,12 @@ class LaunchAllPool(object):
 
     POOL_REQ = 'p:{id}:rq:'
 
+    POOL_DEADLINES = 'p:{id}:dl'
+
+    POOL_SPARES = 'p:{id}:sp'
+
+    POOL_SPARES_LOCK = 'p:{id}:spl'
+
     POOL_NETWORK_TEMPL = 'shepherd-net:%s:{0}'
 
     REQ_TO_POOL = 'reqp:'
@@ -30,8 +41,18 @@ class LaunchAllPool(object):
 
     EXPIRE_CHECK = 30
 
+    EXPIRE_CONCURRENCY = 8
+
+    EXPIRE_BATCH = 100
+
+    SPARES_LOCK_TTL = 60
+
+    # queue times stored by an earlier version, not timestamps
+    MIN_QUEUED_AT = 1000000000
+
     def __init__(self, name, shepherd, redis, duration=None, expire_check=None,
-                 network_pool_size=0, **kwargs):
+                 network_pool_size=0, warm_spares=0, warm_flock=None, warm_opts=None,
+                 expire_concurrency=None, network_quota=0, **kwargs):
         self.name = name
         self.shepherd = shepherd
         self.redis = redis
@@ -46,6 +67,19 @@ class LaunchAllPool(object):
 
         self.req_key = self.POOL_REQ.format(id=self.name)
 
+        self.deadlines_key = self.POOL_DEADLINES.format(id=self.name)
+        self.deadlines_changed = gevent.event.Event()
+        self.expire_pool = gevent.pool.Pool(int(expire_concurrency or self.EXPIRE_CONCURRENCY))
+
+        self.spares_key = self.POOL_SPARES.format(id=self.name)
+        self.spares_lock_key = self.POOL_SPARES_LOCK.format(id=self.name)
+
+        self.warm_spares = int(warm_spares or 0)
+        self.warm_flock = warm_flock
+        self.warm_opts = warm_opts or {}
+        self.spares_lock_id = base64.b32encode(os.urandom(10)).decode('utf-8')
+        self.spares_changed = gevent.event.Event()
+
         self.api = shepherd.docker.api
 
         self.network_pool = None
@@ -57,12 +91,24 @@ class LaunchAllPool(object):
                                                   network_label=shepherd.network_pool.network_label,
                                                   max_size=network_pool_size)
 
+        if shepherd.shared_networks:
+            self.network_pool = QuotaNetworkPool(shepherd.shared_networks, self.name,
+                                                 quota=network_quota,
+                                                 fallback=self.network_pool or shepherd.network_pool)
+
         self.running = True
 
-        gevent.spawn(self.event_loop)
+        self.event_sub = shepherd.event_bus.subscribe(self.handle_event, pool=self.name,
+                                                      actions=('die', 'start'))
 
         gevent.spawn(self.expire_loop)
 
+        if self.warm_spares > 0:
+            if not self.warm_flock:
+                raise Exception('warm_flock required for warm_spares in pool: ' + self.name)
+
+            gevent.spawn(self.spares_loop)
+
     def request(self, flock_name, req_opts):
         res = self.shepherd.request_flock(flock_name, req_opts)
 
@@ -72,13 +118,83 @@ class LaunchAllPool(object):
 
         return res
 
-    def _mark_wait_duration(self, reqid, value=1):
-        self.redis.set(self.req_key + reqid, value, ex=self.duration)
-        self.redis.set(self.REQ_TO_POOL + reqid, self.name)
+    def _mark_wait_duration(self, reqid, value=1, pi=None):
+        pipe = pi or self.redis.pipeline()
+        pipe.set(self.req_key + reqid, value, ex=self.duration)
+        pipe.set(self.REQ_TO_POOL + reqid, self.name)
+        pipe.zadd(self.deadlines_key, time.time() + self.duration, reqid)
+
+        if not pi:
+            self._execute(pipe)
 
-    def _mark_expired(self, reqid):
+    def _mark_expired(self, reqid, pi=None):
         logger.debug('Mark Expired: ' + reqid)
-        self.redis.delete(self.req_key + reqid)
+        pipe = pi or self.redis.pipeline()
+        pipe.delete(self.req_key + reqid)
+        pipe.zadd(self.deadlines_key, 0, reqid)
+
+        if not pi:
+            self._execute(pipe)
+
+    def _mark_running(self, reqid):
+        pi = self.redis.pipeline()
+        pi.sadd(self.flocks_key, reqid)
+        self._mark_wait_duration(reqid, pi=pi)
+
+        # newly added, not a repeated start of a running flock
+        if self._execute(pi)[0]:
+            self._inc_metric('shepherd_pool_admissions_total')
+
+    def _inc_metric(self, name):
+        self.shepherd.metrics.inc(name, {'pool': self.name})
+
+    def _observe_queue_wait(self, queued_at):
+        if queued_at and float(queued_at) > self.MIN_QUEUED_AT:
+            self.shepherd.metrics.observe('shepherd_queue_wait_seconds',
+                                          max(time.time() - float(queued_at), 0),
+                                          {'pool': self.name})
+
+    def get_metrics(self):
+        """ Values read at scrape time, as (name, labels, value)
+        """
+        labels = {'pool': self.name}
+
+        pi = self.redis.pipeline()
+        pi.scard(self.flocks_key)
+        pi.hget(self.pool_key, 'max_size')
+        self._queue_depth(pi)
+        res = pi.execute()
+
+        metrics = [('shepherd_pool_running', labels, res[0])]
+
+        if res[1] is not None:
+            metrics.append(('shepherd_pool_max_size', labels, int(res[1])))
+
+        if len(res) > 2:
+            metrics.append(('shepherd_pool_queue_depth', labels, res[2]))
+
+        network_pool = self.network_pool
+        if isinstance(network_pool, QuotaNetworkPool):
+            network_pool = network_pool.fallback
+
+        if isinstance(network_pool, CachedNetworkPool):
+            metrics.append(('shepherd_network_pool_hits_total', labels, network_pool.hits))
+            metrics.append(('shepherd_network_pool_misses_total', labels, network_pool.misses))
+
+        return metrics
+
+    def _queue_depth(self, pi):
+        pass
+
+    def _set_deadline(self, reqid, deadline):
+        self.redis.zadd(self.deadlines_key, deadline, reqid)
+        self.deadlines_changed.set()
+
+    def _execute(self, pi):
+        # wake expire loop once any new deadline is set
+        res = pi.execute()
+        self.deadlines_changed.set()
+        return res
 
     def start_deferred_container(self, reqid, image_name):
         return self.shepherd.start_deferred_container(reqid=reqid,
@@ -86,16 +202,18 @@ class LaunchAllPool(object):
                                                       labels=self.labels)
 
     def start(self, reqid, **kwargs):
-        res = self.shepherd.start_flock(reqid,
-                                        labels=self.labels,
-                                        network_pool=self.network_pool,
-                                        **kwargs)
-
-        if 'error' not in res:
-            self.add_running(reqid)
+        res = None
+        if self.warm_spares > 0:
+            res = self.assign_spare(reqid, environ=kwargs.get('environ'))
 
-            self._mark_wait_duration(reqid)
+        if not res:
+            res = self.shepherd.start_flock(reqid,
+                                            labels=self.labels,
+                                            network_pool=self.network_pool,
+                                            **kwargs)
 
+        if 'error' not in res:
+            self._mark_running(reqid)
 
         return res
 
@@ -105,18 +223,21 @@ class LaunchAllPool(object):
                                          **kwargs)
 
         if 'error' not in res:
-            self.remove_running(reqid)
+            logger.debug('Stop Running: ' + reqid)
+            pi = self.redis.pipeline()
+            pi.srem(self.flocks_key, reqid)
 
-            self._mark_expired(reqid)
+            self._mark_expired(reqid, pi=pi)
 
             #self.redis.expire(self.REQ_TO_POOL + reqid, self.duration)
-            self.redis.delete(self.REQ_TO_POOL + reqid)
+            pi.delete(self.REQ_TO_POOL + reqid)
+            self._execute(pi)
 
         return res
 
     def stop(self, reqid):
         logger.info('Expired: ' + reqid)
-        return self.remove(reqid)
+        return self.remove(reqid, sync=False)
 
     def add_running(self, reqid):
         return self.redis.sadd(self.flocks_key, reqid)
@@ -135,59 +256,297 @@ class LaunchAllPool(object):
         max_size = self.redis.hget(self.pool_key, 'max_size')
         return int(max_size) - self.curr_size()
 
-    def event_loop(self):
-        filters = {
-                   'label': self.POOL_NAME_LABEL + '=' + self.name,
-                   'event': ['die', 'start'],
-                   'type': 'container'
-                  }
+    def assign_spare(self, reqid, environ=None):
+        flock_req = FlockRequest(reqid)
+        if not flock_req.load(self.redis):
+            return None
+
+        match = self._get_warm_match(flock_req)
+
+        while True:
+            spare_reqid = self.redis.lpop(self.spares_key)
+            if not spare_reqid:
+                return None
+
+            # compare with the spare itself, spares may be from an earlier config
+            spare_req = FlockRequest(spare_reqid)
+            if not spare_req.load(self.redis):
+                self._remove_spare(spare_reqid)
+                continue
 
-        logger.info('Event Loop Started')
+            if self._get_warm_match(spare_req) != match:
+                self.redis.lpush(self.spares_key, spare_reqid)
+                return None
 
-        for event in self.api.events(decode=True,
-                                     filters=filters):
+            self.spares_changed.set()
+
+            res = self.shepherd.assign_flock(spare_reqid, reqid, environ=environ)
+            if 'error' not in res:
+                logger.debug('Assigned Spare {0} to {1}'.format(spare_reqid, reqid))
+                return res
+
+            logger.debug('Invalid Spare {0}: {1}'.format(spare_reqid, res))
+            self._remove_spare(spare_reqid)
+
+    def _get_warm_match(self, flock_req):
+        return (flock_req.data.get('flock'),
+                flock_req.data.get('image_list'),
+                flock_req.data.get('deferred'))
+
+    def add_spare(self):
+        res = self.shepherd.request_flock(self.warm_flock, self.warm_opts)
+        if 'reqid' not in res:
+            logger.error('Error Requesting Spare: ' + str(res))
+            return False
+
+        spare_reqid = res['reqid']
+
+        flock_req = FlockRequest(spare_reqid)
+        flock_req.load(self.redis)
+        flock_req.data['spare'] = True
+        flock_req.save(self.redis, expire=self.shepherd.DEFAULT_REQ_TTL)
+
+        labels = dict(self.labels)
+        labels[self.shepherd.SHEP_SPARE_LABEL] = '1'
+
+        res = self.shepherd.start_flock(spare_reqid,
+                                        labels=labels,
+                                        network_pool=self.network_pool)
+
+        if 'error' in res:
+            logger.error('Error Starting Spare: ' + str(res))
+            return False
+
+        self.redis.rpush(self.spares_key, spare_reqid)
+        logger.debug('Added Spare: ' + spare_reqid)
+        return True
+
+    def _remove_spare(self, spare_reqid):
+        self.redis.lrem(self.spares_key, 1, spare_reqid)
+        self.shepherd.remove_flock(spare_reqid, network_pool=self.network_pool, sync=False)
+        self.spares_changed.set()
+
+    def get_warm_match(self):
+        # match of a spare requested with the current warm config
+        flock = self.shepherd.templates[self.warm_flock]
+        image_list = self.shepherd.resolve_image_list(flock.containers,
+                                                      self.warm_opts.get('overrides') or {})
+
+        return (self.warm_flock, image_list, self.warm_opts.get('deferred'))
+
+    def remove_stale_spares(self):
+        # spares started with an earlier warm config, eg. before a redeploy
+        warm_match = self.get_warm_match()
+
+        for spare_reqid in self.redis.lrange(self.spares_key, 0, -1):
+            spare_req = FlockRequest(spare_reqid)
+            if not spare_req.load(self.redis) or self._get_warm_match(spare_req) == warm_match:
+                continue
+
+            # not removed if already taken by a request
+            if self.redis.lrem(self.spares_key, 1, spare_reqid):
+                logger.debug('Stale Spare: ' + spare_reqid)
+                self.shepherd.remove_flock(spare_reqid, network_pool=self.network_pool, sync=False)
+                self.spares_changed.set()
+
+    def extend_spares_lock(self):
+        # extended before each spare is added, as a fill can outlast the ttl
+        if self.redis.get(self.spares_lock_key) != self.spares_lock_id:
+            return False
+
+        return self.redis.expire(self.spares_lock_key, self.SPARES_LOCK_TTL)
+
+    def spares_loop(self):
+        logger.info('Spares Loop Started')
+        while self.running:
             try:
-                if not self.running:
-                    break
+                if self.redis.set(self.spares_lock_key, self.spares_lock_id,
+                                  nx=True, ex=self.SPARES_LOCK_TTL):
+                    try:
+                        while (self.running and
+                               self.redis.llen(self.spares_key) < self.warm_spares and
+                               self.extend_spares_lock()):
+                            if not self.add_spare():
+                                break
+
+                        self.remove_stale_spares()
+                    finally:
+                        if self.redis.get(self.spares_lock_key) == self.spares_lock_id:
+                            self.redis.delete(self.spares_lock_key)
 
-                attrs = event['Actor']['Attributes']
-                reqid = attrs[self.shepherd.reqid_label]
+            except:
+                traceback.print_exc()
 
-                if event['status'] == 'die':
-                    self.handle_die_event(reqid, event, attrs)
+            self.spares_changed.wait(self.expire_check)
+            self.spares_changed.clear()
 
-                elif event['status'] == 'start':
-                    self.handle_start_event(reqid, event, attrs)
+    def handle_event(self, event):
+        try:
+            if not self.running:
+                return
 
-            except Exception as e:
-                logger.warn(e)
+            # events missed, check for any that died in the meantime
+            if event is None:
+                self.resync()
+                return
+
+            attrs = event['Actor']['Attributes']
+            reqid = attrs[self.shepherd.reqid_label]
+
+            if (attrs.get(self.shepherd.SHEP_SPARE_LABEL) or
+                attrs.get(self.shepherd.SHEP_PRECREATED_LABEL)):
+                flock_req = self.shepherd.resolve_flock_req(reqid)
+                if flock_req:
+                    reqid = flock_req.reqid
+
+                    # spare not yet assigned
+                    if flock_req.data.get('spare'):
+                        if event['status'] == 'die':
+                            self._remove_spare(reqid)
+
+                        return
+
+            if event['status'] == 'die':
+                self.handle_die_event(reqid, event, attrs)
+
+            elif event['status'] == 'start':
+                self.handle_start_event(reqid, event, attrs)
+
+        except Exception as e:
+            logger.warn(e)
+
+    def resync(self):
+        logger.debug('Resync Pool: ' + self.name)
+
+        running = self.redis.smembers(self.flocks_key)
+
+        filters = {'label': self.POOL_NAME_LABEL + '=' + self.name, 'status': 'exited'}
+        for container in self.shepherd.docker.containers.list(all=True, filters=filters,
+                                                               ignore_removed=True):
+            if container.status != 'exited':
+                continue
+
+            labels = container.labels
+            if (labels.get(self.shepherd.reqid_label) not in running and
+                not labels.get(self.shepherd.SHEP_SPARE_LABEL) and
+                not labels.get(self.shepherd.SHEP_PRECREATED_LABEL)):
+                continue
+
+            # handled as the missed die event
+            exit_code = container.attrs['State'].get('ExitCode', '')
+            attrs = dict(labels, exitCode=str(exit_code), name=container.name)
+
+            self.handle_event({'status': 'die', 'Action': 'die', 'id': container.id,
+                               'Actor': {'ID': container.id, 'Attributes': attrs}})
 
     def handle_die_event(self, reqid, event, attrs):
-        self._mark_expired(reqid)
+        if not self.is_stale_event(reqid, event):
+            self._mark_expired(reqid)
+
+    def is_stale_event(self, reqid, event):
+        # event from a container of a flock being removed,
+        # or from the previous run of a restarted flock
+        flock_req = FlockRequest(reqid)
+        if not flock_req.load(self.redis):
+            return False
+
+        if flock_req.get_state() in ('removing', 'stopped'):
+            return True
+
+        container_ids = flock_req.get_container_ids()
+        return bool(container_ids) and event['id'] not in container_ids.values()
 
     def handle_start_event(self, reqid, event, attrs):
         pass
 
     def expire_loop(self):
         logger.info('Expire Loop Started')
+
+        self._init_deadlines()
+
         while self.running:
             try:
-                for reqid in self.redis.smembers(self.flocks_key):
-                    key = self.req_key + reqid
-                    if not self.redis.exists(key):
-                        self.stop(reqid)
+                self.deadlines_changed.clear()
 
-                gevent.sleep(self.expire_check)
+                num_due = self.expire_due()
+
+                # more due than fit in one batch, continue right away
+                if num_due >= self.EXPIRE_BATCH:
+                    continue
+
+                # sleep until earliest deadline, or until a new deadline is set
+                # by this process, and at most expire_check for other processes
+                wait = self.expire_check
+                first = self.redis.zrange(self.deadlines_key, 0, 0, withscores=True)
+                if first:
+                    wait = min(wait, max(first[0][1] - time.time(), 0))
+
+                self.deadlines_changed.wait(wait)
 
             except:
                 traceback.print_exc()
+                gevent.sleep(self.expire_check)
+
+    def expire_due(self):
+        due = self.redis.zrangebyscore(self.deadlines_key, '-inf', time.time(),
+                                       start=0, num=self.EXPIRE_BATCH)
+
+        for reqid in due:
+            # claim, only one process expires each flock
+            if self.redis.zrem(self.deadlines_key, reqid):
+                self.expire_pool.spawn(self._expire, reqid)
+
+        return len(due)
+
+    def _expire(self, reqid):
+        try:
+            if not self.is_running(reqid):
+                return
+
+            # still set, eg. deadline from a clock ahead of redis
+            ttl = self.redis.pttl(self.req_key + reqid)
+            if ttl is not None and ttl > 0:
+                self._set_deadline(reqid, time.time() + ttl / 1000.0)
+                return
+
+            self._inc_metric('shepherd_pool_expirations_total')
+            self.stop(reqid)
+
+        except:
+            traceback.print_exc()
+
+    def _init_deadlines(self):
+        # add deadlines for running flocks started without one
+        for reqid in self.redis.smembers(self.flocks_key):
+            if self.redis.zscore(self.deadlines_key, reqid) is not None:
+                continue
+
+            ttl = self.redis.pttl(self.req_key + reqid)
+            if ttl is not None and ttl > 0:
+                self._set_deadline(reqid, time.time() + ttl / 1000.0)
+            else:
+                # may be reserved and still starting, eg. by another process
+                self._set_deadline(reqid, time.time() + self.duration)
 
     def shutdown(self):
         self.running = False
 
+        self.shepherd.event_bus.unsubscribe(self.event_sub)
+
+        self.deadlines_changed.set()
+
         for reqid in self.redis.smembers(self.flocks_key):
             self.remove(reqid)
 
+        self.redis.delete(self.deadlines_key)
+
+        while self.warm_spares > 0:
+            spare_reqid = self.redis.lpop(self.spares_key)
+            if not spare_reqid:
+                break
+
+            self.shepherd.remove_flock(spare_reqid, network_pool=self.network_pool)
+
         if self.network_pool:
             self.network_pool.shutdown()
 
@@ -198,14 +557,84 @@ class FixedSizePool(LaunchAllPool):
 
     WAIT_PING_TTL = 10
 
-    MAX_REMOVE_SWEEP = 10
-
     NEXT = 'next'
 
     REQID_WAIT = 'p:{id}:r:'
 
     Q_SET = 'p:{id}:q'
 
+    # reqids in queue, scored by time of last ping
+    Q_PING = 'p:{id}:qp'
+
+    # queue_or_reserve() results, otherwise position in queue
+    RESERVED = -1
+
+    RUNNING = -2
+
+    # KEYS: reqid wait key, queue zset, pool info, running set, req key, ping zset
+    # ARGV: reqid, wait ping ttl, current time
+    ENQUEUE_LUA = """
+local reqid = ARGV[1]
+local wait_key = KEYS[1]
+local wait_ping_ttl = tonumber(ARGV[2])
+
+-- wait key holds the time first queued
+local queued_at = redis.call('get', wait_key)
+if not queued_at then
+    local next_number = redis.call('hincrby', KEYS[3], 'next', 1)
+    redis.call('zadd', KEYS[2], next_number, reqid)
+    queued_at = ARGV[3]
+end
+
+redis.call('setex', wait_key, wait_ping_ttl, queued_at)
+redis.call('zadd', KEYS[6], ARGV[3], reqid)
+
+-- also extend time of main req:<id> key
+redis.call('expire', KEYS[5], wait_ping_ttl)
+"""
+
+    RESERVE_LUA = """
+if redis.call('sismember', KEYS[4], ARGV[1]) == 1 then
+    return -2
+end
+""" + ENQUEUE_LUA + """
+local num_avail = tonumber(redis.call('hget', KEYS[3], 'max_size')) - redis.call('scard', KEYS[4])
+local pos = redis.call('zrank', KEYS[2], reqid)
+
+-- wait key still set, but no longer queued, queue again at the end
+if not pos then
+    local next_number = redis.call('hincrby', KEYS[3], 'next', 1)
+    redis.call('zadd', KEYS[2], next_number, reqid)
+    pos = redis.call('zrank', KEYS[2], reqid)
+end
+
+-- remove all waiters that are no longer pinging,
+-- waiters not yet pinged have no ping score and are kept
+if pos >= num_avail and pos > 0 then
+    local min_ping = tonumber(ARGV[3]) - wait_ping_ttl
+    local stale = redis.call('zrangebyscore', KEYS[6], '-inf', '(' .. min_ping)
+    for i, other in ipairs(stale) do
+        redis.call('zrem', KEYS[2], other)
+        redis.call('zrem', KEYS[6], other)
+    end
+
+    if #stale > 0 then
+        pos = redis.call('zrank', KEYS[2], reqid)
+    end
+end
+
+if pos >= num_avail then
+    return pos
+end
+
+-- reserve slot in running set before starting,
+-- wait key is removed once queue time is recorded
+redis.call('zrem', KEYS[2], reqid)
+redis.call('zrem', KEYS[6], reqid)
+redis.call('sadd', KEYS[4], reqid)
+return -1
+"""
+
     def __init__(self, *args, **kwargs):
         super(FixedSizePool, self).__init__(*args, **kwargs)
 
@@ -220,8 +649,36 @@ class FixedSizePool(LaunchAllPool):
 
         self.q_set = self.Q_SET.format(id=self.name)
 
+        self.q_ping = self.Q_PING.format(id=self.name)
+
         self.wait_ping_ttl = int(kwargs.get('wait_ping_ttl', self.WAIT_PING_TTL))
 
+        self._init_ping_times()
+
+        self.enqueue_script = register_script(self.redis, self.ENQUEUE_LUA)
+        self.reserve_script = register_script(self.redis, self.RESERVE_LUA)
+
+    def _init_ping_times(self):
+        # waiters queued by an earlier version have no ping time,
+        # count them as pinged now so that they can still expire
+        queued = self.redis.zrange(self.q_set, 0, -1)
+        if not queued:
+            return
+
+        pi = self.redis.pipeline()
+        for reqid in queued:
+            pi.zscore(self.q_ping, reqid)
+
+        now = time.time()
+        missing = [reqid for reqid, score in zip(queued, pi.execute()) if score is None]
+        if not missing:
+            return
+
+        pi = self.redis.pipeline()
+        for reqid in missing:
+            pi.zadd(self.q_ping, now, reqid)
+        pi.execute()
+
     def request(self, flock_name, req_opts):
         res = super(FixedSizePool, self).request(flock_name, req_opts)
 
@@ -231,19 +688,35 @@ class FixedSizePool(LaunchAllPool):
         return res
 
     def start(self, reqid, environ=None):
-        if self.is_running(reqid):
-            return FlockRequest(reqid).load_cached_response(self.redis, required=True)
+        pos = self.queue_or_reserve(reqid)
+
+        if pos == self.RUNNING:
+            res = FlockRequest(reqid).load_cached_response(self.redis, required=True,
+                                                           cache=self.shepherd.response_cache)
+
+            # slot reserved, but not yet started
+            if res.get('error') == 'not_running':
+                return {'queue': 0}
+
+            return res
 
-        pos = self.get_queue_pos(reqid)
         if pos >= 0:
             if environ:
                 FlockRequest(reqid).update_env(environ, self.redis, save=True, expire=self.wait_ping_ttl)
 
             return {'queue': pos}
 
-        res = super(FixedSizePool, self).start(reqid, environ=environ)
+        self._admitted(reqid)
 
-        self.remove_queued(reqid)
+        try:
+            res = super(FixedSizePool, self).start(reqid, environ=environ)
+        except:
+            self.remove_running(reqid)
+            raise
+
+        # release reserved slot
+        if 'error' in res:
+            self.remove_running(reqid)
 
         return res
 
@@ -251,50 +724,87 @@ class FixedSizePool(LaunchAllPool):
         super(FixedSizePool, self).remove(reqid, **kwargs)
         self.remove_queued(reqid)
 
-    def get_queue_pos(self, reqid):
-        self.ensure_queued(reqid)
-        pos = self.redis.zrank(self.q_set, reqid)
-        num_avail = self.num_avail()
-
-        # limit removal to MAX_REMOVE_SWEEP to limit processing
-        if pos >= num_avail and pos > 1:
-            max_remove = min(self.MAX_REMOVE_SWEEP, pos)
-            reqids = self.redis.zrange(self.q_set, 0, max_remove)
-            qn_keys = self.redis.mget([self.reqid_wait + rq for rq in reqids])
-            rem_keys = [rq for res, rq in zip(qn_keys, reqids)
-                        if not res]
+    def _script_args(self, reqid):
+        keys = [self.reqid_wait + reqid, self.q_set, self.pool_key, self.flocks_key,
+                self.REQ_KEY + reqid, self.q_ping]
 
-            # keys to remove from zset queue
-            if rem_keys:
-                res = self.redis.zrem(self.q_set, *rem_keys)
-                pos = self.redis.zrank(self.q_set, reqid)
+        return keys, [reqid, self.wait_ping_ttl, time.time()]
 
-        if pos < num_avail:
-            return -1
+    def queue_or_reserve(self, reqid):
+        """ Atomically queue or ping reqid, remove any stale waiters ahead of it,
+        and if within the available slots, reserve a slot in the running set
 
-        return pos
+        :returns: queue position, RESERVED, or RUNNING if already running or reserved
+        """
+        keys, args = self._script_args(reqid)
+        return int(self.reserve_script(keys=keys, args=args))
 
     def ensure_queued(self, reqid):
-        if not self.redis.get(self.reqid_wait + reqid):
-            next_number = self.redis.hincrby(self.pool_key, self.NEXT, 1)
-            self.redis.zadd(self.q_set, next_number, reqid)
+        keys, args = self._script_args(reqid)
+        self.enqueue_script(keys=keys, args=args)
 
-        self.redis.set(self.reqid_wait + reqid, '1', ex=self.wait_ping_ttl)
+    def remove_queued(self, reqid):
+        pi = self.redis.pipeline()
+        pi.zrem(self.q_set, reqid)
+        pi.zrem(self.q_ping, reqid)
+        pi.delete(self.reqid_wait + reqid)
+        pi.execute()
 
-        # also extend time of main req:<id> key
-        self.redis.expire(self.REQ_KEY + reqid, self.wait_ping_ttl)
+    def _admitted(self, reqid):
+        pi = self.redis.pipeline()
+        pi.get(self.reqid_wait + reqid)
+        pi.delete(self.reqid_wait + reqid)
+        queued_at = pi.execute()[0]
 
-    def remove_queued(self, reqid):
-        self.redis.zrem(self.q_set, reqid)
-        self.redis.delete(self.reqid_wait + reqid)
+        self._inc_metric('shepherd_pool_admissions_total')
+        self._observe_queue_wait(queued_at)
+
+    def _queue_depth(self, pi):
+        pi.zcard(self.q_set)
 
 
 # ============================================================================
 class PersistentPool(LaunchAllPool):
     TYPE = 'persist'
 
+    # wait queue, reqids scored by order added
+    POOL_WAIT_Z = 'p:{id}:wz'
+
+    # older list wait queue, moved to POOL_WAIT_Z on init
     POOL_WAIT_Q = 'p:{id}:wq'
 
+    # time each reqid was added to the wait queue
+    POOL_WAIT_TIMES = 'p:{id}:wt'
+
+    # KEYS: wait set, wait zset, pool info, wait times
+    # ARGV: reqid, current time
+    PUSH_WAIT_LUA = """
+if redis.call('sadd', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+
+local next_number = redis.call('hincrby', KEYS[3], 'wnext', 1)
+redis.call('zadd', KEYS[2], next_number, ARGV[1])
+redis.call('hset', KEYS[4], ARGV[1], ARGV[2])
+return redis.call('zrank', KEYS[2], ARGV[1]) + 1
+"""
+
+    # KEYS: wait set, wait zset, wait times
+    # returns reqid and time queued
+    POP_WAIT_LUA = """
+local first = redis.call('zrange', KEYS[2], 0, 0)
+if #first == 0 then
+    return false
+end
+
+redis.call('zrem', KEYS[2], first[1])
+redis.call('srem', KEYS[1], first[1])
+
+local queued_at = redis.call('hget', KEYS[3], first[1]) or ''
+redis.call('hdel', KEYS[3], first[1])
+return {first[1], queued_at}
+"""
+
     POOL_WAIT_SET = 'p:{id}:ws'
 
     POOL_ALL_SET = 'p:{id}:a'
@@ -309,10 +819,17 @@ class PersistentPool(LaunchAllPool):
 
         self.redis.hmset(self.pool_key, data)
 
-        self.pool_wait_q = self.POOL_WAIT_Q.format(id=self.name)
+        self.pool_wait_z = self.POOL_WAIT_Z.format(id=self.name)
 
         self.pool_wait_set = self.POOL_WAIT_SET.format(id=self.name)
 
+        self.pool_wait_times = self.POOL_WAIT_TIMES.format(id=self.name)
+
+        self.push_wait_script = register_script(self.redis, self.PUSH_WAIT_LUA)
+        self.pop_wait_script = register_script(self.redis, self.POP_WAIT_LUA)
+
+        self._migrate_wait_list()
+
         self.pool_all_set = self.POOL_ALL_SET.format(id=self.name)
 
         self.grace_time = int(kwargs.get('grace_time', 0))
@@ -321,13 +838,15 @@ class PersistentPool(LaunchAllPool):
         super(PersistentPool, self).handle_die_event(reqid, event, attrs)
 
         # if 'clean exit', then stop entire flock, don't reschedule
-        if attrs['exitCode'] == '0' and attrs.get(self.shepherd.SHEP_DEFERRED_LABEL) != '1':
+        if (attrs['exitCode'] == '0' and attrs.get(self.shepherd.SHEP_DEFERRED_LABEL) != '1' and
+            not self.is_stale_event(reqid, event)):
             logger.debug('Flock Finished Successfully: ' +  reqid)
             self.remove(reqid, stop=True)
 
     def start(self, reqid, environ=None):
         if self.is_running(reqid):
-            return FlockRequest(reqid).load_cached_response(self.redis, required=True)
+            return FlockRequest(reqid).load_cached_response(self.redis, required=True,
+                                                            cache=self.shepherd.response_cache)
 
         elif self.redis.sismember(self.pool_wait_set, reqid):
             return {'queue': self._find_wait_pos(reqid)}
@@ -341,53 +860,57 @@ class PersistentPool(LaunchAllPool):
             pos = self._push_wait(reqid)
             return {'queue': pos - 1}
 
-        res = super(PersistentPool, self).start(reqid, environ=environ)
-
-        self.redis.persist(self.REQ_TO_POOL + reqid)
-
-        return res
+        # REQ_TO_POOL is set without ttl once running
+        return super(PersistentPool, self).start(reqid, environ=environ)
 
     def _is_persist(self, reqid):
         return self.redis.sismember(self.pool_all_set, reqid)
 
     def _add_persist(self, reqid):
         logger.debug('Persist flock: ' + reqid)
-        self.redis.persist(self.REQ_KEY + reqid)
-        return self.redis.sadd(self.pool_all_set, reqid)
-
-    def _remove_persist(self, reqid):
-        logger.debug('Unpersist flock: ' + reqid)
-        return self.redis.srem(self.pool_all_set, reqid)
+        pi = self.redis.pipeline()
+        pi.persist(self.REQ_KEY + reqid)
+        pi.sadd(self.pool_all_set, reqid)
+        return pi.execute()[1]
 
     def _push_wait(self, reqid):
         logger.debug('Adding to Wait Queue: ' + reqid)
-        if self.redis.sadd(self.pool_wait_set, reqid):
-            res = self.redis.rpush(self.pool_wait_q, reqid)
+        res = int(self.push_wait_script(keys=[self.pool_wait_set, self.pool_wait_z, self.pool_key,
+                                              self.pool_wait_times],
+                                        args=[reqid, time.time()]))
+        if res > 0:
             logger.debug('Queued at pos: ' + str(res))
-            return res
         else:
             logger.debug('Already waiting: ' + reqid)
-            return -1
+
+        return res
 
     def _pop_wait(self):
-        reqid = self.redis.lpop(self.pool_wait_q)
-        if reqid:
-            self.redis.srem(self.pool_wait_set, reqid)
+        res = self.pop_wait_script(keys=[self.pool_wait_set, self.pool_wait_z,
+                                         self.pool_wait_times])
+
+        reqid = None
+        if res:
+            reqid = res[0]
+            self._observe_queue_wait(res[1])
 
         logger.debug('Got Next Flock: ' + str(reqid))
         return reqid
 
-    def _remove_wait(self, reqid):
-        self.redis.lrem(self.pool_wait_q, 1, reqid)
-        self.redis.srem(self.pool_wait_set, reqid)
-        logger.debug('Remove from wait queue: ' + reqid)
+    def _queue_depth(self, pi):
+        pi.zcard(self.pool_wait_z)
 
     def _find_wait_pos(self, reqid):
-        pool_list = self.redis.lrange(self.pool_wait_q, 0, -1)
-        try:
-            return pool_list.index(reqid)
-        except:
-            return -1
+        pos = self.redis.zrank(self.pool_wait_z, reqid)
+        return pos if pos is not None else -1
+
+    def _migrate_wait_list(self):
+        wait_q = self.POOL_WAIT_Q.format(id=self.name)
+        for reqid in self.redis.lrange(wait_q, 0, -1):
+            self.redis.srem(self.pool_wait_set, reqid)
+            self._push_wait(reqid)
+
+        self.redis.delete(wait_q)
 
     def stop(self, reqid):
         logger.info('Stopping: ' + reqid)
@@ -405,15 +928,18 @@ class PersistentPool(LaunchAllPool):
             return {'success': True}
 
         else:
-            self.remove_running(reqid)
-
-            self._mark_expired(reqid)
+            logger.debug('Stop Running: ' + reqid)
+            pi = self.redis.pipeline()
+            pi.srem(self.flocks_key, reqid)
+            self._mark_expired(reqid, pi=pi)
+            self._execute(pi)
 
             logger.debug('Removing Flock: {0} with Grace Time {1}'.format(reqid, self.grace_time))
             rem_res = self.shepherd.remove_flock(reqid,
                                                  network_pool=self.network_pool,
                                                  keep_reqid=True,
-                                                 grace_time=self.grace_time)
+                                                 grace_time=self.grace_time,
+                                                 sync=False)
 
             if 'error' not in rem_res and self._is_persist(reqid):
                 self._push_wait(reqid)
@@ -438,9 +964,7 @@ class PersistentPool(LaunchAllPool):
 
                 assert 'error' not in res, res
 
-                self.add_running(reqid)
-
-                self._mark_wait_duration(reqid)
+                self._mark_running(reqid)
                 break
 
             except Exception as e:
@@ -451,20 +975,26 @@ class PersistentPool(LaunchAllPool):
         return res
 
     def remove(self, reqid, **kwargs):
-        self._remove_persist(reqid)
-
-        num_removed = self.remove_running(reqid)
+        logger.debug('Unpersist flock: ' + reqid)
+        pi = self.redis.pipeline()
+        pi.srem(self.pool_all_set, reqid)
+        pi.srem(self.flocks_key, reqid)
 
-        self._mark_expired(reqid)
+        self._mark_expired(reqid, pi=pi)
 
         # remove from wait list always just in case
-        self._remove_wait(reqid)
+        pi.zrem(self.pool_wait_z, reqid)
+        pi.srem(self.pool_wait_set, reqid)
+        pi.hdel(self.pool_wait_times, reqid)
+
+        num_removed = self._execute(pi)[1]
 
         # stop or remove
         if kwargs.get('stop'):
             res = self.shepherd.stop_flock(reqid)
         else:
-            res = super(PersistentPool, self).remove(reqid, grace_time=self.grace_time)
+            res = super(PersistentPool, self).remove(reqid, grace_time=self.grace_time,
+                                                     sync=kwargs.get('sync', True))
 
         # only attempt to restart next if was currently running
         # and stopping succeeded
@@ -474,6 +1004,20 @@ class PersistentPool(LaunchAllPool):
         return res
 
 
+# ============================================================================
+def register_script(redis, script):
+    """ Load script once and call by EVALSHA, or with EVAL if
+    the client has no script cache (eg. fakeredis)
+    """
+    if hasattr(redis, 'register_script'):
+        return redis.register_script(script)
+
+    def call(keys=[], args=[]):
+        return redis.eval(script, len(keys), *(list(keys) + list(args)))
+
+    return call
+
+
 # ============================================================================
 def get_pool_types():
     return [LaunchAllPool, FixedSizePool, PersistentPool]
@@ -0,0 +1,107 @@
+import time
+
+import gevent.local
+
+
+# ============================================================================
+class RedisStats(object):
+    """ Count of Redis round trips and their total time, by command,
+    grouped by the API endpoint (or 'background') that issued them
+    """
+    BACKGROUND = 'background'
+
+    def __init__(self):
+        self.local = gevent.local.local()
+        self.stats = {}
+
+    def wrap(self, redis):
+        return CountingRedis(redis, self)
+
+    def get_context(self):
+        return getattr(self.local, 'context', None) or self.BACKGROUND
+
+    def set_context(self, name):
+        self.local.context = name
+        if name:
+            self._get_entry(name)['requests'] += 1
+
+    def _get_entry(self, name):
+        entry = self.stats.get(name)
+        if not entry:
+            entry = {'requests': 0, 'calls': 0, 'time': 0.0, 'commands': {}}
+            self.stats[name] = entry
+
+        return entry
+
+    def record(self, command, elapsed):
+        entry = self._get_entry(self.get_context())
+        entry['calls'] += 1
+        entry['time'] += elapsed
+
+        command_entry = entry['commands'].setdefault(command, {'calls': 0, 'time': 0.0})
+        command_entry['calls'] += 1
+        command_entry['time'] += elapsed
+
+    def get_stats(self):
+        res = {}
+        for name, entry in self.stats.items():
+            res[name] = dict(entry)
+            if entry['requests']:
+                res[name]['calls_per_request'] = entry['calls'] / entry['requests']
+
+        return res
+
+    def reset(self):
+        self.stats = {}
+
+
+# ============================================================================
+class CountingRedis(object):
+    """ Redis client proxy recording each command, each script call
+    and each pipeline execute as one round trip
+    """
+    def __init__(self, redis, stats):
+        self.redis = redis
+        self.stats = stats
+
+    def _timed(self, name, func):
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.stats.record(name, time.time() - start)
+
+        return call
+
+    def pipeline(self, *args, **kwargs):
+        return CountingPipeline(self.redis.pipeline(*args, **kwargs), self)
+
+    def __getattr__(self, name):
+        attr = getattr(self.redis, name)
+        if not callable(attr):
+            return attr
+
+        if name == 'register_script':
+            return lambda script: self._timed('evalsha', attr(script))
+
+        return self._timed(name, attr)
+
+
+# ============================================================================
+class CountingPipeline(object):
+    def __init__(self, pipeline, counting_redis):
+        self.pipeline = pipeline
+        self.execute = counting_redis._timed('pipeline', pipeline.execute)
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipeline, name)
+        if not callable(attr):
+            return attr
+
+        # queued commands return the pipeline for chaining
+        def call(*args, **kwargs):
+            res = attr(*args, **kwargs)
+            return self if res is self.pipeline else res
+
+        return call
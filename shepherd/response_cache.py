@@ -0,0 +1,133 @@
+import copy
+import time
+from collections import OrderedDict
+
+import gevent
+
+from shepherd.flock import FlockRequest
+
+import logging
+
+logger = logging.getLogger('shepherd.response_cache')
+
+
+# ============================================================================
+class ResponseCache(object):
+    """ Per-process LRU of running flock requests, so that repeated polling
+    of a running flock is served without loading the request from redis.
+    Entries are dropped when the request is changed or removed by any process,
+    through the invalidation channel published to by FlockRequest
+    """
+    SIZE = 1000
+
+    MAX_AGE = 60
+
+    RECONNECT_WAIT = 1.0
+
+    def __init__(self, redis, size=None, max_age=None):
+        self.redis = redis
+        self.size = int(size or self.SIZE)
+        self.max_age = float(max_age or self.MAX_AGE)
+
+        # reqid -> (time added, request data)
+        self.entries = OrderedDict()
+
+        # incremented on each invalidation, a request loaded before an
+        # invalidation is not cached
+        self.version = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        # only cache while subscribed, as invalidations may be missed otherwise
+        self.subscribed = False
+
+        self.running = True
+        self.greenlet = gevent.spawn(self.listen_loop)
+
+    def get(self, reqid):
+        entry = self.entries.get(reqid)
+        if not entry:
+            return None
+
+        if time.time() - entry[0] > self.max_age:
+            self.entries.pop(reqid, None)
+            return None
+
+        self.entries.move_to_end(reqid)
+        return entry[1]
+
+    def put(self, reqid, data, version):
+        if not self.subscribed or version != self.version:
+            return
+
+        self.entries[reqid] = (time.time(), data)
+        self.entries.move_to_end(reqid)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, reqid):
+        self.version += 1
+        self.entries.pop(reqid, None)
+
+    def clear(self):
+        self.version += 1
+        self.entries.clear()
+
+    def load(self, flock_req, redis):
+        data = self.get(flock_req.reqid)
+        if data is not None:
+            self.hits += 1
+
+            # nested environ, resp and container ids are changed in place by callers
+            flock_req.data = copy.deepcopy(data)
+            return True
+
+        self.misses += 1
+
+        version = self.version
+        if not flock_req.load(redis):
+            return False
+
+        # only running flocks, which change only when stopped or removed
+        if flock_req.get_state() == 'running' and flock_req.get_cached_response():
+            self.put(flock_req.reqid, copy.deepcopy(flock_req.data), version)
+
+        return True
+
+    def listen_loop(self):
+        while self.running:
+            pubsub = None
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(FlockRequest.INVALIDATE_CHANNEL)
+                self.subscribed = True
+
+                for message in pubsub.listen():
+                    if not self.running:
+                        break
+
+                    if message and message['type'] == 'message':
+                        self.invalidate(message['data'])
+
+            except Exception as e:
+                logger.warning('Invalidation Channel Error: ' + str(e))
+
+            finally:
+                self.subscribed = False
+                self.clear()
+
+                try:
+                    if pubsub:
+                        pubsub.close()
+                except Exception:
+                    pass
+
+            if self.running:
+                gevent.sleep(self.RECONNECT_WAIT)
+
+    def shutdown(self):
+        self.running = False
+        self.greenlet.kill(block=False)
+        self.clear()
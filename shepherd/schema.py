@@ -12,6 +12,7 @@ class ContainerSchema(Schema):
     external_network = fields.String()
     set_user_params = fields.Boolean(default=False)
     deferred = fields.Boolean(default=False)
+    depends_on = fields.List(fields.String())
 
 class FlockSpecSchema(Schema):
     name = fields.String()
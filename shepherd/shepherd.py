@@ -9,9 +9,21 @@ from redis import StrictRedis
 
 from shepherd.flock import FlockRequest
 from shepherd.schema import FlockSpecSchema, InvalidParam
-from shepherd.network_pool import NetworkPool
+from shepherd.network_pool import NetworkPool, SharedNetworkPool
+from shepherd.container_cache import ContainerCache
+from shepherd.template import FlockTemplate
+from shepherd.image_cache import ImageCache
+from shepherd.image_manager import ImageManager
+from shepherd.layer_index import LayerIndex
+from shepherd.event_bus import EventBus
+from shepherd.state_mirror import StateMirror
+from shepherd.teardown import TeardownQueue
+from shepherd.response_cache import ResponseCache
+from shepherd.metrics import Metrics
+from shepherd.trace import TraceStore, LaunchTrace
 
 import gevent
+import gevent.pool
 
 import logging
 
@@ -30,6 +42,10 @@ class Shepherd(object):
 
     SHEP_DEFERRED_LABEL = 'owt.shepherd.deferred'
 
+    SHEP_SPARE_LABEL = 'owt.shepherd.spare'
+
+    SHEP_PRECREATED_LABEL = ContainerCache.PRECREATED_LABEL
+
     DEFAULT_REQ_TTL = 120
 
     UNTRACKED_CHECK_TIME = 30
@@ -38,20 +54,73 @@ class Shepherd(object):
 
     VOLUME_TEMPL = 'vol-{name}-{reqid}'
 
+    LAUNCH_CONCURRENCY = 4
+
     def __init__(self, redis, network_templ=None, volume_templ=None,
-                 reqid_label=None, untracked_check_time=None, network_label=None):
+                 reqid_label=None, untracked_check_time=None, network_label=None,
+                 launch_concurrency=None, container_cache_size=0, image_cache_ttl=None,
+                 image_prefetch_interval=0, image_disk_budget=0,
+                 teardown_concurrency=None, teardown_rate=None,
+                 response_cache_size=None, network_prewarm=0, docker_client=None,
+                 event_cursor_id=None):
         self.flocks = {}
-        self.docker = docker.from_env()
+        self.templates = {}
+        self.docker = docker_client or docker.from_env()
         self.redis = redis
 
+        self.metrics = Metrics()
+
+        self.traces = TraceStore()
+
+        self.event_bus = EventBus(self.docker, self.redis, cursor_id=event_cursor_id)
+
+        self.image_cache = ImageCache(self.docker, ttl=image_cache_ttl,
+                                      event_bus=self.event_bus)
+
+        self.layer_index = LayerIndex(self.docker, self.image_cache)
+
+        self.image_manager = ImageManager(self,
+                                          prefetch_interval=image_prefetch_interval,
+                                          disk_budget=image_disk_budget)
+
         self.network_pool = NetworkPool(self.docker,
                                         network_templ=network_templ,
                                         network_label=network_label)
 
+        # idle networks kept ready for all pools
+        self.shared_networks = None
+        if network_prewarm > 0:
+            self.shared_networks = SharedNetworkPool(self.docker, self.redis,
+                                                     target=network_prewarm,
+                                                     network_templ=network_templ,
+                                                     network_label=network_label)
+
         self.volume_templ = volume_templ or self.VOLUME_TEMPL
 
         self.reqid_label = reqid_label or self.SHEP_REQID_LABEL
 
+        self.state = StateMirror(self.docker,
+                                 reqid_label=self.reqid_label,
+                                 network_label=self.network_pool.network_label,
+                                 event_bus=self.event_bus)
+
+        self.launch_concurrency = launch_concurrency or self.LAUNCH_CONCURRENCY
+
+        self.teardown = TeardownQueue(self,
+                                      concurrency=teardown_concurrency,
+                                      rate=teardown_rate)
+
+        if response_cache_size is None:
+            response_cache_size = ResponseCache.SIZE
+
+        self.response_cache = None
+        if response_cache_size > 0:
+            self.response_cache = ResponseCache(self.redis, size=response_cache_size)
+
+        self.container_cache = None
+        if container_cache_size > 0:
+            self.container_cache = ContainerCache(self, size=container_cache_size)
+
         self.untracked_check_time = 0
         self.start_cleanup_loop(untracked_check_time)
 
@@ -88,6 +157,9 @@ class Shepherd(object):
             for data in all_flocks:
                 flock = FlockSpecSchema().load(data)
                 self.flocks[flock['name']] = flock
+                self.templates[flock['name']] = FlockTemplate.compile(flock,
+                                                                      self.docker.api,
+                                                                      self.DEFAULT_SHM_SIZE)
                 num_loaded += 1
 
         return num_loaded
@@ -95,7 +167,7 @@ class Shepherd(object):
     def request_flock(self, flock_name, req_opts=None, ttl=None):
         req_opts = req_opts or {}
         try:
-            flock = self.flocks[flock_name]
+            flock = self.templates[flock_name]
         except:
             return {'error': 'invalid_flock',
                     'flock': flock_name}
@@ -105,12 +177,12 @@ class Shepherd(object):
         overrides = flock_req.get_overrides()
 
         try:
-            image_list = self.resolve_image_list(flock['containers'], overrides)
+            image_list = self.resolve_image_list(flock.containers, overrides)
         except InvalidParam as ip:
             return ip.msg
 
         flock_req.data['image_list'] = image_list
-        flock_req.data['num_volumes'] = len(flock.get('volumes', []))
+        flock_req.data['num_volumes'] = len(flock.volumes)
         ttl = ttl or self.DEFAULT_REQ_TTL
         flock_req.save(self.redis, expire=ttl)
 
@@ -121,23 +193,95 @@ class Shepherd(object):
         if not flock_req.load(self.redis):
             return False
 
+        alias = flock_req.get_alias()
+        if alias:
+            return self.is_valid_flock(alias, ensure_state)
+
         if ensure_state and ensure_state != flock_req.get_state():
             return False
 
         return True
 
+    def resolve_alias(self, reqid):
+        flock_req = self.resolve_flock_req(reqid)
+        return flock_req.reqid if flock_req else reqid
+
+    def resolve_flock_req(self, reqid, max_depth=3):
+        # follow alias records to the flock request that owns the containers
+        for x in range(0, max_depth):
+            flock_req = FlockRequest(reqid)
+            if not flock_req.load(self.redis):
+                return None
+
+            reqid = flock_req.get_alias()
+            if not reqid:
+                return flock_req
+
+        return None
+
+    def assign_flock(self, spare_reqid, reqid, environ=None):
+        spare_req = FlockRequest(spare_reqid)
+        response = spare_req.load_cached_response(self.redis, required=True)
+        if 'error' in response:
+            return response
+
+        if spare_req.get_alias() or not spare_req.data.get('spare'):
+            return {'error': 'already_assigned'}
+
+        flock_req = FlockRequest(reqid)
+        if not flock_req.load(self.redis):
+            return {'error': 'invalid_reqid'}
+
+        flock_req.update_env(environ, self.redis, save=False)
+
+        for key in ('net', 'auto_remove', 'num_volumes', 'container_ids'):
+            if key in spare_req.data:
+                flock_req.data[key] = spare_req.data[key]
+
+        # containers and volumes keep the spare reqid in their labels
+        flock_req.data['launch_id'] = spare_reqid
+
+        pi = self.redis.pipeline()
+
+        for alias_id in [spare_reqid] + spare_req.data.get('aliases', []):
+            flock_req.add_alias(alias_id, pi)
+
+        # containers are already running, pass the request environ
+        # along with the user params
+        params = dict(flock_req.data.get('environ') or {})
+        params.update(flock_req.data.get('user_params') or {})
+        params['reqid'] = flock_req.reqid
+
+        flock_spec = self.templates[flock_req.data['flock']]
+
+        for spec in flock_spec.containers:
+            info = response['containers'].get(spec.name)
+            if not info or not info.get('ip') or not spec.set_user_params:
+                continue
+
+            up_key = self.USER_PARAMS_KEY.format(info['ip'])
+            pi.delete(up_key)
+            pi.hmset(up_key, params)
+
+        flock_req.cache_response(response, pi)
+        pi.execute()
+        return response
+
     def start_flock(self, reqid,
                     labels=None,
                     environ=None,
                     auto_remove=False,
                     network_pool=None):
 
+        # a restarted flock reuses the container names of its previous run
+        self.teardown.wait(reqid)
+
         flock_req = FlockRequest(reqid)
         state = flock_req.get_state()
         if state == 'stopped':
             return {'error': 'already_done'}
 
-        response = flock_req.load_cached_response(self.redis)
+        response = flock_req.load_cached_response(self.redis, cache=self.response_cache)
         if response:
             return response
 
@@ -146,60 +290,82 @@ class Shepherd(object):
         try:
             flock_name = flock_req.data['flock']
             image_list = flock_req.data['image_list']
-            flock_spec = self.flocks[flock_name]
+            flock_spec = self.templates[flock_name]
         except:
             return {'error': 'invalid_flock',
                     'flock': flock_name}
 
         req_deferred = flock_req.data.get('deferred', {})
 
+        start = time.time()
+        trace = self.traces.begin(flock_req.reqid, 'start_flock')
+
         network = None
+        volume_binds = None
         containers = {}
+        started = []
 
-        labels = labels or {}
+        labels = dict(labels or {})
         labels[self.reqid_label] = flock_req.reqid
 
+        network_pool = network_pool or self.network_pool
+
         try:
             flock_req.set_state('running', self.redis)
 
-            network_pool = network_pool or self.network_pool
-            network = network_pool.create_network()
+            with trace.span('create_network'):
+                network = network_pool.create_network()
+
+            self.state.add_network(network)
 
             flock_req.set_network(network.name)
 
             flock_req.data['auto_remove'] = auto_remove
 
-            volume_binds, volumes = self.get_volumes(flock_req, flock_spec, labels, create=True)
+            with trace.span('get_volumes'):
+                volume_binds, volumes = self.get_volumes(flock_req, flock_spec, labels, create=True)
+
+            launch_list = []
 
-            for image, spec in zip(image_list, flock_spec['containers']):
-                name = spec['name']
+            for image, spec in zip(image_list, flock_spec.containers):
+                name = spec.name
 
                 if name in req_deferred:
                     deferred = req_deferred[name]
                 else:
-                    deferred = spec.get('deferred', False)
+                    deferred = spec.deferred
 
                 if deferred:
-                    info = {'deferred': True, 'image': image}
-
+                    containers[name] = {'deferred': True, 'image': image}
                 else:
-                    res = self.run_container(image, spec, flock_req, network,
-                                             labels=labels,
-                                             volume_binds=volume_binds,
-                                             volumes=volumes,
-                                             auto_remove=auto_remove)
-                    container, info = res
+                    launch_list.append((image, spec))
+
+            launched = self.launch_containers(launch_list, flock_req, network,
+                                              started=started,
+                                              labels=labels,
+                                              volume_binds=volume_binds,
+                                              volumes=volumes,
+                                              auto_remove=auto_remove,
+                                              trace=trace)
+
+            containers.update(launched)
 
-                containers[spec['name']] = info
+            # keep response in flock spec order
+            containers = {spec.name: containers[spec.name]
+                          for spec in flock_spec.containers}
 
         except:
             traceback.print_exc()
 
             try:
-                self.remove_flock(reqid)
+                self._remove_partial_flock(flock_req, started, network,
+                                           network_pool, volume_binds)
             except:
                 pass
 
+            self.metrics.inc('shepherd_start_flock_errors_total')
+            self.traces.finish(trace, self.redis, error=True)
+
             return {'error': 'start_error',
                     'details': traceback.format_exc()
                    }
@@ -208,9 +374,81 @@ class Shepherd(object):
                     'network': network.name
                    }
 
-        flock_req.cache_response(response, self.redis)
+        with trace.span('save'):
+            flock_req.cache_response(response, self.redis)
+
+        self.metrics.observe_since('shepherd_start_flock_seconds', start)
+        self.traces.finish(trace, self.redis)
         return response
 
+    def launch_containers(self, launch_list, flock_req, network, started=None, **kwargs):
+        # run (image, spec) pairs concurrently, up to launch_concurrency at a time,
+        # starting any 'depends_on' containers first.
+        # each started container is added to 'started' to allow cleanup on error
+        if started is None:
+            started = []
+
+        pool = gevent.pool.Pool(self.launch_concurrency)
+        jobs = {}
+
+        def launch(image, spec):
+            for dep in spec.depends_on:
+                if dep in jobs:
+                    # raises if the dependency failed to start
+                    jobs[dep].get()
+
+            container, info = self.run_container(image, spec, flock_req, network, **kwargs)
+            started.append(container)
+            return info
+
+        # dependencies are always spawned before their dependents,
+        # so a full pool can not deadlock on waiting dependents
+        for image, spec in self.resolve_launch_order(launch_list):
+            jobs[spec.name] = pool.spawn(launch, image, spec)
+
+        pool.join()
+
+        return {name: job.get() for name, job in jobs.items()}
+
+    def resolve_launch_order(self, launch_list):
+        names = set(spec.name for image, spec in launch_list)
+        ordered = []
+        added = set()
+        remaining = list(launch_list)
+
+        while remaining:
+            ready = []
+            for image, spec in remaining:
+                deps = set(spec.depends_on) & names
+                if deps <= added:
+                    ready.append((image, spec))
+
+            if not ready:
+                raise Exception('Circular depends_on: ' +
+                                ', '.join(spec.name for image, spec in remaining))
+
+            for image, spec in ready:
+                ordered.append((image, spec))
+                added.add(spec.name)
+                remaining.remove((image, spec))
+
+        return ordered
+
+    def _remove_partial_flock(self, flock_req, containers, network, network_pool, volume_binds):
+        for container in containers:
+            self._remove_container(container)
+
+        if network:
+            try:
+                network_pool.remove_network(network)
+            except Exception as e:
+                logger.error(str(e))
+
+        if volume_binds:
+            self.teardown.remove_volumes(flock_req)
+
+        flock_req.delete(self.redis)
+
     def short_id(self, container):
         return container.id[:12]
 
@@ -246,7 +484,7 @@ class Shepherd(object):
 
         try:
             flock_name = flock_req.data['flock']
-            flock_spec = self.flocks[flock_name]
+            flock_spec = self.templates[flock_name]
 
             info = response['containers'][image_name]
 
@@ -262,8 +500,10 @@ class Shepherd(object):
             return {'error': 'invalid_deferred',
                     'flock': flock_name}
 
+        trace = self.traces.begin(flock_req.reqid, 'start_deferred')
+
         try:
-            labels = labels or {}
+            labels = dict(labels or {})
             labels[self.reqid_label] = flock_req.reqid
             labels[self.SHEP_DEFERRED_LABEL] = '1'
 
@@ -276,100 +516,120 @@ class Shepherd(object):
 
             auto_remove = flock_req.data['auto_remove']
 
-            volume_binds, volumes = self.get_volumes(flock_req, flock_spec, labels, create=False)
+            with trace.span('get_volumes'):
+                volume_binds, volumes = self.get_volumes(flock_req, flock_spec, labels, create=False)
 
             res = self.run_container(info['image'], spec, flock_req, network,
                                      labels=labels,
                                      volume_binds=volume_binds,
                                      volumes=volumes,
-                                     auto_remove=auto_remove)
+                                     auto_remove=auto_remove,
+                                     trace=trace)
 
             info.update(res[1])
 
         except:
             traceback.print_exc()
+            self.traces.finish(trace, self.redis, error=True)
             return {'error': 'error_starting_deferred',
                     'flock': flock_name}
 
-        flock_req.cache_response(response, self.redis)
+        with trace.span('save'):
+            flock_req.cache_response(response, self.redis)
+
+        self.invalidate_cached(flock_req.reqid)
+        self.traces.finish(trace, self.redis)
         return info
 
     def find_spec_for_flock_req(self, flock_req, image_name):
         try:
             flock_name = flock_req.data['flock']
-            flock_spec = self.flocks[flock_name]
-            for spec in flock_spec['containers']:
-                if spec['name'] == image_name:
-                    return spec
+            return self.templates[flock_name].get_container(image_name)
         except:
-            pass
-
-        return None
+            return None
 
     def run_container(self, image, spec, flock_req, network, labels=None,
                       volumes=None,
                       volume_binds=None,
-                      auto_remove=False):
+                      auto_remove=False,
+                      trace=None):
 
         api = self.docker.api
 
-        net_config = api.create_networking_config({
-            network.name: api.create_endpoint_config(
-                aliases=[spec['name']],
-            )
-        })
-
-        port_values = []
-        port_bindings = {}
-
-        ports = spec.get('ports', {})
-
-        for port_name, port in ports.items():
-            if isinstance(port, int) or '/' not in port:
-                port = str(port) + '/tcp'
-                ports[port_name] = port
-
-            port_bindings[port] = None
-            port_values.append(tuple(port.split('/', 1)))
-
-        host_config = api.create_host_config(auto_remove=auto_remove,
-                                             cap_add=['ALL'],
-                                             shm_size=spec.get('shm_size', self.DEFAULT_SHM_SIZE),
-                                             security_opt=['apparmor=unconfined'],
-                                             port_bindings=port_bindings,
-                                             binds=volume_binds)
-
-        name = spec['name'] + '-' + flock_req.reqid
-
-        environ = spec.get('environment') or {}
-        if 'environ' in flock_req.data:
-            environ = environ.copy()
-            environ.update(flock_req.data['environ'])
-
-        cdata = api.create_container(
-            image,
-            networking_config=net_config,
-            ports=port_values,
-            name=name,
-            host_config=host_config,
-            detach=True,
-            hostname=spec['name'],
-            environment=environ,
-            labels=labels,
-            volumes=volumes
-        )
-
-        container = self.docker.containers.get(cdata['Id'])
-
-        external_network = spec.get('external_network')
-        if external_network:
-            external_network = self.docker.networks.get(external_network)
-            external_network.connect(container)
+        # spans are discarded if not part of a traced launch
+        trace = trace or LaunchTrace(flock_req.reqid, 'run_container')
+
+        host_config = spec.get_host_config(auto_remove=auto_remove,
+                                           binds=volume_binds)
+
+        name = spec.name + '-' + flock_req.reqid
+
+        environ = spec.get_environ(flock_req.data.get('environ'))
+
+        create_kwargs = dict(ports=list(spec.port_values),
+                             host_config=host_config,
+                             detach=True,
+                             hostname=spec.name,
+                             environment=environ,
+                             labels=labels,
+                             volumes=volumes)
+
+        container = None
+
+        # only containers with no per-request config can be precreated
+        if self.container_cache and not volume_binds and environ == spec.environment:
+            cache_key = self.container_cache.get_key(image, spec, labels, host_config)
+            with trace.span('adopt_container', spec.name, image):
+                container, slot_id = self.container_cache.adopt(cache_key, image, create_kwargs,
+                                                                name, network, [spec.name])
+
+            if container:
+                flock_req.add_alias(slot_id, self.redis)
+
+        if not container:
+            try:
+                with trace.span('create_container', spec.name, image):
+                    cdata = api.create_container(image,
+                                                 networking_config=spec.get_networking_config(network),
+                                                 name=name,
+                                                 **create_kwargs)
+            except docker.errors.ImageNotFound:
+                # pull missing image, shared with any other launches of same image
+                with trace.span('pull_image', spec.name, image):
+                    self.image_manager.pull(image)
+
+                with trace.span('create_container', spec.name, image):
+                    cdata = api.create_container(image,
+                                                 networking_config=spec.get_networking_config(network),
+                                                 name=name,
+                                                 **create_kwargs)
+
+            container = self.docker.containers.get(cdata['Id'])
+
+        try:
+            external_network = spec.external_network
+            if external_network:
+                with trace.span('connect_external', spec.name, image):
+                    external_network = self.docker.networks.get(external_network)
+                    external_network.connect(container)
+
+            with trace.span('start_container', spec.name, image):
+                container.start()
+
+            # reload to get updated data
+            with trace.span('reload_container', spec.name, image):
+                container.reload()
 
-        container.start()
+            self.state.add_container(container)
 
-        # reload to get updated data
-        container.reload()
+            flock_req.add_container(spec.name, container.id)
+
+        except:
+            # not yet part of a started flock, remove here
+            self._remove_container(container)
+            raise
+
+        self.image_manager.record_launch(image)
 
         info = {}
         info['id'] = self.short_id(container)
@@ -379,14 +639,16 @@ class Shepherd(object):
         else:
             info['ip'] = self.get_ip(container, network)
 
-        info['ports'] = self.get_ports(container, ports)
+        info['ports'] = self.get_ports(container, dict(spec.ports))
 
-        if info['ip'] and spec.get('set_user_params'):
+        if info['ip'] and spec.set_user_params:
             # add reqid to userparams
             flock_req.data['user_params']['reqid'] = flock_req.reqid
             up_key = self.USER_PARAMS_KEY.format(info['ip'])
-            self.redis.hmset(up_key, flock_req.data['user_params'])
-            self.redis.set(self.C_TO_U_KEY.format(info['id']), up_key)
+            pi = self.redis.pipeline()
+            pi.hmset(up_key, flock_req.data['user_params'])
+            pi.set(self.C_TO_U_KEY.format(info['id']), up_key)
+            pi.execute()
 
         info['environ'] = environ
 
@@ -397,15 +659,15 @@ class Shepherd(object):
         if not name:
             return None
 
-        return self.docker.networks.get(name)
+        return self.state.get_network(name)
 
     def resolve_image_list(self, specs, overrides):
         image_list = []
         for spec in specs:
-            image = overrides.get(spec['name'], spec['image'])
+            image = overrides.get(spec.name, spec.image)
             image_list.append(image)
-            if image != spec['image']:
-                label = spec.get('image_label')
+            if image != spec.image:
+                label = spec.image_label
                 if not label:
                     raise InvalidParam({'error': 'invalid_image_param',
                                         'details': 'no image_label to allow overrides'})
@@ -419,130 +681,141 @@ class Shepherd(object):
         return image_list
 
     def image_has_label(self, image_name, label):
-        try:
-            image = self.docker.images.get(image_name)
-        except docker.errors.ImageNotFound:
-            return False
-
-        if '=' in label:
-            name, value = label.split('=', 1)
-            return image.labels.get(name) == value
-        else:
-            return image.labels.get(label, '') != ''
+        return self.image_cache.has_label(image_name, label)
 
     def is_ancestor_of(self, name, ancestor):
-        name = self.full_tag(name)
-        ancestor = self.full_tag(ancestor)
-        try:
-            image = self.docker.images.get(name)
-            base_image = self.docker.images.get(ancestor)
-        except docker.errors.ImageNotFound:
+        image = self.image_cache.get(name)
+        base_image = self.image_cache.get(ancestor)
+        if not image or not base_image:
             return False
 
-        base_layers = base_image.attrs['RootFS']['Layers']
-        layers = image.attrs['RootFS']['Layers']
-
-        # layers should start with base_layers if base is ancestor
-        # of image
+        return self.layer_index.is_ancestor(base_image, image)
 
-        # can't be ancestor if has more layers in base
-        if len(base_layers) > len(layers):
-            return False
-
-        return layers[:len(base_layers)] == base_layers
+    def get_layer_report(self, image_names):
+        images = {}
+        for name in image_names:
+            meta = self.image_cache.get(name)
+            if meta:
+                images[name] = meta
 
+        return self.layer_index.get_report(images)
 
-    def remove_flock(self, reqid, keep_reqid=False, grace_time=None, network_pool=None):
+    def remove_flock(self, reqid, keep_reqid=False, grace_time=None, network_pool=None,
+                     sync=True):
         flock_req = FlockRequest(reqid)
         if not flock_req.load(self.redis):
             return {'error': 'invalid_reqid'}
 
+        # already being removed
+        if self.teardown.is_pending(reqid):
+            return self.teardown.wait(reqid) if sync else {'success': True}
+
         try:
             network = self.get_network(flock_req)
         except:
             network = None
 
-        containers = self.get_flock_containers(flock_req)
+        label_ids = flock_req.get_label_ids()
 
-        for container in containers:
-            if container.labels.get(self.reqid_label) != reqid:
+        containers = []
+        user_params_keys = []
+
+        for container in self.get_flock_containers(flock_req):
+            # containers found by id may not have labels loaded
+            labels = container.labels
+            if labels and labels.get(self.reqid_label) not in label_ids:
                 continue
 
             try:
                 ip = self.get_ip(container, network)
-                self.redis.delete(self.USER_PARAMS_KEY.format(ip))
+                user_params_keys.append(self.USER_PARAMS_KEY.format(ip))
             except:
                 pass
 
-            self._remove_container(container, grace_time=grace_time)
+            containers.append(container)
 
-        if network:
-            try:
-                network_pool = network_pool or self.network_pool
-                network_pool.remove_network(network)
-            except Exception as e:
-                logger.error(str(e))
+        # tombstone: no longer running, but kept until docker removal is finished
+        flock_req.data.pop('resp', None)
+        flock_req.data['state'] = 'removing'
 
-        try:
-            self.remove_flock_volumes(flock_req)
-        except:
-            pass
+        pi = self.redis.pipeline()
+        if user_params_keys:
+            pi.delete(*user_params_keys)
+
+        flock_req.save_fields(pi, ['state', 'resp'])
+        flock_req.invalidate(pi)
+        pi.execute()
+
+        self.invalidate_cached(reqid)
 
-        # delete flock after docker removal is finished to avoid race condition
-        # with 'untracked' container removal
+        result = self.teardown.remove_flock(flock_req, containers, network,
+                                            network_pool or self.network_pool,
+                                            grace_time=grace_time,
+                                            keep_reqid=keep_reqid)
+
+        if not sync:
+            return {'success': True}
+
+        return result.get()
+
+    def invalidate_cached(self, reqid):
+        # other processes are notified through the invalidation channel,
+        # but drop from this process immediately
+        if self.response_cache:
+            self.response_cache.invalidate(reqid)
+
+    def _finish_remove_flock(self, flock_req, keep_reqid=False):
         if not keep_reqid:
             flock_req.delete(self.redis)
         else:
-            flock_req.stop(self.redis)
+            pi = self.redis.pipeline()
+            flock_req.clear_aliases(pi)
+            flock_req.data.pop('container_ids', None)
+            flock_req.stop(pi)
+            pi.execute()
 
-        return {'success': True}
-
-    def _remove_container(self, container, v=False, grace_time=0):
+    def _stop_container(self, container, grace_time=0):
         short_id = self.short_id(container)
 
         try:
             if grace_time:
                 logger.debug('Graceful Stop: ' + short_id)
-                self._do_graceful_stop(container, grace_time)
+                container.stop(timeout=grace_time)
             else:
                 logger.debug('Kill Container: ' + short_id)
                 container.kill()
         except docker.errors.APIError as e:
             logger.error(str(e))
 
+    def _remove_container(self, container, v=False, grace_time=0, stopped=False):
+        short_id = self.short_id(container)
+
+        if not stopped:
+            self._stop_container(container, grace_time=grace_time)
+
         try:
             c_to_uparams = self.C_TO_U_KEY.format(short_id)
             res = self.redis.get(c_to_uparams)
             if res:
-                self.redis.delete(res)
-                self.redis.delete(c_to_uparams)
+                self.redis.delete(res, c_to_uparams)
 
             container.remove(force=True, v=v)
+            self.state.remove_container(container.id)
             return short_id
 
         except docker.errors.APIError as e:
             logger.error(str(e))
             return None
 
-    def _do_graceful_stop(self, container, grace_time):
-        def do_stop():
-            try:
-                container.stop(timeout=grace_time)
-            except docker.errors.APIError as e:
-                logger.error(str(e))
-
-        gevent.spawn(do_stop)
-
     def get_volumes(self, flock_req, flock_spec, labels=None, create=False):
-        volume_spec = flock_spec.get('volumes')
-        if not volume_spec:
+        if not flock_spec.volumes:
             return None, None
 
         volumes_list = []
         volume_binds = []
 
-        for n, v in volume_spec.items():
-            vol_name = self.volume_templ.format(reqid=flock_req.reqid, name=n)
+        for n, v in flock_spec.volumes:
+            vol_name = self.volume_templ.format(reqid=flock_req.get_launch_id(), name=n)
 
             if create:
                 volume = self.docker.volumes.create(vol_name, labels=labels)
@@ -554,24 +827,28 @@ class Shepherd(object):
         return volume_binds, volumes_list
 
     def get_flock_containers(self, flock_req):
-        return self.docker.containers.list(all=True,
-                                           filters={'label': self.reqid_label + '=' + flock_req.reqid},
-                                           ignore_removed=True) or []
+        container_ids = flock_req.get_container_ids()
+        if container_ids:
+            return [self.state.get_container(container_id)
+                    for container_id in container_ids.values()]
 
-    def remove_flock_volumes(self, flock_req):
-        num_volumes = flock_req.data.get('num_volumes', 0)
+        # older requests without container ids, find by label
+        containers = []
+        for label_id in flock_req.get_label_ids():
+            containers.extend(self.state.get_containers(label_id))
 
-        for x in range(0, 3):
-            res = self.docker.volumes.prune(filters={'label': self.reqid_label + '=' + flock_req.reqid})
-            num_volumes -= len(res.get('VolumesDeleted', []))
+        return containers
+
+    def remove_flock_volumes(self, flock_req):
+        # returns false if not all volumes deleted yet, to be retried
+        if not flock_req.data.get('num_volumes'):
+            return True
 
-            if num_volumes == 0:
-                return True
+        filters = {'label': self.reqid_label + '=' + flock_req.get_launch_id()}
 
-            # if not all volumes deleted yet, wait and try again
-            time.sleep(1.0)
+        self.docker.volumes.prune(filters=filters)
 
-        return num_volumes == 0
+        return not self.docker.volumes.list(filters=filters)
 
     def stop_flock(self, reqid, grace_time=1):
         flock_req = FlockRequest(reqid)
@@ -587,9 +864,12 @@ class Shepherd(object):
 
             for container in containers:
                 print('Stopping {0} with grace {1}'.format(container.id, grace_time))
-                self._do_graceful_stop(container, grace_time)
 
-            flock_req.set_state('stopped', self.redis)
+            self.teardown.stop_containers(containers, grace_time)
+
+            # drops the cached response in every process
+            flock_req.stop(self.redis)
+            self.invalidate_cached(reqid)
 
         except:
             traceback.print_exc()
@@ -603,13 +883,9 @@ class Shepherd(object):
     def untracked_check_loop(self):
         print('Untracked Container Check Loop Started')
 
-        filters = {'label': self.reqid_label}
-
         while self.untracked_check_time > 0:
             try:
-                all_containers = self.docker.containers.list(all=False,
-                                                             filters=filters,
-                                                             ignore_removed=True)
+                all_containers = self.state.list_containers(running_only=True)
 
                 reqids = set()
                 network_names = set()
@@ -654,6 +930,28 @@ class Shepherd(object):
 
             time.sleep(self.untracked_check_time)
 
+    def shutdown(self):
+        self.untracked_check_time = 0
+
+        self.teardown.shutdown()
+
+        if self.container_cache:
+            self.container_cache.shutdown()
+
+        if self.response_cache:
+            self.response_cache.shutdown()
+
+        if self.shared_networks:
+            self.shared_networks.shutdown()
+
+        self.image_manager.shutdown()
+
+        self.state.shutdown()
+
+        self.image_cache.shutdown()
+
+        self.event_bus.shutdown()
+
     @classmethod
     def full_tag(cls, tag):
         return tag + ':latest' if ':' not in tag else tag
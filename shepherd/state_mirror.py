@@ -0,0 +1,214 @@
+import time
+import traceback
+
+import docker
+import gevent
+
+import logging
+
+logger = logging.getLogger('shepherd.state')
+
+
+# ============================================================================
+class StateMirror(object):
+    """ In-memory copy of all containers with the reqid label and all networks
+    with the network label, seeded from the daemon, updated from Docker events,
+    and fully reloaded every resync_interval seconds
+    """
+    RESYNC_INTERVAL = 300
+
+    # ignore late create/start events for containers already removed
+    TOMBSTONE_TTL = 60
+
+    def __init__(self, docker_client, reqid_label, network_label, event_bus=None,
+                 resync_interval=None):
+        self.docker = docker_client
+        self.reqid_label = reqid_label
+        self.network_label = network_label
+
+        self.resync_interval = resync_interval or self.RESYNC_INTERVAL
+
+        # container id -> attrs
+        self.containers = {}
+
+        # reqid label value -> set of container ids
+        self.by_reqid = {}
+
+        # network name -> attrs
+        self.networks = {}
+
+        # removed container id -> time removed
+        self.tombstones = {}
+
+        self.running = True
+
+        self.resync()
+
+        if event_bus:
+            event_bus.subscribe(self.handle_event, type_='container')
+            event_bus.subscribe(self.handle_event, type_='network')
+
+        gevent.spawn(self.resync_loop)
+
+    def resync(self):
+        containers = self.docker.containers.list(all=True,
+                                                 filters={'label': self.reqid_label},
+                                                 ignore_removed=True)
+
+        networks = self.docker.networks.list(filters={'label': self.network_label})
+
+        self.containers = {}
+        self.by_reqid = {}
+        for container in containers:
+            self._add_container(container.attrs)
+
+        self.networks = {network.name: network.attrs for network in networks}
+
+    def _add_container(self, attrs):
+        labels = (attrs.get('Config') or {}).get('Labels') or {}
+        reqid = labels.get(self.reqid_label)
+        if not reqid:
+            return
+
+        self.containers[attrs['Id']] = attrs
+        self.by_reqid.setdefault(reqid, set()).add(attrs['Id'])
+
+    def add_container(self, container):
+        self.tombstones.pop(container.id, None)
+        self._add_container(container.attrs)
+
+    def remove_container(self, container_id, tombstone=True):
+        attrs = self.containers.pop(container_id, None)
+
+        if tombstone:
+            self.tombstones[container_id] = time.time()
+
+        if not attrs:
+            return
+
+        reqid = attrs['Config']['Labels'].get(self.reqid_label)
+        ids = self.by_reqid.get(reqid)
+        if ids:
+            ids.discard(container_id)
+            if not ids:
+                del self.by_reqid[reqid]
+
+    def get_containers(self, reqid, running_only=False):
+        return [self._to_container(self.containers[id_])
+                for id_ in self.by_reqid.get(reqid, ())
+                if not running_only or self._is_running(self.containers[id_])]
+
+    def get_container(self, container_id):
+        attrs = self.containers.get(container_id)
+        if not attrs:
+            # not mirrored (yet), enough to stop and remove by id
+            attrs = {'Id': container_id,
+                     'Config': {'Labels': {}},
+                     'State': {'Status': 'unknown'}}
+
+        return self._to_container(attrs)
+
+    def list_containers(self, running_only=False):
+        return [self._to_container(attrs)
+                for attrs in list(self.containers.values())
+                if not running_only or self._is_running(attrs)]
+
+    def _is_running(self, attrs):
+        return attrs['State']['Status'] == 'running'
+
+    def _to_container(self, attrs):
+        return self.docker.containers.prepare_model(attrs)
+
+    def add_network(self, network):
+        if network.attrs.get('Labels', {}).get(self.network_label):
+            self.networks[network.name] = network.attrs
+
+    def remove_network(self, name):
+        self.networks.pop(name, None)
+
+    def get_network(self, name):
+        attrs = self.networks.get(name)
+        if attrs:
+            return self.docker.networks.prepare_model(attrs)
+
+        network = self.docker.networks.get(name)
+        self.add_network(network)
+        return network
+
+    def handle_event(self, event):
+        # events missed, reload all
+        if event is None:
+            self.resync()
+            return
+
+        if event['Type'] == 'network':
+            self.handle_network_event(event)
+        else:
+            self.handle_container_event(event)
+
+    def handle_container_event(self, event):
+        id_ = event.get('id') or event['Actor']['ID']
+        attrs = event['Actor'].get('Attributes', {})
+        action = event.get('Action')
+
+        if action == 'destroy':
+            self.remove_container(id_, tombstone=False)
+            self.tombstones.pop(id_, None)
+            return
+
+        if id_ in self.tombstones:
+            return
+
+        container = self.containers.get(id_)
+
+        if action == 'create' and not container:
+            if attrs.get(self.reqid_label):
+                self._add_container(self._attrs_from_event(id_, attrs))
+
+        elif container and action in ('start', 'die'):
+            container['State']['Status'] = 'running' if action == 'start' else 'exited'
+
+        elif container and action == 'rename':
+            container['Name'] = '/' + attrs.get('name', '')
+
+    def _attrs_from_event(self, id_, attrs):
+        labels = {n: v for n, v in attrs.items() if n not in ('image', 'name')}
+        return {'Id': id_,
+                'Name': '/' + attrs.get('name', ''),
+                'Image': attrs.get('image'),
+                'Config': {'Labels': labels, 'Image': attrs.get('image')},
+                'State': {'Status': 'created'}}
+
+    def handle_network_event(self, event):
+        id_ = event['Actor']['ID']
+        name = event['Actor'].get('Attributes', {}).get('name')
+        action = event.get('Action')
+
+        if action == 'destroy':
+            self.remove_network(name)
+
+        elif action == 'create' and name not in self.networks:
+            try:
+                self.add_network(self.docker.networks.get(id_))
+            except docker.errors.NotFound:
+                pass
+
+    def resync_loop(self):
+        while self.running:
+            gevent.sleep(self.resync_interval)
+
+            if not self.running:
+                break
+
+            try:
+                self.resync()
+            except Exception:
+                traceback.print_exc()
+
+            now = time.time()
+            for id_, removed in list(self.tombstones.items()):
+                if now - removed > self.TOMBSTONE_TTL:
+                    self.tombstones.pop(id_, None)
+
+    def shutdown(self):
+        self.running = False
@@ -0,0 +1,205 @@
+import time
+import traceback
+
+import gevent
+import gevent.event
+import gevent.queue
+
+import logging
+
+logger = logging.getLogger('shepherd.teardown')
+
+
+# ============================================================================
+class TeardownQueue(object):
+    """ Removes flocks in the background. Container stops and removals from all
+    flocks are run by a fixed number of workers, started at most 'rate' per second,
+    then the flock network and volumes are removed, retrying until they are free.
+    Graceful stops are started by the workers, but waited for outside of them
+    """
+    CONCURRENCY = 8
+
+    RATE = 20
+
+    MAX_GRACE_TIME = 30
+
+    CLEANUP_RETRIES = 5
+
+    CLEANUP_RETRY_DELAY = 1.0
+
+    def __init__(self, shepherd, concurrency=None, rate=None, max_grace_time=None):
+        self.shepherd = shepherd
+
+        self.concurrency = int(concurrency or self.CONCURRENCY)
+        self.rate = float(rate or self.RATE)
+        self.max_grace_time = int(max_grace_time or self.MAX_GRACE_TIME)
+
+        # (func, args, kwargs, AsyncResult)
+        self.tasks = gevent.queue.Queue()
+
+        # reqid -> AsyncResult of flock teardown
+        self.pending = {}
+
+        self.next_slot = 0
+
+        self.running = True
+
+        self.workers = [gevent.spawn(self.worker_loop)
+                        for x in range(0, self.concurrency)]
+
+    def submit(self, func, *args, **kwargs):
+        result = gevent.event.AsyncResult()
+        self.tasks.put((func, args, kwargs, result))
+        return result
+
+    def get_grace_time(self, grace_time):
+        return min(int(grace_time or 0), self.max_grace_time)
+
+    def remove_flock(self, flock_req, containers, network, network_pool,
+                     grace_time=None, keep_reqid=False):
+        reqid = flock_req.reqid
+
+        result = self.pending.get(reqid)
+        if result:
+            return result
+
+        result = gevent.event.AsyncResult()
+        self.pending[reqid] = result
+
+        gevent.spawn(self._remove_flock, result, flock_req, containers, network,
+                     network_pool, grace_time, keep_reqid)
+
+        return result
+
+    def _remove_flock(self, result, flock_req, containers, network, network_pool,
+                      grace_time, keep_reqid):
+        start = time.time()
+        try:
+            grace_time = self.get_grace_time(grace_time)
+
+            # wait for all graceful stops before removing, the removals
+            # then only kill any containers that did not stop in time
+            if grace_time:
+                jobs = self.stop_containers(containers, grace_time)
+                gevent.joinall([job.get() for job in jobs])
+
+            jobs = [self.submit(self.shepherd._remove_container, container,
+                                stopped=bool(grace_time))
+                    for container in containers]
+
+            for job in jobs:
+                job.wait()
+
+            if network:
+                if not self.retry(network_pool.remove_network, network):
+                    logger.error('Network Not Removed: ' + network.name)
+
+            if not self.retry(self.shepherd.remove_flock_volumes, flock_req):
+                logger.error('Volumes Not Removed: ' + flock_req.reqid)
+
+            # delete flock after docker removal is finished to avoid race condition
+            # with 'untracked' container removal
+            self.shepherd._finish_remove_flock(flock_req, keep_reqid)
+
+            self.shepherd.metrics.observe_since('shepherd_teardown_seconds', start)
+
+            result.set({'success': True})
+
+        except Exception as e:
+            traceback.print_exc()
+            result.set({'error': 'remove_failed',
+                        'details': str(e)})
+
+        finally:
+            self.pending.pop(flock_req.reqid, None)
+
+    def stop_containers(self, containers, grace_time):
+        """ Start a graceful stop of each container at the teardown rate.
+        The stops run in their own greenlets, so that a worker is not
+        held for the grace time of each container
+
+        :returns: list of AsyncResult, set to each stop greenlet once started
+        """
+        grace_time = self.get_grace_time(grace_time)
+
+        return [self.submit(gevent.spawn, self.shepherd._stop_container, container,
+                            grace_time=grace_time)
+                for container in containers]
+
+    def remove_volumes(self, flock_req):
+        # volumes of a flock that failed to start, retried in the background
+        reqid = flock_req.reqid
+
+        result = self.pending.get(reqid)
+        if result:
+            return result
+
+        result = gevent.event.AsyncResult()
+        self.pending[reqid] = result
+
+        gevent.spawn(self._remove_volumes, result, flock_req)
+
+        return result
+
+    def _remove_volumes(self, result, flock_req):
+        try:
+            if not self.retry(self.shepherd.remove_flock_volumes, flock_req):
+                logger.error('Volumes Not Removed: ' + flock_req.reqid)
+
+            result.set({'success': True})
+
+        finally:
+            self.pending.pop(flock_req.reqid, None)
+
+    def retry(self, func, *args):
+        delay = self.CLEANUP_RETRY_DELAY
+        for x in range(0, self.CLEANUP_RETRIES):
+            try:
+                if func(*args):
+                    return True
+            except Exception as e:
+                logger.debug('Cleanup Failed: ' + str(e))
+
+            if x < self.CLEANUP_RETRIES - 1:
+                gevent.sleep(delay)
+                delay *= 2
+
+        return False
+
+    def wait(self, reqid, timeout=None):
+        # wait for a pending teardown of the same reqid, eg. before restarting
+        # a flock with the same container names
+        result = self.pending.get(reqid)
+        if result:
+            logger.debug('Waiting for Teardown: ' + reqid)
+            return result.get(timeout=timeout)
+
+    def is_pending(self, reqid):
+        return reqid in self.pending
+
+    def _wait_rate(self):
+        now = time.time()
+        start = max(self.next_slot, now)
+        self.next_slot = start + 1.0 / self.rate
+
+        if start > now:
+            gevent.sleep(start - now)
+
+    def worker_loop(self):
+        while self.running:
+            func, args, kwargs, result = self.tasks.get()
+
+            try:
+                self._wait_rate()
+                result.set(func(*args, **kwargs))
+            except Exception as e:
+                traceback.print_exc()
+                result.set_exception(e)
+
+    def shutdown(self, timeout=30):
+        pending = list(self.pending.values())
+        if pending:
+            gevent.wait(pending, timeout=timeout)
+
+        self.running = False
+        gevent.killall(self.workers)
@@ -0,0 +1,108 @@
+import copy
+import hashlib
+import json
+
+from collections import namedtuple
+from types import MappingProxyType
+
+
+# ============================================================================
+class ContainerTemplate(namedtuple('ContainerTemplate',
+                                   ['name', 'image', 'image_label',
+                                    'deferred', 'depends_on',
+                                    'external_network', 'set_user_params',
+                                    'environment', 'ports', 'port_values',
+                                    'host_config', 'endpoint_config', 'key'])):
+    """ Precomputed launch parameters for one container in a flock.
+    Only the reqid-specific fields are filled in at launch time.
+    The host and endpoint config mappings are read-only, but not their nested
+    values, so each launch gets a deep copy from get_host_config() and get_networking_config()
+    """
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, spec, api, shm_size):
+        ports = []
+        port_values = []
+        port_bindings = {}
+
+        for port_name, port in (spec.get('ports') or {}).items():
+            if isinstance(port, int) or '/' not in port:
+                port = str(port) + '/tcp'
+
+            ports.append((port_name, port))
+            port_bindings[port] = None
+            port_values.append(tuple(port.split('/', 1)))
+
+        host_config = api.create_host_config(cap_add=['ALL'],
+                                             shm_size=spec.get('shm_size', shm_size),
+                                             security_opt=['apparmor=unconfined'],
+                                             port_bindings=port_bindings)
+
+        endpoint_config = api.create_endpoint_config(aliases=[spec['name']])
+
+        key = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+        return cls(name=spec['name'],
+                   image=spec['image'],
+                   image_label=spec.get('image_label'),
+                   deferred=spec.get('deferred', False),
+                   depends_on=tuple(spec.get('depends_on') or ()),
+                   external_network=spec.get('external_network'),
+                   set_user_params=spec.get('set_user_params', False),
+                   environment=MappingProxyType(dict(spec.get('environment') or {})),
+                   ports=tuple(ports),
+                   port_values=tuple(port_values),
+                   host_config=MappingProxyType(host_config),
+                   endpoint_config=MappingProxyType(endpoint_config),
+                   key=key)
+
+    def get_environ(self, req_environ=None):
+        environ = dict(self.environment)
+        if req_environ:
+            environ.update(req_environ)
+
+        return environ
+
+    def get_host_config(self, auto_remove=False, binds=None):
+        host_config = copy.deepcopy(dict(self.host_config))
+        if auto_remove:
+            host_config['AutoRemove'] = True
+
+        if binds:
+            host_config['Binds'] = binds
+
+        return host_config
+
+    def get_networking_config(self, network):
+        return {'EndpointsConfig': {network.name: copy.deepcopy(dict(self.endpoint_config))}}
+
+
+# ============================================================================
+class FlockTemplate(namedtuple('FlockTemplate', ['name', 'containers', 'volumes'])):
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, flock_spec, api, shm_size):
+        containers = tuple(ContainerTemplate.compile(spec, api, shm_size)
+                           for spec in flock_spec['containers'])
+
+        names = set(container.name for container in containers)
+        for container in containers:
+            for dep in container.depends_on:
+                if dep not in names:
+                    raise Exception('Unknown depends_on "{0}" for "{1}" in flock "{2}"'.format(
+                                    dep, container.name, flock_spec['name']))
+
+        volumes = tuple((flock_spec.get('volumes') or {}).items())
+
+        return cls(name=flock_spec['name'],
+                   containers=containers,
+                   volumes=volumes)
+
+    def get_container(self, name):
+        for container in self.containers:
+            if container.name == name:
+                return container
+
+        return None
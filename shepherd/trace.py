@@ -0,0 +1,167 @@
+import json
+import time
+from contextlib import contextmanager
+
+import gevent.local
+
+
+# ============================================================================
+class LaunchTrace(object):
+    """ Spans for each phase of a single flock or deferred container launch
+    """
+    def __init__(self, reqid, op):
+        self.reqid = reqid
+        self.op = op
+        self.start = time.time()
+        self.duration = None
+        self.error = False
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, container=None, image=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spans.append({'name': name,
+                               'container': container,
+                               'image': image,
+                               'start': start - self.start,
+                               'duration': time.time() - start})
+
+    def finish(self, error=False):
+        self.duration = time.time() - self.start
+        self.error = error
+
+    def to_dict(self):
+        return {'reqid': self.reqid,
+                'op': self.op,
+                'start': self.start,
+                'duration': self.duration,
+                'error': self.error,
+                'spans': self.spans}
+
+    def get_server_timing(self):
+        # total per phase, containers may be launched concurrently
+        phases = {}
+        for span in self.spans:
+            phases[span['name']] = phases.get(span['name'], 0) + span['duration']
+
+        timings = ['{0};dur={1:.1f}'.format(name, value * 1000)
+                   for name, value in phases.items()]
+
+        timings.append('total;dur={0:.1f}'.format((self.duration or 0) * 1000))
+        return ', '.join(timings)
+
+
+# ============================================================================
+class TraceStore(object):
+    """ Stores launch traces in redis: the most recent traces in a bounded list,
+    recent traces for each reqid, and a running count, total and max
+    for each phase of each image
+    """
+    RECENT_KEY = 'tr:recent'
+
+    REQ_KEY = 'tr:r:{0}'
+
+    IMAGE_KEY = 'tr:i:{0}'
+
+    IMAGES_KEY = 'tr:images'
+
+    SIZE = 1000
+
+    PER_REQ = 20
+
+    REQ_TTL = 3600
+
+    def __init__(self, size=None):
+        self.size = int(size or self.SIZE)
+
+        # last trace finished by current greenlet, for Server-Timing
+        self.local = gevent.local.local()
+
+    def begin(self, reqid, op):
+        return LaunchTrace(reqid, op)
+
+    def finish(self, trace, redis, error=False):
+        trace.finish(error=error)
+        self.local.last = trace
+
+        data = json.dumps(trace.to_dict())
+        req_key = self.REQ_KEY.format(trace.reqid)
+
+        pi = redis.pipeline(transaction=False)
+        pi.lpush(self.RECENT_KEY, data)
+        pi.ltrim(self.RECENT_KEY, 0, self.size - 1)
+
+        pi.rpush(req_key, data)
+        pi.ltrim(req_key, -self.PER_REQ, -1)
+        pi.expire(req_key, self.REQ_TTL)
+
+        if not error:
+            for span in trace.spans:
+                if not span['image']:
+                    continue
+
+                image_key = self.IMAGE_KEY.format(span['image'])
+                pi.sadd(self.IMAGES_KEY, span['image'])
+                pi.hincrby(image_key, span['name'] + ':count', 1)
+                pi.hincrbyfloat(image_key, span['name'] + ':total', span['duration'])
+
+        pi.execute()
+
+        # max is not atomic, but only used as a rough guide
+        if not error:
+            self._update_max(trace, redis)
+
+    def _update_max(self, trace, redis):
+        spans = [span for span in trace.spans if span['image']]
+        if not spans:
+            return
+
+        pi = redis.pipeline(transaction=False)
+        for span in spans:
+            pi.hget(self.IMAGE_KEY.format(span['image']), span['name'] + ':max')
+
+        current = pi.execute()
+
+        pi = redis.pipeline(transaction=False)
+        for span, value in zip(spans, current):
+            if value is None or span['duration'] > float(value):
+                pi.hset(self.IMAGE_KEY.format(span['image']), span['name'] + ':max', span['duration'])
+
+        pi.execute()
+
+    def pop_last(self):
+        trace = getattr(self.local, 'last', None)
+        self.local.last = None
+        return trace
+
+    def get_traces(self, reqid, redis):
+        return [json.loads(data) for data in redis.lrange(self.REQ_KEY.format(reqid), 0, -1)]
+
+    def get_recent(self, redis, count=100):
+        return [json.loads(data) for data in redis.lrange(self.RECENT_KEY, 0, count - 1)]
+
+    def get_image_phases(self, redis):
+        images = sorted(redis.smembers(self.IMAGES_KEY))
+
+        pi = redis.pipeline(transaction=False)
+        for image in images:
+            pi.hgetall(self.IMAGE_KEY.format(image))
+
+        res = {}
+        for image, fields in zip(images, pi.execute()):
+            phases = {}
+            for field, value in fields.items():
+                phase, stat = field.rsplit(':', 1)
+                phases.setdefault(phase, {})[stat] = float(value)
+
+            for phase in phases.values():
+                if phase.get('count'):
+                    phase['count'] = int(phase['count'])
+                    phase['mean'] = phase.get('total', 0) / phase['count']
+
+            res[image] = phases
+
+        return res
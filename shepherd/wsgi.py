@@ -20,6 +20,8 @@ from shepherd.schema import LaunchResponseSchema
 from shepherd.api import init_routes
 from shepherd.pool import create_pool
 from shepherd.imageinfo import ImageInfo
+from shepherd.blob_cache import BlobCache
+from shepherd.redis_stats import CountingRedis
 
 
 # ============================================================================
@@ -27,11 +29,22 @@ class APIFlask(Flask):
     REQ_TO_POOL = 'reqp:'
     MATCH_TS = re.compile(r'([\d]{1,20})/(.*)')
 
-    def __init__(self, shepherd, pools_filename, images_filename, name=None, *args, **kwargs):
+    def __init__(self, shepherd, pools_filename, images_filename, name=None, *args,
+                 redis_stats=None, **kwargs):
         self.shepherd = shepherd
         self.pools = {}
         self.imageinfos = {}
 
+        # count redis calls per api endpoint, the client must be wrapped
+        # before creating the shepherd, so that all subsystems are counted
+        counting = isinstance(self.shepherd.redis, CountingRedis)
+        if redis_stats and not counting:
+            raise ValueError('redis_stats requires a shepherd created with RedisStats().wrap(redis)')
+
+        self.redis_stats = None
+        if counting and redis_stats is not False:
+            self.redis_stats = self.shepherd.redis.stats
+
         self.init_pool_config(self.load_yaml_file(pools_filename))
         self.init_image_config(self.load_yaml_file(images_filename))
 
@@ -46,6 +59,25 @@ class APIFlask(Flask):
         self.config['TEMPLATES_AUTO_RELOAD'] = True
         self.jinja_env.auto_reload = True
 
+        if self.redis_stats:
+            self.before_request(lambda: self.redis_stats.set_context(request.endpoint))
+            self.teardown_request(lambda exc: self.redis_stats.set_context(None))
+
+        # launch phase timings of any flock or container started by this request
+        self.before_request(self.clear_server_timing)
+        self.after_request(self.add_server_timing)
+
+    def clear_server_timing(self):
+        # drop any trace left by a launch outside of a request
+        self.shepherd.traces.pop_last()
+
+    def add_server_timing(self, response):
+        trace = self.shepherd.traces.pop_last()
+        if trace:
+            response.headers['Server-Timing'] = trace.get_server_timing()
+
+        return response
+
     def load_yaml_file(self, filename):
         with open(filename, 'rt') as fh:
             contents = fh.read()
@@ -62,9 +94,16 @@ class APIFlask(Flask):
 
     def init_image_config(self, config):
         for name, data in config['images'].items():
-            info = ImageInfo(self.shepherd.docker, **data)
+            info = ImageInfo(self.shepherd.docker,
+                             image_cache=self.shepherd.image_cache,
+                             **data)
             self.imageinfos[name] = info
 
+            self.shepherd.image_manager.add_source(info.get_image_names)
+
+        self.blob_cache = BlobCache(image_cache=self.shepherd.image_cache,
+                                    **config.get('blob_cache', {}))
+
         view = config.get('view', {})
 
         def load_value(name, default=''):
@@ -79,6 +118,20 @@ class APIFlask(Flask):
         self.view_override_image = load_value('override')
         self.view_default_flock = os.environ.get('DEFAULT_FLOCK', load_value('default_flock'))
 
+    def render_metrics(self):
+        collected = []
+        for pool in self.pools.values():
+            collected.extend(pool.get_metrics())
+
+        shared = self.shepherd.shared_networks
+        if shared:
+            labels = {'pool': shared.pool_name}
+            collected.append(('shepherd_network_pool_hits_total', labels, shared.hits))
+            collected.append(('shepherd_network_pool_misses_total', labels, shared.misses))
+            collected.append(('shepherd_network_pool_quota_misses_total', labels, shared.quota_misses))
+
+        return self.shepherd.metrics.render(collected)
+
     def parse_url_ts(self, url):
         timestamp = ''
         m = self.MATCH_TS.match(url)
@@ -177,6 +230,8 @@ class APIFlask(Flask):
         for pool in self.pools.values():
             pool.shutdown()
 
+        self.blob_cache.close()
+
     def add_url_rule(self, rule, endpoint=None, view_func=None, **kwargs):
         req_schema = kwargs.pop('req_schema', '')
         resp_schema = kwargs.pop('resp_schema', '')
@@ -88,7 +88,9 @@ def shepherd(redis):
                     untracked_check_time=0)
 
     shep.load_flocks(TEST_FLOCKS)
-    return shep
+    yield shep
+
+    shep.shutdown()
 
 
 @pytest.fixture(scope='module')
@@ -2,12 +2,12 @@ from gevent.monkey import patch_all; patch_all()
 
 import docker.errors
 import fakeredis
-import json
 import os
 import pytest
 import time
 import glob
 from shepherd.shepherd import Shepherd
+from shepherd.template import FlockTemplate
 
 
 # ============================================================================
@@ -51,7 +51,7 @@ class TestShepherd(object):
         reqid = res['reqid']
         TestShepherd.reqid = reqid
         assert reqid
-        assert json.loads(redis.get('req:' + reqid))['flock'] == 'test_1'
+        assert redis.hget('req:' + reqid, 'flock') == 'test_1'
 
     def test_is_ancestor(self, shepherd):
         assert shepherd.is_ancestor_of('test-shepherd/busybox', 'busybox')
@@ -151,6 +151,60 @@ class TestShepherd(object):
         # verify network
         assert docker_client.networks.get(flock['network'])
 
+    def test_depends_on_started_first(self, docker_client):
+        containers = TestShepherd.flock['containers']
+
+        def started_at(name):
+            container = docker_client.containers.get(containers[name]['id'])
+            return container.attrs['State']['StartedAt']
+
+        # 'another-box' depends on 'busybox'
+        assert started_at('busybox') <= started_at('another-box')
+
+    def test_launch_order(self, shepherd):
+        flock = FlockTemplate.compile({'name': 'order',
+                                       'containers': [{'name': 'a', 'image': 'x', 'depends_on': ['b']},
+                                                      {'name': 'b', 'image': 'y', 'depends_on': ['c']},
+                                                      {'name': 'c', 'image': 'z'}]},
+                                      shepherd.docker.api, '1g')
+
+        order = shepherd.resolve_launch_order(list(zip(['x', 'y', 'z'], flock.containers)))
+        assert [spec.name for image, spec in order] == ['c', 'b', 'a']
+
+        circular = FlockTemplate.compile({'name': 'circular',
+                                          'containers': [{'name': 'a', 'image': 'x', 'depends_on': ['b']},
+                                                         {'name': 'b', 'image': 'y', 'depends_on': ['a']}]},
+                                         shepherd.docker.api, '1g')
+
+        with pytest.raises(Exception):
+            shepherd.resolve_launch_order(list(zip(['x', 'y'], circular.containers)))
+
+        with pytest.raises(Exception):
+            FlockTemplate.compile({'name': 'invalid',
+                                   'containers': [{'name': 'a', 'image': 'x', 'depends_on': ['d']}]},
+                                  shepherd.docker.api, '1g')
+
+    def test_templates_not_modified(self, shepherd):
+        # specs not modified by launch
+        assert shepherd.flocks['test_1']['containers'][1]['ports'] == {'port_a': '8200/udp', 'port_b': 9356}
+
+        template = shepherd.templates['test_1'].get_container('busybox')
+        assert template.ports == (('port_a', '8200/udp'), ('port_b', '9356/tcp'))
+        assert template.port_values == (('8200', 'udp'), ('9356', 'tcp'))
+
+        with pytest.raises(TypeError):
+            template.environment['FOO'] = 'BAR'
+
+        # nested config is copied for each launch
+        host_config = template.get_host_config(binds=['/tmp:/tmp'])
+        host_config['PortBindings']['8200/udp'][0]['HostPort'] = '1'
+        assert template.host_config['PortBindings']['8200/udp'] == [{'HostIp': '', 'HostPort': ''}]
+        assert 'Binds' not in template.host_config
+
+        networking_config = template.get_networking_config(shepherd.docker.networks.prepare_model({'Name': 'net'}))
+        networking_config['EndpointsConfig']['net']['Aliases'].append('other')
+        assert template.endpoint_config['Aliases'] == ['busybox']
+
     def test_stop(self, shepherd, docker_client):
         flock = TestShepherd.flock
         containers = flock['containers']
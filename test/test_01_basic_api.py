@@ -100,3 +100,12 @@ class TestBasicApi:
         assert res.json['success'] == True
 
 
+
+    def test_metrics(self):
+        res = self.client.get('/metrics')
+        text = res.data.decode('utf-8')
+
+        assert 'shepherd_pool_running{pool="test-pool"} 0' in text
+        assert 'shepherd_pool_admissions_total{pool="test-pool"}' in text
+        assert 'shepherd_start_flock_seconds_count' in text
+        assert 'shepherd_pool_queue_depth{pool="fixed-pool"}' in text
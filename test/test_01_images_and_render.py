@@ -52,6 +52,17 @@ class TestImages:
 
         assert set(res.json.keys()) == set(['busybox', 'exit0'])
 
+    def test_images_query_facets(self):
+        res = self.client.get('/api/images/test-images?caps.test=2&facets=caps.small,some')
+
+        assert set(res.json['images'].keys()) == set(['busybox', 'exit0'])
+        assert res.json['facets'] == {'caps.small': {'1': 2},
+                                      'some': {'Value': 2}}
+
+        res = self.client.get('/api/images/test-images?facets=caps.test')
+
+        assert res.json['facets'] == {'caps.test': {'2': 2, '3': 1, '4': 1}}
+
 
     def test_images_query_by_name(self):
         res = self.client.get('/api/images/test-images?id=alpine')
@@ -81,6 +92,33 @@ class TestImages:
 
         assert res.data == b'<html>test</html>'
 
+    def test_images_get_field_etag(self):
+        res = self.client.get('/api/images/test-images/alpine-derived/data_mime_b64')
+
+        etag = res.headers['ETag']
+        assert res.headers['Cache-Control'] == 'no-cache'
+
+        res = self.client.get('/api/images/test-images/alpine-derived/data_mime_b64',
+                              headers={'If-None-Match': etag})
+
+        assert res.status_code == 304
+        assert res.data == b''
+
+        res = self.client.get('/api/images/test-images/alpine-derived/data_mime_b64?v=' + etag.strip('"'))
+
+        assert res.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+        assert res.data == b'<html>test</html>'
+
+    def test_images_layer_report(self):
+        res = self.client.get('/api/images/test-images/layers')
+
+        # no new layers, all shared with base image
+        derived = res.json['images']['test-shepherd/alpine-derived']
+        assert derived['unique'] == 0
+        assert derived['shared'] == res.json['images']['test-shepherd/alpine']['size']
+
+        assert res.json['stored_size'] < res.json['total_size']
+
     def test_image_api(self, docker_client, redis):
         res = self.client.get('/api/request/alpine-derived/1996/http://example.com/path?foo=bar')
 
@@ -165,3 +203,33 @@ class TestImages:
 
         assert 'Not a valid image request.' in text
 
+
+
+# ============================================================================
+class TestBlobCache:
+    def test_spill_per_process(self, tmpdir):
+        from shepherd.blob_cache import BlobCache
+        import os
+
+        spill_dir = str(tmpdir)
+        value = 'data:text/plain,' + 'x' * 32
+
+        # another worker's cache sharing the same spill_dir
+        other = BlobCache(max_entries=1, spill_size=16, spill_dir=spill_dir)
+        other_dir = os.path.join(spill_dir, 'other')
+        other.get_process_dir = lambda: other_dir
+        other_blob = other.get('sha256:a', 'field', value)
+
+        cache = BlobCache(max_entries=1, spill_size=16, spill_dir=spill_dir)
+        blob = cache.get('sha256:a', 'field', value)
+        assert os.path.dirname(blob.path) == os.path.join(spill_dir, str(os.getpid()))
+        assert blob.digest == other_blob.digest
+
+        # evicting the same content only removes this process's file
+        cache.get('sha256:b', 'field', 'data:text/plain,' + 'y' * 32)
+        assert not os.path.isfile(blob.path)
+        assert os.path.isfile(other_blob.path)
+
+        cache.close()
+        assert not os.path.isdir(cache.get_process_dir())
+        assert os.path.isfile(other_blob.path)
@@ -1,5 +1,6 @@
 from gevent.monkey import patch_all; patch_all()
 import pytest
+import time
 from utils import sleep_try
 
 
@@ -17,6 +18,9 @@ class TestTimedPoolApi:
         assert redis.scard('p:test-pool:f') == 1
         assert redis.ttl('p:test-pool:rq:'+ reqid) <= 1.0
 
+        # expiry deadline indexed
+        assert redis.zscore('p:test-pool:dl', reqid) > time.time()
+
         TestTimedPoolApi.reqid = reqid
 
     def test_flock_still_running(self, redis):
@@ -30,6 +34,7 @@ class TestTimedPoolApi:
         def assert_done():
             assert not redis.exists('p:test-pool:rq:' + self.reqid)
             assert redis.scard('p:test-pool:f') == 0
+            assert redis.zscore('p:test-pool:dl', self.reqid) is None
 
         sleep_try(0.2, 6.0, assert_done)
 
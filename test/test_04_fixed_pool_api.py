@@ -2,6 +2,7 @@ from gevent.monkey import patch_all; patch_all()
 import pytest
 
 from shepherd.wsgi import create_app
+from shepherd.pool import FixedSizePool
 from utils import sleep_try
 
 
@@ -44,6 +45,7 @@ class TestFixedPoolApi:
 
     def delete_reqid(self, redis, reqid):
         redis.delete('p:fixed-pool:r:' + reqid)
+        redis.zadd('p:fixed-pool:qp', 0, reqid)
 
     def test_launch_3_requests_no_queue(self, redis):
         for x in range(1, 4):
@@ -160,3 +162,59 @@ class TestFixedPoolApi:
         assert res['queue'] == 4
 
 
+
+
+# ============================================================================
+@pytest.mark.usefixtures('shepherd')
+class TestFixedPoolReserve:
+    def test_reserve_slots(self, shepherd, redis):
+        pool = FixedSizePool('reserve-pool', shepherd, redis, duration=60, max_size=2)
+
+        try:
+            res = [pool.queue_or_reserve(reqid) for reqid in ('A', 'B', 'C', 'D')]
+            assert res == [pool.RESERVED, pool.RESERVED, 0, 1]
+
+            assert redis.scard('p:reserve-pool:f') == 2
+            assert pool.queue_or_reserve('A') == pool.RUNNING
+
+            # stale waiter removed
+            redis.zadd('p:reserve-pool:qp', 0, 'C')
+            assert pool.queue_or_reserve('D') == 0
+            assert redis.zscore('p:reserve-pool:qp', 'C') is None
+
+            # waiter with no ping time not removed
+            assert pool.queue_or_reserve('E') == 1
+            redis.zrem('p:reserve-pool:qp', 'D')
+            assert pool.queue_or_reserve('E') == 1
+
+            # still waiting, but no longer queued
+            redis.zrem('p:reserve-pool:q', 'D')
+            assert redis.get('p:reserve-pool:r:D')
+            assert pool.queue_or_reserve('D') == 1
+            assert pool.queue_or_reserve('E') == 0
+
+            pool.remove_running('A')
+            assert pool.queue_or_reserve('E') == pool.RESERVED
+            assert pool.queue_or_reserve('D') == 0
+            pool.remove_queued('D')
+            assert redis.zcard('p:reserve-pool:q') == 0
+            assert redis.zcard('p:reserve-pool:qp') == 0
+
+        finally:
+            pool.running = False
+            redis.delete('p:reserve-pool:f', 'p:reserve-pool:i', 'p:reserve-pool:qp',
+                         'p:reserve-pool:q',
+                         *['p:reserve-pool:r:' + reqid for reqid in ('A', 'B', 'C', 'D', 'E')])
+
+    def test_queued_without_ping_time(self, shepherd, redis):
+        # queued by an earlier version
+        redis.zadd('p:ping-pool:q', 1, 'A')
+
+        pool = FixedSizePool('ping-pool', shepherd, redis, duration=60, max_size=1)
+
+        try:
+            assert redis.zscore('p:ping-pool:qp', 'A') is not None
+
+        finally:
+            pool.running = False
+            redis.delete('p:ping-pool:i', 'p:ping-pool:q', 'p:ping-pool:qp')
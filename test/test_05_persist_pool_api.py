@@ -94,7 +94,7 @@ class TestPersistPoolApi:
             assert len(persist_pool.start_events) == 6
             assert len(persist_pool.stop_events) == 0
 
-            assert redis.llen('p:{0}:wq'.format(persist_pool.name)) == 0
+            assert redis.zcard('p:{0}:wz'.format(persist_pool.name)) == 0
             assert redis.scard('p:{0}:f'.format(persist_pool.name)) == 3
 
         sleep_try(0.2, 5.0, assert_done)
@@ -107,7 +107,7 @@ class TestPersistPoolApi:
             assert res['queue'] == x - 1
             assert redis.scard('p:{0}:f'.format(persist_pool.name)) == 3
 
-            assert redis.llen('p:{0}:wq'.format(persist_pool.name)) == x
+            assert redis.zcard('p:{0}:wz'.format(persist_pool.name)) == x
             assert redis.scard('p:{0}:ws'.format(persist_pool.name)) == x
 
             # ensure double start doesn't move position
@@ -117,9 +117,9 @@ class TestPersistPoolApi:
         for x in range(1, 10):
             time.sleep(2.1)
 
-            llen = redis.llen('p:{0}:wq'.format(persist_pool.name))
+            zcard = redis.zcard('p:{0}:wz'.format(persist_pool.name))
             scard = redis.scard('p:{0}:ws'.format(persist_pool.name))
-            assert llen in (2, 3)
+            assert zcard in (2, 3)
             assert scard in (2, 3)
 
         def assert_done():
@@ -158,7 +158,7 @@ class TestPersistPoolApi:
         def assert_done():
             assert redis.scard('p:{0}:f'.format(persist_pool.name)) == 0
 
-            assert redis.llen('p:{0}:wq'.format(persist_pool.name)) == 0
+            assert redis.zcard('p:{0}:wz'.format(persist_pool.name)) == 0
             assert redis.scard('p:{0}:ws'.format(persist_pool.name)) == 0
             assert redis.scard('p:{0}:a'.format(persist_pool.name)) == 0
 
@@ -0,0 +1,134 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import docker
+from mock import patch
+
+from shepherd.wsgi import create_app
+from utils import sleep_try
+
+from conftest import TEST_DIR, TEST_IMAGES, get_pool_types
+import os
+
+TEST_SPARES_POOLS = os.path.join(TEST_DIR, 'test_pools_spares.yaml')
+
+
+@pytest.fixture(scope='module')
+def app(shepherd):
+    with patch('shepherd.pool.get_pool_types', get_pool_types):
+        wsgi_app = create_app(shepherd, TEST_SPARES_POOLS, TEST_IMAGES, template_folder=TEST_DIR)
+
+    yield wsgi_app
+
+    wsgi_app.close()
+
+
+# ============================================================================
+@pytest.mark.usefixtures('client_class', 'docker_client')
+class TestWarmSparesPool:
+    def test_spares_started(self, redis):
+        def assert_done():
+            assert redis.llen('p:spares-pool:sp') == 2
+
+        sleep_try(0.2, 10.0, assert_done)
+
+        TestWarmSparesPool.spares = redis.lrange('p:spares-pool:sp', 0, -1)
+
+    def test_assign_spare(self, redis, shepherd, docker_client):
+        res = self.client.post('/api/flock/request/test_b', json={'user_params': {'a': 'b'}})
+        reqid = res.json['reqid']
+
+        res = self.client.post('/api/flock/start/' + reqid, json={'environ': {'NEW': 'VALUE'}})
+        assert res.json['containers']['box']
+
+        # first spare assigned to this reqid
+        box = docker_client.containers.get(res.json['containers']['box']['id'])
+        assert box.labels[shepherd.reqid_label] == self.spares[0]
+
+        assert shepherd.resolve_alias(self.spares[0]) == reqid
+        assert shepherd.is_valid_flock(self.spares[0])
+
+        assert redis.scard('p:spares-pool:f') == 1
+
+        # same response on repeated start
+        new_res = self.client.post('/api/flock/start/' + reqid)
+        assert res.json == new_res.json
+
+        TestWarmSparesPool.reqid = reqid
+        TestWarmSparesPool.containers = res.json['containers']
+
+    def test_spare_refilled(self, redis):
+        def assert_done():
+            assert redis.llen('p:spares-pool:sp') == 2
+            assert self.spares[0] not in redis.lrange('p:spares-pool:sp', 0, -1)
+
+        sleep_try(0.2, 10.0, assert_done)
+
+    def test_different_flock_not_assigned(self, redis):
+        res = self.client.post('/api/flock/request/test_deferred')
+        reqid = res.json['reqid']
+
+        res = self.client.post('/api/flock/start/' + reqid)
+        assert res.json['containers']['box-1']
+
+        assert redis.llen('p:spares-pool:sp') == 2
+
+        res = self.client.post('/api/flock/remove/' + reqid)
+        assert res.json['success']
+
+    def test_remove_assigned(self, redis, docker_client):
+        res = self.client.post('/api/flock/remove/' + self.reqid)
+        assert res.json['success']
+
+        for container in self.containers.values():
+            with pytest.raises(docker.errors.NotFound):
+                docker_client.containers.get(container['id'])
+
+        assert not redis.exists('req:' + self.reqid)
+        assert not redis.exists('req:' + self.spares[0])
+
+
+# ============================================================================
+class TestSparesConfigChange:
+    @pytest.fixture
+    def pool(self):
+        from benchmarks.utils import make_shepherd
+        from shepherd.pool import create_pool
+
+        shepherd = make_shepherd()
+        pool = create_pool(shepherd, shepherd.redis,
+                           {'name': 'spares-bench', 'type': 'fixed', 'duration': 60,
+                            'max_size': 5, 'expire_check': 0.2,
+                            'warm_spares': 2, 'warm_flock': 'bench'})
+
+        yield pool
+
+        pool.shutdown()
+        shepherd.shutdown()
+
+    def get_spares(self, pool, exclude=()):
+        def assert_filled():
+            spares = pool.redis.lrange(pool.spares_key, 0, -1)
+            assert len(spares) == 2
+            assert not set(spares) & set(exclude)
+
+        sleep_try(0.1, 10.0, assert_filled)
+        return pool.redis.lrange(pool.spares_key, 0, -1)
+
+    def test_replace_stale_spares(self, pool):
+        spares = self.get_spares(pool)
+
+        chrome_opts = {'overrides': {'browser': 'bench/chrome'}}
+
+        # not matching the spares, left in place
+        reqid = pool.request('bench', chrome_opts)['reqid']
+        assert pool.assign_spare(reqid) is None
+        assert pool.redis.lrange(pool.spares_key, 0, -1) == spares
+
+        # warm config changed, spares replaced and matched against each spare
+        pool.warm_opts = chrome_opts
+        pool.spares_changed.set()
+        self.get_spares(pool, exclude=spares)
+
+        res = pool.assign_spare(reqid)
+        browser = pool.shepherd.docker.containers.get(res['containers']['browser']['id'])
+        assert browser.attrs['Config']['Image'] == 'bench/chrome'
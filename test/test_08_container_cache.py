@@ -0,0 +1,93 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import docker
+
+from shepherd.shepherd import Shepherd
+from shepherd.container_cache import ContainerCache
+from utils import sleep_try
+
+from conftest import TEST_FLOCKS, TEST_REQID_LABEL, TEST_NETWORK_LABEL, NETWORKS_NAME
+
+
+@pytest.fixture(scope='module')
+def cache_shepherd(redis):
+    shep = Shepherd(redis,
+                    reqid_label=TEST_REQID_LABEL,
+                    network_templ=NETWORKS_NAME,
+                    network_label=TEST_NETWORK_LABEL,
+                    untracked_check_time=0,
+                    container_cache_size=1)
+
+    shep.container_cache.fill_check = 0.2
+    shep.load_flocks(TEST_FLOCKS)
+
+    yield shep
+
+    shep.shutdown()
+
+
+# ============================================================================
+@pytest.mark.usefixtures('docker_client')
+class TestContainerCache(object):
+    def _count_precreated(self, docker_client):
+        return len(docker_client.containers.list(all=True,
+                                                 filters={'label': ContainerCache.PRECREATED_LABEL,
+                                                          'status': 'created'}))
+
+    def test_first_launch_not_cached(self, cache_shepherd, docker_client):
+        reqid = cache_shepherd.request_flock('test_b')['reqid']
+        res = cache_shepherd.start_flock(reqid)
+
+        box = docker_client.containers.get(res['containers']['box']['id'])
+        assert ContainerCache.PRECREATED_LABEL not in box.labels
+
+        assert cache_shepherd.remove_flock(reqid) == {'success': True}
+
+    def test_precreated(self, cache_shepherd, docker_client):
+        def assert_done():
+            assert self._count_precreated(docker_client) == 2
+
+        sleep_try(0.2, 10.0, assert_done)
+
+    def test_launch_adopt_precreated(self, cache_shepherd, docker_client, redis):
+        reqid = cache_shepherd.request_flock('test_b')['reqid']
+        res = cache_shepherd.start_flock(reqid)
+
+        box = docker_client.containers.get(res['containers']['box']['id'])
+        assert box.labels[ContainerCache.PRECREATED_LABEL] == cache_shepherd.container_cache.owner
+        assert box.name == 'box-' + reqid
+        assert box.status == 'running'
+
+        # only attached to flock network
+        assert list(box.attrs['NetworkSettings']['Networks'].keys()) == [res['network']]
+
+        # label id resolves to the flock reqid
+        assert cache_shepherd.resolve_alias(box.labels[TEST_REQID_LABEL]) == reqid
+        assert cache_shepherd.is_valid_flock(box.labels[TEST_REQID_LABEL])
+
+        assert cache_shepherd.remove_flock(reqid) == {'success': True}
+
+        for info in res['containers'].values():
+            with pytest.raises(docker.errors.NotFound):
+                docker_client.containers.get(info['id'])
+
+        assert redis.keys('req:*') == []
+
+    def test_environ_not_cached(self, cache_shepherd, docker_client):
+        reqid = cache_shepherd.request_flock('test_b', {'environ': {'FOO': 'BAR'}})['reqid']
+        res = cache_shepherd.start_flock(reqid)
+
+        box = docker_client.containers.get(res['containers']['box']['id'])
+        assert ContainerCache.PRECREATED_LABEL not in box.labels
+
+        assert cache_shepherd.remove_flock(reqid) == {'success': True}
+
+    def test_shutdown_removes_precreated(self, cache_shepherd, docker_client):
+        def assert_done():
+            assert self._count_precreated(docker_client) == 2
+
+        sleep_try(0.2, 10.0, assert_done)
+
+        cache_shepherd.container_cache.shutdown()
+
+        assert self._count_precreated(docker_client) == 0
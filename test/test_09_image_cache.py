@@ -0,0 +1,62 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+from mock import patch
+
+from utils import sleep_try
+
+
+# ============================================================================
+@pytest.mark.usefixtures('docker_client', 'shepherd')
+class TestImageCache(object):
+    def test_cached_meta(self, shepherd, docker_client):
+        cache = shepherd.image_cache
+
+        meta = cache.get('test-shepherd/busybox')
+        image = docker_client.images.get('test-shepherd/busybox')
+
+        assert meta.id == image.id
+        assert meta.labels['test.isbusybox'] == '1'
+        assert list(meta.layers) == image.attrs['RootFS']['Layers']
+
+        # same cached instance
+        assert cache.get('test-shepherd/busybox:latest') is meta
+
+    def test_not_found_cached(self, shepherd):
+        assert shepherd.image_cache.get('test-shepherd/cache-test') is None
+        assert shepherd.image_cache.images['test-shepherd/cache-test:latest'][0] is None
+
+    def test_tag_event_invalidates(self, shepherd, docker_client):
+        cache = shepherd.image_cache
+
+        alpine = docker_client.images.get('test-shepherd/alpine')
+        busybox = docker_client.images.get('test-shepherd/busybox')
+
+        alpine.tag('test-shepherd/cache-test')
+
+        def assert_alpine():
+            assert cache.get_id('test-shepherd/cache-test') == alpine.id
+
+        sleep_try(0.2, 5.0, assert_alpine)
+
+        busybox.tag('test-shepherd/cache-test')
+
+        def assert_busybox():
+            assert cache.get_id('test-shepherd/cache-test') == busybox.id
+
+        sleep_try(0.2, 5.0, assert_busybox)
+
+        docker_client.images.remove('test-shepherd/cache-test')
+
+        def assert_removed():
+            assert cache.get('test-shepherd/cache-test') is None
+
+        sleep_try(0.2, 5.0, assert_removed)
+
+    def test_request_flock_uses_cache(self, shepherd):
+        shepherd.image_cache.get('test-shepherd/alpine-derived')
+
+        # no daemon lookup for known image
+        with patch.object(shepherd.docker.images, 'get', side_effect=Exception('images.get called')):
+            res = shepherd.request_flock('test_1', {'overrides': {'base-alpine': 'test-shepherd/alpine-derived'}})
+
+        assert res['reqid']
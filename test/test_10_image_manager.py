@@ -0,0 +1,82 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import gevent
+from mock import patch
+
+
+# ============================================================================
+@pytest.mark.usefixtures('docker_client', 'shepherd')
+class TestImageManager(object):
+    def test_single_flight_pull(self, shepherd, docker_client):
+        manager = shepherd.image_manager
+
+        image = docker_client.images.get('test-shepherd/alpine')
+        calls = []
+
+        def slow_pull(repo, tag=None):
+            calls.append((repo, tag))
+            gevent.sleep(0.5)
+            return image
+
+        with patch.object(shepherd.docker.images, 'pull', side_effect=slow_pull):
+            jobs = [gevent.spawn(manager.pull, 'test-shepherd/pull-test') for _ in range(4)]
+            gevent.joinall(jobs, raise_error=True)
+
+        assert calls == [('test-shepherd/pull-test', 'latest')]
+        assert all(job.value == image for job in jobs)
+        assert manager.pulls == {}
+
+    def test_launch_recorded(self, shepherd, redis):
+        reqid = shepherd.request_flock('test_b')['reqid']
+        res = shepherd.start_flock(reqid)
+
+        assert res['containers']['box']
+        assert redis.zscore(shepherd.image_manager.LAUNCH_KEY, 'test-shepherd/busybox:latest')
+
+        assert shepherd.remove_flock(reqid) == {'success': True}
+
+    def test_collect_lru(self, shepherd, docker_client, redis):
+        manager = shepherd.image_manager
+
+        exit0 = docker_client.images.get('test-shepherd/exit0')
+        alpine_derived = docker_client.images.get('test-shepherd/alpine-derived')
+
+        redis.zadd(manager.LAUNCH_KEY, 100, 'test-shepherd/exit0:latest')
+        redis.zadd(manager.LAUNCH_KEY, 200, 'test-shepherd/alpine-derived:latest')
+
+        df = {'LayersSize': 3000,
+              'Images': [{'Id': exit0.id, 'Size': 1000, 'SharedSize': 0,
+                          'RepoTags': ['test-shepherd/exit0:latest'], 'Containers': 0},
+                         {'Id': alpine_derived.id, 'Size': 1000, 'SharedSize': 0,
+                          'RepoTags': ['test-shepherd/alpine-derived:latest'], 'Containers': 0}]}
+
+        manager.disk_budget = 2500
+
+        try:
+            with patch.object(shepherd.docker, 'df', return_value=df):
+                with patch.object(shepherd.docker.images, 'remove') as remove:
+                    removed = manager.collect()
+
+        finally:
+            manager.disk_budget = 0
+
+        # least recently launched image removed until under budget
+        assert removed == [exit0.id]
+        remove.assert_called_once_with('test-shepherd/exit0:latest')
+
+        assert redis.zscore(manager.EVICTED_KEY, 'test-shepherd/exit0:latest')
+        assert 'test-shepherd/exit0:latest' not in manager.get_prefetch_images()
+
+        # prefetched again once launched
+        manager.record_launch('test-shepherd/exit0')
+        assert redis.zscore(manager.EVICTED_KEY, 'test-shepherd/exit0:latest') is None
+
+    def test_split_tag(self):
+        from shepherd.image_manager import ImageManager
+
+        assert ImageManager.split_tag('test-shepherd/busybox') == ('test-shepherd/busybox', 'latest')
+        assert ImageManager.split_tag('localhost:5000/busybox:1.0') == ('localhost:5000/busybox', '1.0')
+
+        digest = 'sha256:' + 'a' * 64
+        assert ImageManager.split_tag('localhost:5000/busybox@' + digest) == ('localhost:5000/busybox', digest)
+        assert ImageManager.split_tag('busybox:1.0@' + digest) == ('busybox', digest)
@@ -0,0 +1,175 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import gevent
+import gevent.event
+
+from shepherd.event_bus import EventBus
+
+from utils import sleep_try
+
+
+def make_event(type_, action, id_, time_nano, attrs=None):
+    return {'Type': type_, 'Action': action, 'status': action, 'id': id_,
+            'timeNano': time_nano,
+            'Actor': {'ID': id_, 'Attributes': attrs or {}}}
+
+
+# ============================================================================
+class TestEventBus(object):
+    @pytest.fixture
+    def bus(self, redis):
+        bus = EventBus(None, redis, cursor_key='test:ev:since')
+        # don't connect to docker, events are dispatched directly
+        bus.running = True
+        yield bus
+        bus.shutdown()
+
+    def test_dispatch_by_pool(self, bus):
+        pool_a = []
+        pool_b = []
+        images = []
+
+        bus.subscribe(pool_a.append, pool='a')
+        bus.subscribe(pool_b.append, pool='b')
+        bus.subscribe(images.append, type_='image')
+
+        bus.dispatch(make_event('container', 'start', 'c1', 100, {EventBus.POOL_NAME_LABEL: 'a'}))
+        bus.dispatch(make_event('container', 'die', 'c2', 101, {EventBus.POOL_NAME_LABEL: 'b'}))
+        bus.dispatch(make_event('image', 'tag', 'i1', 102))
+
+        gevent.sleep(0.1)
+
+        assert [event['id'] for event in pool_a] == ['c1']
+        assert [event['id'] for event in pool_b] == ['c2']
+        assert [event['id'] for event in images] == ['i1']
+
+    def test_replay_skips_seen(self, bus, redis):
+        events = []
+        bus.subscribe(events.append, pool='a')
+
+        attrs = {EventBus.POOL_NAME_LABEL: 'a'}
+
+        bus.dispatch(make_event('container', 'start', 'c1', 200, attrs))
+        bus.dispatch(make_event('container', 'die', 'c1', 300, attrs))
+        bus.save_cursor(force=True)
+
+        assert redis.get('test:ev:since') == '300'
+        assert bus.get_since() == '0.000000300'
+
+        # replayed from cursor
+        bus.dispatch(make_event('container', 'start', 'c1', 200, attrs))
+        bus.dispatch(make_event('container', 'die', 'c1', 300, attrs))
+        bus.dispatch(make_event('container', 'die', 'c2', 300, attrs))
+
+        gevent.sleep(0.1)
+
+        assert [(event['id'], event['Action']) for event in events] == [('c1', 'start'), ('c1', 'die'), ('c2', 'die')]
+
+    def test_slow_subscriber_bounded(self, bus):
+        fast = []
+        bus.subscribe(fast.append, pool='a')
+
+        bus.queue_size = 2
+        slow = bus.subscribe(lambda event: gevent.sleep(10), pool='a')
+
+        for i in range(5):
+            bus.dispatch(make_event('container', 'start', 'c' + str(i), 400 + i,
+                                    {EventBus.POOL_NAME_LABEL: 'a'}))
+
+            # first event now being handled
+            if i == 0:
+                gevent.sleep(0.1)
+
+        gevent.sleep(0.1)
+
+        assert len(fast) == 5
+        assert slow.queue.qsize() == 2
+        assert slow.dropped == 2
+
+    def test_resync_after_dropped(self, bus):
+        events = []
+        release = gevent.event.Event()
+
+        def handle(event):
+            events.append(event and event['id'])
+            release.wait()
+
+        bus.queue_size = 2
+        sub = bus.subscribe(handle, pool='a')
+
+        for i in range(5):
+            bus.dispatch(make_event('container', 'die', 'c' + str(i), 500 + i,
+                                    {EventBus.POOL_NAME_LABEL: 'a'}))
+
+            if i == 0:
+                gevent.sleep(0.1)
+
+        release.set()
+        gevent.sleep(0.1)
+
+        # None sent once, before the next event after the drop
+        assert events == ['c0', None, 'c3', 'c4']
+        assert sub.dropped == 2
+        assert not sub.needs_resync
+
+    def test_cursor_per_process(self, redis):
+        import os
+        import socket
+
+        bus = EventBus(None, redis)
+        assert bus.cursor_key == 'shep:ev:since:{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+        other = EventBus(None, redis, cursor_id='other')
+        assert other.cursor_key == 'shep:ev:since:other'
+
+        bus.cursor = 100
+        other.cursor = 200
+        bus.save_cursor(force=True)
+        other.save_cursor(force=True)
+
+        assert redis.ttl(bus.cursor_key) > 0
+
+        # clean shutdown only removes its own cursor
+        bus.shutdown()
+        assert redis.get(bus.cursor_key) is None
+        assert redis.get(other.cursor_key) == '200'
+
+        other.shutdown()
+
+
+# ============================================================================
+class TestPoolResync(object):
+    def test_missed_die_event(self):
+        from benchmarks.utils import make_shepherd
+        from shepherd.pool import LaunchAllPool
+
+        shepherd = make_shepherd()
+        redis = shepherd.redis
+        pool = LaunchAllPool('resync-pool', shepherd, redis, duration=60, expire_check=0.1)
+
+        try:
+            reqid = pool.request('bench', {})['reqid']
+            res = pool.start(reqid)
+
+            other = pool.request('bench', {})['reqid']
+            pool.start(other)
+
+            # exited without a die event
+            container = shepherd.docker.get_container(res['containers']['browser']['id'])
+            container.attrs['State']['Status'] = 'exited'
+            container.attrs['State']['ExitCode'] = 137
+
+            pool.handle_event(None)
+
+            assert not redis.exists(pool.req_key + reqid)
+            assert redis.exists(pool.req_key + other)
+
+            def assert_expired():
+                assert not pool.is_running(reqid)
+
+            sleep_try(0.1, 2.0, assert_expired)
+            assert pool.is_running(other)
+
+        finally:
+            pool.shutdown()
+            shepherd.shutdown()
@@ -0,0 +1,77 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import docker
+from mock import patch
+
+from utils import sleep_try
+
+
+# ============================================================================
+@pytest.mark.usefixtures('docker_client', 'shepherd')
+class TestStateMirror(object):
+    def test_start_flock_mirrored(self, shepherd):
+        reqid = shepherd.request_flock('test_b')['reqid']
+        res = shepherd.start_flock(reqid)
+
+        TestStateMirror.reqid = reqid
+        TestStateMirror.box_id = res['containers']['box']['id']
+
+        # no daemon label scan
+        with patch.object(shepherd.docker.containers, 'list', side_effect=Exception('containers.list called')):
+            containers = shepherd.get_flock_containers(shepherd.resolve_flock_req(reqid))
+
+        assert len(containers) == 2
+        assert all(container.status == 'running' for container in containers)
+
+        assert res['network'] in shepherd.state.networks
+
+    def test_external_remove(self, shepherd, docker_client):
+        docker_client.containers.get(self.box_id).remove(force=True)
+
+        def assert_removed():
+            containers = shepherd.state.get_containers(self.reqid)
+            assert len(containers) == 1
+
+        sleep_try(0.2, 5.0, assert_removed)
+
+    def test_remove_flock(self, shepherd):
+        network = shepherd.resolve_flock_req(self.reqid).get_network()
+
+        assert shepherd.remove_flock(self.reqid) == {'success': True}
+
+        assert shepherd.state.get_containers(self.reqid) == []
+
+        def assert_network_removed():
+            assert network not in shepherd.state.networks
+
+        sleep_try(0.2, 5.0, assert_network_removed)
+
+    def test_remove_by_container_ids(self, shepherd, docker_client):
+        reqid = shepherd.request_flock('test_b')['reqid']
+        res = shepherd.start_flock(reqid)
+
+        flock_req = shepherd.resolve_flock_req(reqid)
+        container_ids = flock_req.get_container_ids()
+
+        assert set(container_ids.keys()) == {'box', 'box-2'}
+        assert container_ids['box'].startswith(res['containers']['box']['id'])
+
+        # removed by id even if not (yet) mirrored
+        shepherd.state.containers = {}
+        shepherd.state.by_reqid = {}
+
+        assert shepherd.remove_flock(reqid) == {'success': True}
+
+        for container_id in container_ids.values():
+            with pytest.raises(docker.errors.NotFound):
+                docker_client.containers.get(container_id)
+
+    def test_resync(self, shepherd):
+        shepherd.state.containers = {}
+        shepherd.state.by_reqid = {}
+
+        shepherd.state.resync()
+
+        # only containers with reqid label
+        for container in shepherd.state.list_containers():
+            assert container.labels[shepherd.reqid_label]
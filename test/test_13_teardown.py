@@ -0,0 +1,150 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import docker
+import gevent
+import time
+
+from utils import sleep_try
+
+
+# ============================================================================
+@pytest.mark.usefixtures('docker_client', 'shepherd')
+class TestTeardown(object):
+    def test_remove_async(self, shepherd, redis, docker_client):
+        reqid = shepherd.request_flock('test_b')['reqid']
+        res = shepherd.start_flock(reqid)
+
+        assert shepherd.remove_flock(reqid, sync=False) == {'success': True}
+
+        # tombstoned until removal is finished
+        assert redis.hget('req:' + reqid, 'state') == 'removing'
+        assert not redis.hexists('req:' + reqid, 'resp')
+
+        def assert_removed():
+            assert not redis.exists('req:' + reqid)
+
+            for container in res['containers'].values():
+                with pytest.raises(docker.errors.NotFound):
+                    docker_client.containers.get(container['id'])
+
+            with pytest.raises(docker.errors.NotFound):
+                docker_client.networks.get(res['network'])
+
+        sleep_try(0.2, 10.0, assert_removed)
+
+    def test_restart_waits_for_teardown(self, shepherd, redis, docker_client):
+        reqid = shepherd.request_flock('test_b')['reqid']
+        res = shepherd.start_flock(reqid)
+
+        assert shepherd.remove_flock(reqid, keep_reqid=True, sync=False) == {'success': True}
+        assert shepherd.teardown.is_pending(reqid)
+
+        # same container names, only started once previous containers are removed
+        new_res = shepherd.start_flock(reqid)
+        assert 'error' not in new_res
+        assert new_res['containers']['box']['id'] != res['containers']['box']['id']
+
+        assert not shepherd.teardown.is_pending(reqid)
+
+        assert shepherd.remove_flock(reqid) == {'success': True}
+
+        for container in new_res['containers'].values():
+            with pytest.raises(docker.errors.NotFound):
+                docker_client.containers.get(container['id'])
+
+    def test_concurrency_limit(self, shepherd):
+        active = [0]
+        max_active = [0]
+
+        def task():
+            active[0] += 1
+            max_active[0] = max(max_active[0], active[0])
+            gevent.sleep(0.05)
+            active[0] -= 1
+
+        rate = shepherd.teardown.rate
+        shepherd.teardown.rate = 10000
+
+        try:
+            jobs = [shepherd.teardown.submit(task) for x in range(0, 20)]
+            for job in jobs:
+                job.get()
+        finally:
+            shepherd.teardown.rate = rate
+
+        assert max_active[0] == shepherd.teardown.concurrency
+
+    def test_rate_limit(self, shepherd):
+        rate = shepherd.teardown.rate
+        shepherd.teardown.rate = 10
+
+        try:
+            start = time.time()
+            jobs = [shepherd.teardown.submit(lambda: None) for x in range(0, 6)]
+            for job in jobs:
+                job.get()
+        finally:
+            shepherd.teardown.rate = rate
+
+        assert time.time() - start >= 0.5
+
+    def test_graceful_stop_not_holding_workers(self, shepherd):
+        stopped = []
+
+        def stop_container(container, grace_time=0):
+            gevent.sleep(0.5)
+            stopped.append((container, grace_time))
+
+        teardown = shepherd.teardown
+        rate = teardown.rate
+        teardown.rate = 10000
+
+        orig_stop = shepherd._stop_container
+        shepherd._stop_container = stop_container
+        try:
+            start = time.time()
+            count = teardown.concurrency * 2
+            jobs = teardown.stop_containers(list(range(0, count)), 60)
+            stops = [job.get() for job in jobs]
+
+            # workers free while containers are stopping
+            assert teardown.submit(lambda: True).get(timeout=0.2)
+            assert stopped == []
+
+            gevent.joinall(stops)
+            assert time.time() - start < 1.0
+
+        finally:
+            teardown.rate = rate
+            shepherd._stop_container = orig_stop
+
+        assert sorted(stopped) == [(x, teardown.max_grace_time) for x in range(0, count)]
+
+    def test_remove_volumes_async(self, shepherd):
+        calls = []
+
+        def remove_volumes(flock_req):
+            calls.append(flock_req.reqid)
+            if len(calls) < 2:
+                raise Exception('volume in use')
+
+            return True
+
+        orig_remove = shepherd.remove_flock_volumes
+        shepherd.remove_flock_volumes = remove_volumes
+        try:
+            from shepherd.flock import FlockRequest
+            flock_req = FlockRequest('test-volumes')
+
+            # returns right away, retried with backoff in the background
+            start = time.time()
+            result = shepherd.teardown.remove_volumes(flock_req)
+            assert time.time() - start < 0.5
+            assert shepherd.teardown.is_pending('test-volumes')
+
+            assert result.get(timeout=10) == {'success': True}
+            assert calls == ['test-volumes', 'test-volumes']
+            assert not shepherd.teardown.is_pending('test-volumes')
+
+        finally:
+            shepherd.remove_flock_volumes = orig_remove
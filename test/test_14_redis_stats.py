@@ -0,0 +1,108 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+
+from shepherd.flock import FlockRequest
+from shepherd.redis_stats import RedisStats
+
+
+# ============================================================================
+class TestRedisStats(object):
+    def test_count_by_context(self, redis):
+        stats = RedisStats()
+        counted = stats.wrap(redis)
+
+        stats.set_context('start_flock')
+        counted.set('test:stats:a', '1')
+        counted.get('test:stats:a')
+
+        pi = counted.pipeline()
+        pi.set('test:stats:b', '2').expire('test:stats:b', 10)
+        pi.sadd('test:stats:c', 'x')
+        assert pi.execute() == [True, True, 1]
+
+        stats.set_context(None)
+        counted.get('test:stats:a')
+
+        res = stats.get_stats()
+        assert res['start_flock']['requests'] == 1
+        assert res['start_flock']['calls'] == 3
+        assert res['start_flock']['calls_per_request'] == 3
+        assert set(res['start_flock']['commands']) == {'set', 'get', 'pipeline'}
+
+        assert res['background']['calls'] == 1
+
+        stats.reset()
+        assert stats.get_stats() == {}
+
+        redis.delete('test:stats:a', 'test:stats:b', 'test:stats:c')
+
+    def test_flock_save_single_call(self, redis):
+        stats = RedisStats()
+        counted = stats.wrap(redis)
+
+        flock_req = FlockRequest('test-stats').init_new('test_b', {})
+        flock_req.save(counted, expire=10)
+        flock_req.save(counted)
+
+        # full save rewrites the hash and clears ttl in one round trip
+        assert redis.ttl(flock_req.key) == -1
+        commands = stats.get_stats()['background']['commands']
+        assert list(commands.keys()) == ['pipeline']
+        assert commands['pipeline']['calls'] == 2
+
+        flock_req.delete(redis)
+
+    def test_app_counts_all_subsystems(self):
+        from shepherd.wsgi import create_app
+        from benchmarks.utils import make_shepherd, BENCH_POOLS, BENCH_IMAGE_CONFIG
+
+        shepherd = make_shepherd()
+        app = create_app(shepherd, BENCH_POOLS, BENCH_IMAGE_CONFIG)
+        client = app.test_client()
+
+        try:
+            assert app.redis_stats is shepherd.redis_stats
+            assert shepherd.event_bus.redis is shepherd.redis
+            assert shepherd.image_manager.redis is shepherd.redis
+            assert shepherd.response_cache.redis is shepherd.redis
+
+            counted = []
+            record = app.redis_stats.record
+            app.redis_stats.record = lambda command, elapsed: counted.append(command) or record(command, elapsed)
+
+            # redis calls made by the trace store and image manager while starting
+            during = {}
+            for obj, name in ((shepherd.traces, 'finish'), (shepherd.image_manager, 'record_launch')):
+                def wrap(func, name=name):
+                    def call(*args, **kwargs):
+                        start = len(counted)
+                        res = func(*args, **kwargs)
+                        during[name] = during.get(name, 0) + len(counted) - start
+                        return res
+
+                    return call
+
+                setattr(obj, name, wrap(getattr(obj, name)))
+
+            reqid = client.post('/api/request/browser', json={}).json['reqid']
+            assert 'containers' in client.post('/api/flock/start/' + reqid, json={}).json
+
+            assert during['finish'] > 0
+            assert during['record_launch'] > 0
+            assert app.redis_stats.get_stats()['start_flock']['requests'] == 1
+
+        finally:
+            app.close()
+            shepherd.shutdown()
+
+    def test_requires_wrapped_client(self):
+        from shepherd.wsgi import create_app
+        from benchmarks.utils import make_shepherd, BENCH_POOLS, BENCH_IMAGE_CONFIG
+
+        shepherd = make_shepherd()
+        shepherd.redis = shepherd.redis.redis
+        try:
+            with pytest.raises(ValueError):
+                create_app(shepherd, BENCH_POOLS, BENCH_IMAGE_CONFIG, redis_stats=True)
+        finally:
+            shepherd.shutdown()
@@ -0,0 +1,104 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import json
+
+from shepherd.flock import FlockRequest
+
+
+# ============================================================================
+class TestFlockStorage(object):
+    ENVIRON = {'FOO': 'BAR', 'SOME': 'VALUE', 'REMOVED': '1'}
+
+    def make_resp(self):
+        environ = {'FOO': 'BAR', 'SOME': 'OTHER', 'EXTRA': '2'}
+        return {'containers': {'box': {'id': 'abc', 'ip': '10.0.0.2',
+                                       'environ': environ}},
+                'network': 'test-net'}
+
+    def test_round_trip(self, redis):
+        flock_req = FlockRequest('test-store').init_new('test_b', {'environ': self.ENVIRON})
+        flock_req.data['image_list'] = ['test-shepherd/busybox'] * 100
+        flock_req.set_network('test-net')
+        flock_req.add_container('box', 'abc')
+        flock_req.cache_response(self.make_resp(), redis)
+
+        # hot fields stored as plain hash fields
+        assert redis.hget(flock_req.key, 'state') == 'running'
+        assert redis.hget(flock_req.key, 'net') == 'test-net'
+        assert json.loads(redis.hget(flock_req.key, 'container_ids')) == {'box': 'abc'}
+
+        # large blob compressed
+        assert FlockRequest.unpack(redis.hget(flock_req.key, 'blob'))['image_list'][0] == 'test-shepherd/busybox'
+
+        loaded = FlockRequest('test-store')
+        assert loaded.load(redis)
+        assert loaded.get_state() == 'running'
+        assert loaded._packed
+
+        assert loaded.data == flock_req.data
+        assert loaded.get_cached_response() == self.make_resp()
+
+        flock_req.delete(redis)
+
+    def test_set_state_partial(self, redis):
+        flock_req = FlockRequest('test-store').init_new('test_b', {'environ': self.ENVIRON})
+        flock_req.save(redis, expire=30)
+        blob = redis.hget(flock_req.key, 'blob')
+
+        loaded = FlockRequest('test-store')
+        loaded.load(redis)
+        loaded.set_state('running', redis)
+
+        # not unpacked, other fields unchanged
+        assert loaded._packed
+        assert redis.hget(flock_req.key, 'state') == 'running'
+        assert redis.hget(flock_req.key, 'blob') == blob
+
+        # queue or request ttl cleared once launching
+        assert redis.ttl(flock_req.key) == -1
+
+        flock_req.delete(redis)
+
+    def test_resp_environ_diff(self, redis):
+        flock_req = FlockRequest('test-store').init_new('test_b', {'environ': self.ENVIRON})
+        flock_req.cache_response(self.make_resp(), redis)
+
+        box = FlockRequest.unpack(redis.hget(flock_req.key, 'resp'))['containers']['box']
+        assert 'environ' not in box
+        assert box['environ_diff'] == {'SOME': 'OTHER', 'EXTRA': '2'}
+        assert box['environ_del'] == ['REMOVED']
+
+        # response unchanged by later request environ update
+        flock_req.update_env({'FOO': 'NEW'}, redis, save=True)
+
+        loaded = FlockRequest('test-store')
+        loaded.load(redis)
+        assert loaded.data['environ']['FOO'] == 'NEW'
+        assert loaded.get_cached_response() == self.make_resp()
+
+        loaded.stop(redis)
+        assert not redis.hexists(flock_req.key, 'resp')
+        assert FlockRequest('test-store').load_cached_response(redis) is None
+
+        flock_req.delete(redis)
+
+    def test_migrate_json(self, redis):
+        data = {'id': 'test-old', 'flock': 'test_b', 'state': 'new',
+                'environ': self.ENVIRON, 'image_list': ['test-shepherd/busybox']}
+
+        redis.set('req:test-old', json.dumps(data), ex=30)
+
+        flock_req = FlockRequest('test-old')
+        assert flock_req.load(redis)
+        assert flock_req.data == data
+
+        assert redis.type('req:test-old') == 'hash'
+        assert redis.hget('req:test-old', 'flock') == 'test_b'
+        assert redis.ttl('req:test-old') > 0
+
+        flock_req.delete(redis)
+
+    def test_load_missing(self, redis):
+        flock_req = FlockRequest('test-missing')
+        assert not flock_req.load(redis)
+        assert flock_req.load_cached_response(redis) == {'error': 'invalid_reqid'}
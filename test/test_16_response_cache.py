@@ -0,0 +1,150 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import gevent
+
+from shepherd.flock import FlockRequest
+from shepherd.response_cache import ResponseCache
+
+from utils import sleep_try
+
+
+# ============================================================================
+class TestResponseCache(object):
+    RESP = {'containers': {'box': {'id': 'abc', 'ip': '10.0.0.2'}},
+            'network': 'test-net'}
+
+    @pytest.fixture
+    def cache(self, redis):
+        cache = ResponseCache(redis, size=2)
+
+        def assert_subscribed():
+            assert cache.subscribed
+
+        sleep_try(0.05, 1.0, assert_subscribed)
+        yield cache
+        cache.shutdown()
+
+    def start_req(self, reqid, redis):
+        flock_req = FlockRequest(reqid).init_new('test_b', {})
+        flock_req.cache_response(dict(self.RESP), redis)
+        return flock_req
+
+    def test_running_cached(self, cache, redis):
+        self.start_req('test-cache-a', redis)
+
+        assert FlockRequest('test-cache-a').load_cached_response(redis, cache=cache) == self.RESP
+        assert cache.misses == 1
+
+        # not loaded from redis again
+        flock_req = FlockRequest('test-cache-a')
+        assert cache.load(flock_req, None)
+        assert flock_req.get_cached_response() == self.RESP
+        assert cache.hits == 1
+
+        FlockRequest('test-cache-a').delete(redis)
+
+    def test_cached_copy_not_shared(self, cache, redis):
+        self.start_req('test-cache-d', redis)
+
+        flock_req = FlockRequest('test-cache-d')
+        assert cache.load(flock_req, redis)
+
+        # changes by one request not seen by the next
+        flock_req.data['environ']['FOO'] = 'BAR'
+        flock_req.add_container('box', 'abc')
+        flock_req.get_cached_response()['containers']['box']['ip'] = '10.0.0.3'
+
+        flock_req = FlockRequest('test-cache-d')
+        assert cache.load(flock_req, None)
+        assert flock_req.data['environ'] == {}
+        assert flock_req.get_container_ids() == {}
+        assert flock_req.get_cached_response() == self.RESP
+
+        flock_req.add_container('box', 'abc')
+        assert FlockRequest('test-cache-d').load_cached_response(None, cache=cache) == self.RESP
+        assert cache.entries['test-cache-d'][1].get('container_ids') is None
+
+        FlockRequest('test-cache-d').delete(redis)
+
+    def test_not_running_not_cached(self, cache, redis):
+        FlockRequest('test-cache-new').init_new('test_b', {}).save(redis)
+
+        assert FlockRequest('test-cache-new').load_cached_response(redis, cache=cache) is None
+        assert FlockRequest('test-cache-missing').load_cached_response(redis, cache=cache) == {'error': 'invalid_reqid'}
+        assert cache.entries == {}
+
+        FlockRequest('test-cache-new').delete(redis)
+
+    def test_invalidate_on_stop_and_delete(self, cache, redis):
+        def assert_evicted():
+            assert 'test-cache-b' not in cache.entries
+
+        flock_req = self.start_req('test-cache-b', redis)
+        assert cache.load(FlockRequest('test-cache-b'), redis)
+        assert 'test-cache-b' in cache.entries
+
+        flock_req.stop(redis)
+        sleep_try(0.05, 1.0, assert_evicted)
+
+        assert FlockRequest('test-cache-b').load_cached_response(redis, required=True, cache=cache) == {'error': 'not_running'}
+
+        flock_req = self.start_req('test-cache-b', redis)
+        assert cache.load(FlockRequest('test-cache-b'), redis)
+
+        flock_req.delete(redis)
+        sleep_try(0.05, 1.0, assert_evicted)
+
+        assert FlockRequest('test-cache-b').load_cached_response(redis, cache=cache) == {'error': 'invalid_reqid'}
+
+    def test_lru_size(self, cache, redis):
+        for reqid in ('test-cache-1', 'test-cache-2', 'test-cache-3'):
+            self.start_req(reqid, redis)
+            gevent.sleep(0.1)
+            assert cache.load(FlockRequest(reqid), redis)
+
+        assert list(cache.entries.keys()) == ['test-cache-2', 'test-cache-3']
+
+        for reqid in ('test-cache-1', 'test-cache-2', 'test-cache-3'):
+            FlockRequest(reqid).delete(redis)
+
+    def test_not_cached_if_invalidated_during_load(self, cache, redis):
+        self.start_req('test-cache-c', redis)
+
+        flock_req = FlockRequest('test-cache-c')
+        version = cache.version
+        flock_req.load(redis)
+
+        cache.invalidate('test-cache-c')
+        cache.put('test-cache-c', flock_req.data, version)
+
+        assert 'test-cache-c' not in cache.entries
+
+        flock_req.delete(redis)
+
+    def test_stop_flock_not_served_from_cache(self):
+        from benchmarks.utils import make_shepherd
+
+        shepherd = make_shepherd()
+        try:
+            def assert_subscribed():
+                assert shepherd.response_cache.subscribed
+
+            sleep_try(0.05, 1.0, assert_subscribed)
+
+            reqid = shepherd.request_flock('bench')['reqid']
+            assert 'containers' in shepherd.start_flock(reqid)
+
+            cache = shepherd.response_cache
+            assert FlockRequest(reqid).load_cached_response(shepherd.redis, cache=cache)
+            assert reqid in cache.entries
+
+            assert shepherd.stop_flock(reqid) == {'success': True}
+
+            flock_req = FlockRequest(reqid)
+            assert cache.load(flock_req, shepherd.redis)
+            assert flock_req.get_state() == 'stopped'
+            assert flock_req.get_cached_response() is None
+            assert not shepherd.redis.hexists(flock_req.key, 'resp')
+
+        finally:
+            shepherd.shutdown()
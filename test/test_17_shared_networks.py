@@ -0,0 +1,149 @@
+from gevent.monkey import patch_all; patch_all()
+import pytest
+import docker
+
+from shepherd.network_pool import NetworkPool, SharedNetworkPool, QuotaNetworkPool
+
+from utils import sleep_try
+
+
+@pytest.fixture(scope='module')
+def shared_networks(docker_client, redis, shepherd):
+    shared = SharedNetworkPool(docker_client, redis, target=2,
+                               network_templ='test-shared-pool-{0}',
+                               network_label=shepherd.network_pool.network_label,
+                               check_interval=0.2)
+    yield shared
+    shared.shutdown()
+
+
+# ============================================================================
+@pytest.mark.usefixtures('docker_client', 'shepherd')
+class TestSharedNetworks(object):
+    def assert_filled(self, redis):
+        def assert_idle():
+            assert redis.scard(SharedNetworkPool.IDLE_KEY) == 2
+
+        sleep_try(0.2, 5.0, assert_idle)
+
+    def test_prewarm(self, shared_networks, redis, docker_client):
+        self.assert_filled(redis)
+
+        for name in redis.smembers(SharedNetworkPool.IDLE_KEY):
+            assert docker_client.networks.get(name)
+            assert redis.hget(SharedNetworkPool.INFO_KEY + name, 'attrs')
+
+    def test_launch_with_quota(self, shared_networks, shepherd, redis, docker_client):
+        network_pool = QuotaNetworkPool(shared_networks, 'test-quota', quota=1,
+                                        fallback=shepherd.network_pool)
+
+        reqs = []
+        for x in range(0, 2):
+            reqid = shepherd.request_flock('test_b')['reqid']
+            res = shepherd.start_flock(reqid, network_pool=network_pool)
+            reqs.append((reqid, res['network']))
+
+        # first from shared pool, second over quota
+        assert reqs[0][1].startswith('test-shared-pool-')
+        assert not reqs[1][1].startswith('test-shared-pool-')
+        assert shared_networks.hits >= 1
+        assert shared_networks.quota_misses == 1
+
+        assert redis.smembers(SharedNetworkPool.LEASED_KEY.format('test-quota')) == {reqs[0][1]}
+
+        for reqid, network in reqs:
+            assert shepherd.remove_flock(reqid, network_pool=network_pool) == {'success': True}
+
+        assert redis.scard(SharedNetworkPool.LEASED_KEY.format('test-quota')) == 0
+
+        with pytest.raises(docker.errors.NotFound):
+            docker_client.networks.get(reqs[1][1])
+
+        self.assert_filled(redis)
+
+    def test_verify_removes_missing(self, shared_networks, redis, docker_client):
+        self.assert_filled(redis)
+
+        name = redis.srandmember(SharedNetworkPool.IDLE_KEY)
+        docker_client.networks.get(name).remove()
+
+        shared_networks.verify_interval = 0.01
+        try:
+            def assert_replaced():
+                assert not redis.sismember(SharedNetworkPool.IDLE_KEY, name)
+                assert redis.scard(SharedNetworkPool.IDLE_KEY) == 2
+
+            sleep_try(0.2, 5.0, assert_replaced)
+        finally:
+            shared_networks.verify_interval = SharedNetworkPool.VERIFY_INTERVAL
+
+    def test_shutdown(self, shared_networks, redis, docker_client):
+        names = redis.smembers(SharedNetworkPool.IDLE_KEY)
+        shared_networks.shutdown()
+
+        assert redis.scard(SharedNetworkPool.IDLE_KEY) == 0
+        for name in names:
+            with pytest.raises(docker.errors.NotFound):
+                docker_client.networks.get(name)
+
+
+# ============================================================================
+class TestLeases(object):
+    @pytest.fixture
+    def shared(self):
+        import fakeredis
+        from benchmarks.fake_docker import FakeDockerClient
+
+        redis = fakeredis.FakeStrictRedis(decode_responses=True)
+        redis.flushall()
+
+        shared = SharedNetworkPool(FakeDockerClient(), redis, target=3,
+                                   network_templ='test-leases-{0}',
+                                   check_interval=60, lease_timeout=10)
+
+        # filled and verified directly
+        shared.greenlet.kill()
+        shared.fill()
+        yield shared
+        shared.shutdown()
+
+    def test_verify_stale_leases(self, shared):
+        docker = shared.docker
+        redis = shared.redis
+        leased_key = SharedNetworkPool.LEASED_KEY.format('test-leases')
+
+        network_pool = QuotaNetworkPool(shared, 'test-leases', quota=3,
+                                        fallback=NetworkPool(docker))
+
+        removed = network_pool.create_network()
+        empty = network_pool.create_network()
+        used = network_pool.create_network()
+
+        docker.add_image('test/box')
+        container = docker.containers.get(docker.api.create_container('test/box')['Id'])
+        used.connect(container)
+
+        # like docker, a stopped container has no endpoint
+        docker.networks.get(used.name).attrs['Containers'].pop(container.id)
+
+        removed.remove()
+
+        # recently taken, not checked
+        shared.verify_leases()
+        assert redis.scard(leased_key) == 3
+
+        for network in (removed, empty, used):
+            redis.hset(SharedNetworkPool.INFO_KEY + network.name, 'taken', 0)
+
+        shared.verify_leases()
+
+        # stopped container still attached, lease kept
+        assert redis.smembers(leased_key) == {used.name}
+        assert float(redis.hget(SharedNetworkPool.INFO_KEY + used.name, 'in_use')) > 0
+
+        # empty network returned to the idle set
+        assert redis.sismember(SharedNetworkPool.IDLE_KEY, empty.name)
+
+        network_pool.shutdown()
+        assert redis.scard(leased_key) == 0
+        assert 'test-leases' not in shared.lease_pools
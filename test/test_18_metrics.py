@@ -0,0 +1,41 @@
+from shepherd.metrics import Metrics, Histogram
+
+
+# ============================================================================
+class TestMetrics(object):
+    def test_counters_and_collected(self):
+        metrics = Metrics()
+        metrics.inc('shepherd_pool_admissions_total', {'pool': 'a'})
+        metrics.inc('shepherd_pool_admissions_total', {'pool': 'a'})
+        metrics.inc('shepherd_pool_admissions_total', {'pool': 'b'})
+
+        text = metrics.render([('shepherd_pool_running', {'pool': 'a'}, 3)])
+        lines = text.split('\n')
+
+        assert '# TYPE shepherd_pool_admissions_total counter' in lines
+        assert 'shepherd_pool_admissions_total{pool="a"} 2' in lines
+        assert 'shepherd_pool_admissions_total{pool="b"} 1' in lines
+
+        assert '# TYPE shepherd_pool_running gauge' in lines
+        assert 'shepherd_pool_running{pool="a"} 3' in lines
+
+    def test_histogram(self):
+        metrics = Metrics()
+        for value in (0.02, 0.3, 0.3, 1000):
+            metrics.observe('shepherd_teardown_seconds', value)
+
+        lines = metrics.render().split('\n')
+
+        assert '# TYPE shepherd_teardown_seconds histogram' in lines
+        assert 'shepherd_teardown_seconds_bucket{le="0.01"} 0' in lines
+        assert 'shepherd_teardown_seconds_bucket{le="0.05"} 1' in lines
+        assert 'shepherd_teardown_seconds_bucket{le="0.5"} 3' in lines
+        assert 'shepherd_teardown_seconds_bucket{le="300"} 3' in lines
+        assert 'shepherd_teardown_seconds_bucket{le="+Inf"} 4' in lines
+        assert 'shepherd_teardown_seconds_count 4' in lines
+
+    def test_label_escape(self):
+        metrics = Metrics()
+        metrics.inc('shepherd_pool_expirations_total', {'pool': 'a"b'})
+
+        assert 'shepherd_pool_expirations_total{pool="a\\"b"} 1' in metrics.render()
@@ -0,0 +1,125 @@
+from gevent.monkey import patch_all; patch_all()
+
+import fakeredis
+import gevent
+import time
+
+from shepherd.trace import TraceStore, LaunchTrace
+
+
+# ============================================================================
+class TestTrace(object):
+    @classmethod
+    def setup_class(cls):
+        cls.redis = fakeredis.FakeStrictRedis(decode_responses=True)
+
+    def setup_method(self):
+        self.redis.flushall()
+
+    def make_trace(self, store, reqid, image='test-shepherd/busybox'):
+        trace = store.begin(reqid, 'start_flock')
+        with trace.span('create_network'):
+            pass
+
+        with trace.span('create_container', 'box', image):
+            time.sleep(0.01)
+
+        with trace.span('start_container', 'box', image):
+            pass
+
+        return trace
+
+    def test_spans_and_server_timing(self):
+        trace = self.make_trace(TraceStore(), 'abc')
+        trace.finish()
+
+        data = trace.to_dict()
+        assert data['reqid'] == 'abc'
+        assert [span['name'] for span in data['spans']] == ['create_network', 'create_container', 'start_container']
+        assert data['spans'][1]['container'] == 'box'
+        assert data['spans'][1]['duration'] >= 0.01
+        assert data['duration'] >= data['spans'][1]['duration']
+
+        timing = trace.get_server_timing().split(', ')
+        assert timing[0].startswith('create_network;dur=')
+        assert timing[-1].startswith('total;dur=')
+
+    def test_span_on_error(self):
+        trace = LaunchTrace('abc', 'start_flock')
+        try:
+            with trace.span('create_container', 'box'):
+                raise Exception('fail')
+        except Exception:
+            pass
+
+        assert trace.spans[0]['name'] == 'create_container'
+
+    def test_store_and_aggregate(self):
+        store = TraceStore(size=3)
+
+        for reqid in ('a', 'a', 'b', 'c', 'd'):
+            store.finish(self.make_trace(store, reqid), self.redis)
+
+        assert len(store.get_traces('a', self.redis)) == 2
+        assert self.redis.ttl(TraceStore.REQ_KEY.format('a')) > 0
+
+        recent = store.get_recent(self.redis)
+        assert [trace['reqid'] for trace in recent] == ['d', 'c', 'b']
+
+        phases = store.get_image_phases(self.redis)
+        create = phases['test-shepherd/busybox']['create_container']
+        assert create['count'] == 5
+        assert create['max'] >= create['mean'] >= 0.01
+
+        # spans without an image are not aggregated
+        assert 'create_network' not in phases['test-shepherd/busybox']
+
+    def test_error_not_aggregated(self):
+        store = TraceStore()
+        store.finish(self.make_trace(store, 'a'), self.redis, error=True)
+
+        assert store.get_traces('a', self.redis)[0]['error'] == True
+        assert store.get_image_phases(self.redis) == {}
+
+    def test_pop_last_per_greenlet(self):
+        store = TraceStore()
+
+        def finish():
+            store.finish(self.make_trace(store, 'other'), self.redis)
+
+        gevent.spawn(finish).join()
+        assert store.pop_last() is None
+
+        store.finish(self.make_trace(store, 'a'), self.redis)
+        assert store.pop_last().reqid == 'a'
+        assert store.pop_last() is None
+
+
+# ============================================================================
+class TestServerTiming(object):
+    def test_stale_trace_cleared(self):
+        from shepherd.wsgi import create_app
+        from benchmarks.utils import make_shepherd, BENCH_POOLS, BENCH_IMAGE_CONFIG
+
+        shepherd = make_shepherd()
+        app = create_app(shepherd, BENCH_POOLS, BENCH_IMAGE_CONFIG, redis_stats=False)
+        client = app.test_client()
+
+        try:
+            # launched outside of a request, in the same greenlet
+            reqid = shepherd.request_flock('bench')['reqid']
+            assert 'containers' in shepherd.start_flock(reqid)
+
+            res = client.get('/api/flock/' + reqid)
+            assert res.status_code == 200
+            assert res.json['id'] == reqid
+            assert 'Server-Timing' not in res.headers
+
+            reqid = client.post('/api/request/browser', json={}).json['reqid']
+            res = client.post('/api/flock/start/' + reqid, json={})
+            assert 'containers' in res.json
+            assert 'total;dur=' in res.headers['Server-Timing']
+
+        finally:
+            app.close()
+            shepherd.shutdown()
@@ -0,0 +1,109 @@
+from gevent.monkey import patch_all; patch_all()
+
+import pytest
+
+from benchmarks.bench_pools import PoolBenchmark
+
+
+# ============================================================================
+class TestPoolBenchmark(object):
+    @pytest.mark.parametrize('pool_type', ['all', 'fixed', 'persist'])
+    def test_run_small(self, pool_type):
+        case = PoolBenchmark(pool_type, size=2, depth=1, teardown_rate=1000).run()
+
+        ops = case['ops']
+        assert ops['request']['count'] == (3 if pool_type != 'all' else 2)
+        assert ops['start']['count'] == 2
+        assert ops['expire']['count'] == 1
+
+        assert ops['start']['redis_calls_per_op'] > 0
+        assert ops['start']['docker_calls_per_op']['create_container'] == 2
+
+        if pool_type != 'all':
+            assert ops['queue_poll']['count'] == 3
+
+        if pool_type == 'fixed':
+            assert ops['queue_admit']['count'] == 1
+
+
+# ============================================================================
+class TestLoadGen(object):
+    def test_run_small(self):
+        from benchmarks.loadgen import main
+
+        res = main(['--clients', '6', '--rate', '100', '--arrival', 'constant',
+                    '--session', 'fixed:0', '--walk-away', '0.5',
+                    '--poll-interval', '0.1', '--latency', '0'])
+
+        assert res['clients'] == 6
+        assert sum(res['outcomes'].values()) == 6
+        assert res['outcomes'].get('stopped', 0) + res['outcomes'].get('walked_away', 0) == 6
+        assert res['endpoints']['request']['rate_4xx'] == 0
+        assert res['admission_latency']['count'] == 6
+
+    def test_fairness(self):
+        from benchmarks.loadgen import count_inversions
+
+        assert count_inversions([1, 2, 3, 4])[1] == 0
+        assert count_inversions([2, 1, 4, 3])[1] == 2
+        assert count_inversions([4, 3, 2, 1])[1] == 6
+
+
+# ============================================================================
+class TestFakeEngineServer(object):
+    def make_client(self, tmpdir, **kwargs):
+        import docker
+        from benchmarks.fake_engine_server import FakeEngineServer, make_server
+        from benchmarks.utils import BENCH_IMAGES
+
+        path = str(tmpdir.join('docker.sock'))
+        self.app = FakeEngineServer(images=BENCH_IMAGES, **kwargs)
+        self.server = make_server(self.app, path)
+        self.server.start()
+
+        return docker.DockerClient(base_url='unix://' + path)
+
+    def teardown_method(self):
+        if getattr(self, 'server', None):
+            self.server.stop()
+
+    def test_start_remove_flock(self, tmpdir):
+        from benchmarks.utils import make_shepherd
+
+        client = self.make_client(tmpdir)
+        assert client.ping()
+
+        shepherd = make_shepherd(docker_client=client)
+
+        try:
+            reqid = shepherd.request_flock('bench')['reqid']
+            res = shepherd.start_flock(reqid)
+
+            assert set(res['containers']) == {'browser', 'xserver'}
+            assert res['containers']['browser']['ports']['vnc_port'] > 0
+
+            container = client.containers.get(res['containers']['browser']['id'])
+            assert container.status == 'running'
+            assert container.labels[shepherd.reqid_label] == reqid
+
+            assert shepherd.remove_flock(reqid) == {'success': True}
+            assert client.containers.list(all=True) == []
+
+        finally:
+            shepherd.shutdown()
+
+        assert self.app.docker.calls['create_container'] == 2
+
+    def test_errors(self, tmpdir):
+        import docker
+
+        client = self.make_client(tmpdir, errors={'networks.create': 1.0})
+
+        with pytest.raises(docker.errors.APIError):
+            client.networks.create('test-net')
+
+        with pytest.raises(docker.errors.NotFound):
+            client.containers.get('missing')
+
+        with pytest.raises(docker.errors.ImageNotFound):
+            client.api.create_container('missing/image')